@@ -10,39 +10,29 @@ from dbserver import DBServer
 #from utils.file import create_directory
 import time
 import logging
-import threading
 import os
 import config
 from application.superapp import SuperApp
+from testcase.permutations import PERMUTATION_RANGE_ENV
+from runner.pool import RunnerPool
+from utils.connpool import CONNECTION_POOL_SIZE
 
 RUNNER_LOG_TO_SCREEN = config.runner_output_to_streen
+RUNNER_POOL_SIZE = getattr(config, 'runner_pool_size', 0)
 logger = logging.getLogger('MultiApp')
 
-def capture_runner_output(proc, logfile, to_screen=True):
-    """ this is called by a new thread, so that it can capture the log
-    with blocking the main thread
-
-    :type proc: :class:`subprocess.Popen`
-    :param proc: the return by subprocess.Popen function call
+def echo_runner_output(logfile):
+    """duplicate the result file content to screen, this is used by the
+    runner pool mode, the worker writes the result file directly, so the
+    content can only be shown after the case finished
 
     :type logfile: str
     :param logfile: the log file absoute path
-
-    :type to_screen: bool
-    :param to_screen: indicate whether duplicated the log to screen
-
-    ..note:
-      currently not taking care of the thread end running staffing
     """
-    logger.debug("capture log to %s" % logfile)
     runner_logger = logging.getLogger("MultiRunner")
-    with open(logfile, 'w') as fd:
-        for line in iter(proc.stdout.readline, ''):
-            if to_screen:
-                runner_logger.info(line.strip())
-            fd.write('%s' % line)
-            # flush the data to disk in real time
-            fd.flush()
+    with open(logfile, 'r') as fd:
+        for line in fd:
+            runner_logger.info(line.strip())
 
 class Application(SuperApp):
     """test progress coordination, one profile bind to one Application
@@ -54,8 +44,37 @@ class Application(SuperApp):
     def __init__(self, profile, checker):
         #super(MultiApp,self).__init__(profile,checker)
         super().__init__(profile,checker)
+        # a range of the permutations is not comparable with the expected
+        checker._set_partial_run(bool(os.environ.get(PERMUTATION_RANGE_ENV)))
+        self._pool = None
 
-    def _start_batch(self, batch):
+    def run(self, test_mode):
+        """start the runner pool before the profile running if it is
+        configured, and shutdown the pool after all the cases finished
+        """
+        if RUNNER_POOL_SIZE > 0:
+            self._pool = RunnerPool(RUNNER_POOL_SIZE,
+                                    'runner.testrunner_spec', ('spec',))
+        try:
+            super().run(test_mode)
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
+    def _slots(self):
+        if self._pool is not None:
+            return self._pool.size()
+        return 0
+
+    def _reserved_connections(self):
+        # every worker of the pool keeps the idle maint and session
+        # connections of its connection pool
+        if self._pool is not None:
+            return self._pool.size() * 2 * CONNECTION_POOL_SIZE
+        return 0
+
+    def _start_batch(self, batch, port=None):
         """execute a batch of test cases parallelly
 
         if there is on one test case in the batch, just run it singlly
@@ -63,40 +82,78 @@ class Application(SuperApp):
 
         super()._start_batch_prompt(batch)
 
+        if self._pool is not None:
+            self._start_batch_in_pool(batch, port)
+            diff_results = self.checker._make_many_diff(batch.tests())
+            super()._end_batch_prompt(batch,diff_results)
+            return
+
         import subprocess
-        processes = []
-        env = os.environ.copy()
+        env = self._runner_env(port)
 
-        for case in batch.tests():
+        def launch(case):
             child = subprocess.Popen(
                 ['python3', '-u', 'runner/testrunner_spec.py', case.path()],
                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                universal_newlines=True, env=env
+                env=env
                 )
-        
+
             result_file = os.path.join(self.checker._results_dir,
                                        case.name()+".out")
 
-            t = threading.Thread(target=capture_runner_output,
-                                 args=(child, result_file,
-                                       RUNNER_LOG_TO_SCREEN))
-            t.start()
-            processes.append(child)
+            self._output.add(child, result_file, RUNNER_LOG_TO_SCREEN,
+                             "MultiRunner")
+            return child
 
-        for child in processes:
-            child.wait()
+        self._run_runners(batch.tests(), launch, port)
 
         diff_results = self.checker._make_many_diff(batch.tests())
         
         super()._end_batch_prompt(batch,diff_results)
 
+    def _start_batch_in_pool(self, batch, port=None):
+        """run all the cases of the batch in the runner pool, at most
+        pool size cases are running at the same time, the longest case is
+        submitted first, so it does not start last and stretch the batch.
+        a case is submitted only after the limiter admits it
+        """
+        handles = []
+        env = self._port_env(port)
+        limiter = self._limiter(port)
+        for case in self._longest_first(batch.tests()):
+            result_file = os.path.join(self.checker._results_dir,
+                                       case.name()+".out")
+            demand = self._case_connections(case)
+            limiter.acquire(demand)
+            release = lambda _, demand=demand: limiter.release(demand)
+            handles.append(
+                (case, self._pool.submit(case.path(), result_file, env,
+                                         release),
+                 result_file)
+                )
 
-    def _start_test(self, testcase):
+        for case, handle, result_file in handles:
+            self._record_duration(case, handle.get())
+            if RUNNER_LOG_TO_SCREEN:
+                echo_runner_output(result_file)
+
+    def _start_test(self, testcase, port=None):
         """run the test case singly, one by one
         """
         logger.debug("processing case \n%s" % str(testcase))
 
         super()._start_testcase_prompt(testcase)
+
+        if self._pool is not None:
+            result_file = os.path.join(self.checker._results_dir,
+                                       testcase.name()+".out")
+            self._pool.run(testcase.path(), result_file,
+                           self._port_env(port))
+            if RUNNER_LOG_TO_SCREEN:
+                echo_runner_output(result_file)
+            diff_result = self.checker._make_diff(testcase)
+            super()._end_testcase_prompt(testcase,diff_result)
+            return
         
         # here why we want to run the testcase in a seperate process is
         # to capture the pure output of the testcase runner. run testcase
@@ -123,20 +180,19 @@ class Application(SuperApp):
         child = subprocess.Popen(
             ['python3', '-u', 'runner/testrunner_spec.py', testcase.path()],
             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            universal_newlines=True
+            env=self._runner_env(port)
             )
         
         result_file = os.path.join(self.checker._results_dir,
                                    testcase.name()+".out")
         # Popen communicate is not good, since it will block until the
         # the runner finish and then we can get the output, here we use
-        # a thread to monitor the runner tool, and print the stdout
-        # content to screen and result file in real time
-        t = threading.Thread(target=capture_runner_output,
-                             args=(child, result_file,
-                                   RUNNER_LOG_TO_SCREEN))
-        t.start()
+        # the output multiplexer to drain the stdout of the runner tool to
+        # screen and result file
+        self._output.add(child, result_file, RUNNER_LOG_TO_SCREEN,
+                         "MultiRunner")
         child.wait()
+        self._output.wait(child)
 
         diff_result = self.checker._make_diff(testcase)
 
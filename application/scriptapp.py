@@ -10,41 +10,15 @@ from dbserver import DBServer
 #from utils.file import create_directory
 import time
 import logging
-import threading
 import os
 import config
 from application.superapp import SuperApp
+from testcase.permutations import PERMUTATION_RANGE_ENV
 
 
 logger = logging.getLogger('scriptapp')
 RUNNER_LOG_TO_SCREEN = config.runner_output_to_streen
 
-def capture_runner_output(proc, logfile, to_screen=True):
-    """ this is called by a new thread, so that it can capture the log
-    with blocking the main thread
-
-    :type proc: :class:`subprocess.Popen`
-    :param proc: the return by subprocess.Popen function call
-    
-    :type logfile: str
-    :param logfile: the log file absoute path
-    
-    :type to_screen: bool
-    :param to_screen: indicate whether duplicated the log to screen
-
-    ..note:
-      currently not taking care of the thread end running staffing
-    """
-    logger.debug("capture log to %s" % logfile)
-    runner_logger = logging.getLogger("ScriptRunner")
-    with open(logfile, 'w') as fd:
-        for line in iter(proc.stdout.readline, ''):
-            if to_screen:
-                runner_logger.info(line.strip())
-            fd.write('%s' % line)
-            # flush the data to disk in real time
-            fd.flush()
-
 class Application(SuperApp):
     """test progress coordination, one profile bind to one Application
        there are two kinds of Applications, this Application is for multisession.
@@ -52,11 +26,17 @@ class Application(SuperApp):
     :type profile: :class:`Profile`
     :param profile: profile which bind to this application
     """
+    # the keywords restart or reload the instance of the default data
+    # directory, the cases cannot be spread over other instances
+    SUPPORT_INSTANCES = False
+
     def __init__(self, profile, checker):
         #super(ScriptApp,self).__init__(profile,checker)
         super().__init__(profile,checker)
+        # a range of the permutations is not comparable with the expected
+        checker._set_partial_run(bool(os.environ.get(PERMUTATION_RANGE_ENV)))
 
-    def _start_batch(self, batch):
+    def _start_batch(self, batch, port=None):
         """execute a batch of test cases parallelly
 
         if there is on one test case in the batch, just run it singlly
@@ -65,27 +45,23 @@ class Application(SuperApp):
         super()._start_batch_prompt(batch)
 
         import subprocess
-        processes = []
-        env = os.environ.copy()
+        env = self._runner_env(port)
 
-        for case in batch.tests():
+        def launch(case):
             child = subprocess.Popen(
                 ['python3', '-u', 'runner/testrunner_spt.py', case.path()],
                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                universal_newlines=True, env=env
+                env=env
                 )
-        
+
             result_file = os.path.join(self.checker._results_dir,
                                        case.name()+".out")
 
-            t = threading.Thread(target=capture_runner_output,
-                                 args=(child, result_file,
-                                       RUNNER_LOG_TO_SCREEN))
-            t.start()
-            processes.append(child)
+            self._output.add(child, result_file, RUNNER_LOG_TO_SCREEN,
+                             "ScriptRunner")
+            return child
 
-        for child in processes:
-            child.wait()
+        self._run_runners(batch.tests(), launch, port)
 
         time.sleep(2)
         diff_results = self.checker._make_many_diff(batch.tests())
@@ -93,7 +69,7 @@ class Application(SuperApp):
         super()._end_batch_prompt(batch,diff_results)
 
 
-    def _start_test(self, testcase):
+    def _start_test(self, testcase, port=None):
         """run the test case singly, one by one
         """
         logger.debug("processing case \n%s" % str(testcase))
@@ -125,20 +101,19 @@ class Application(SuperApp):
         child = subprocess.Popen(
             ['python3', '-u', 'runner/testrunner_spt.py', testcase.path()],
             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            universal_newlines=True
+            env=self._runner_env(port)
             )
         
         result_file = os.path.join(self.checker._results_dir,
                                    testcase.name()+".out")
         # Popen communicate is not good, since it will block until the
         # the runner finish and then we can get the output, here we use
-        # a thread to monitor the runner tool, and print the stdout
-        # content to screen and result file in real time
-        t = threading.Thread(target=capture_runner_output,
-                             args=(child, result_file,
-                                   RUNNER_LOG_TO_SCREEN))
-        t.start()
+        # the output multiplexer to drain the stdout of the runner tool to
+        # screen and result file
+        self._output.add(child, result_file, RUNNER_LOG_TO_SCREEN,
+                         "ScriptRunner")
         child.wait()
+        self._output.wait(child)
 
         time.sleep(2)
         diff_result = self.checker._make_diff(testcase)
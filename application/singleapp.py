@@ -10,7 +10,6 @@ from dbserver import DBServer
 #from utils.file import create_directory
 import time
 import logging
-import threading
 import os
 import config
 from application.superapp import SuperApp
@@ -18,32 +17,6 @@ from application.superapp import SuperApp
 logger = logging.getLogger('SingleApp')
 RUNNER_LOG_TO_SCREEN = config.runner_output_to_streen
 
-def capture_runner_output(proc, logfile, to_screen=True):
-    """ this is called by a new thread, so that it can capture the log
-    with blocking the main thread
-
-    :type proc: :class:`subprocess.Popen`
-    :param proc: the return by subprocess.Popen function call
-    
-    :type logfile: str
-    :param logfile: the log file absoute path
-    
-    :type to_screen: bool
-    :param to_screen: indicate whether duplicated the log to screen
-
-    ..note:
-      currently not taking care of the thread end running staffing
-    """
-    logger.debug("capture log to %s" % logfile)
-    runner_logger = logging.getLogger("SingleRunner")
-    with open(logfile, 'w') as fd:
-        for line in iter(proc.stdout.readline, ''):
-            if to_screen:
-                runner_logger.info(line.strip())
-            fd.write('%s' % line)
-            # flush the data to disk in real time
-            fd.flush()
-
 class Application(SuperApp):
     """test progress coordination, one profile bind to one Application
        there are two kinds of Applications, this Application is for multisession.
@@ -56,7 +29,11 @@ class Application(SuperApp):
         super().__init__(profile,checker)       
         
  
-    def _start_batch(self, batch):
+    def _case_connections(self, testcase):
+        # psql runs the whole case in one connection
+        return 1
+
+    def _start_batch(self, batch, port=None):
         """execute a batch of test cases parallelly
 
         if there is on one test case in the batch, just run it singlly
@@ -65,33 +42,29 @@ class Application(SuperApp):
         super()._start_batch_prompt(batch)
 
         import subprocess
-        processes = []
-        env = os.environ.copy()
+        env = self._runner_env(port)
         psql = os.path.join(config.installation,'bin/','psql')
 
-        for case in batch.tests():
+        def launch(case):
             child = subprocess.Popen(
                 [psql, '-U', config.user, '-d',config.dbname,'-f', case.path()],
                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                universal_newlines=True, env=env
+                env=env
                 )
-        
+
             result_file = os.path.join(self.checker._results_dir,
                                        case.name()+".out")
 
-            t = threading.Thread(target=capture_runner_output,
-                                 args=(child, result_file,
-                                       RUNNER_LOG_TO_SCREEN))
-            t.start()
-            processes.append(child)
+            self._output.add(child, result_file, RUNNER_LOG_TO_SCREEN,
+                             "SingleRunner")
+            return child
 
-        for child in processes:
-            child.wait()
+        self._run_runners(batch.tests(), launch, port)
         diff_results = self.checker._make_many_diff(batch.tests())
         
         super()._end_batch_prompt(batch,diff_results)
 
-    def _start_test(self, testcase):
+    def _start_test(self, testcase, port=None):
         """run the test case singly, one by one
         """
         logger.debug("processing case \n%s" % str(testcase))
@@ -109,20 +82,19 @@ class Application(SuperApp):
         child = subprocess.Popen(
             [psql, '-U', config.user, '-d',config.dbname,'-f', testcase.path()],
             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            universal_newlines=True
+            env=self._runner_env(port)
             )
         
         result_file = os.path.join(self.checker._results_dir,
                                    testcase.name()+".out")
         # Popen communicate is not good, since it will block until the
         # the runner finish and then we can get the output, here we use
-        # a thread to monitor the runner tool, and print the stdout
-        # content to screen and result file in real time
-        t = threading.Thread(target=capture_runner_output,
-                             args=(child, result_file,
-                                   RUNNER_LOG_TO_SCREEN))
-        t.start()
+        # the output multiplexer to drain the stdout of the runner tool to
+        # screen and result file
+        self._output.add(child, result_file, RUNNER_LOG_TO_SCREEN,
+                         "SingleRunner")
         child.wait()
+        self._output.wait(child)
 
         diff_result = self.checker._make_diff(testcase)
 
@@ -7,20 +7,39 @@ that one profile should contain one kind of testcase.
 """
 
 from dbserver import DBServer
-from dbserver import get_installation_bin_path
-from dbserver import get_installation_lib_path
+from dbserver import wait_for_server_ready
 #from utils.file import create_directory
 import time
 import datetime
 import logging
 import threading
 import os
+import queue
+import hashlib
 import config
-import subprocess
+from utils.file import create_directory
+from utils.connection import SERVER_PORT_ENV
+from utils import trace
+from utils.schedule import GraphScheduler, TestBatch
+from utils.history import case_history
+from utils.output import OutputMultiplexer
+from utils.limiter import (ConnectionLimiter, case_connections,
+                           server_connection_budget, CONNECTION_BUDGET)
+from utils.makespan import (CaseEstimator, longest_first, slots_makespan,
+                            graph_priorities, graph_makespan)
 
 _PORT = config.port
 _DBNAME = config.dbname
 _INSTALLDIR = config.installation
+# in check mode, the number of temporary instances the cases are spread
+# over when the schedule declares the needs or the conflicts, each instance
+# use its own data directory, log directory and port
+_CHECK_INSTANCES = getattr(config, 'check_instances', 1)
+# the max cases running at the same time when the schedule declares the
+# needs or the conflicts, 0 means no limit (or one case per instance)
+_SCHEDULE_WORKERS = getattr(config, 'schedule_workers', 0)
+# the seconds between the checks of the runner processes of a batch
+_WAIT_INTERVAL = 0.05
 logger = logging.getLogger('SuperApp')
 
 class SuperApp(object):
@@ -30,16 +49,36 @@ class SuperApp(object):
     :type profile: :class:`Profile`
     :param profile: profile which bind to this application
     """
+    # whether the cases of the application can be run on the different
+    # temporary instances, the application which operates the instance
+    # data directory directly should not support it
+    SUPPORT_INSTANCES = True
+
     def __init__(self, profile, checker):
         self.profile = profile
         self.checker = checker
         self._maint_session = None
         self._sessions = {}
         self.server = None
+        self._instances = [] # [(data_path, port)]
         self._clear_logs()
         self._start_time = None
         self._end_time = None
         self._fail_reason = {}
+        self._case_start = {} # {testcase name: timestamp}
+        # the case duration history, and the prediction by it
+        self._history = case_history()
+        self._history_lock = threading.Lock()
+        self._estimator = CaseEstimator(self._history, self._case_key)
+        # run the cases even if they passed with the same inputs before
+        self._force = False
+        # drain the output of all the runner processes
+        self._output = OutputMultiplexer()
+        # the concurrency limiters of the servers, {port: limiter}
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+        # the prompts of the cases running in threads are not interleaved
+        self._prompt_lock = threading.Lock()
  
 
     def _clear_logs(self):
@@ -56,74 +95,106 @@ class SuperApp(object):
         """whether PostgreSQL is accepting message
 
         although the process of the database server may be up, but it
-        maybe cannot accept message, this function use psql to send
-        message to check whether the server is really can handle message
-
-        :rtype: Boolen
-        :returns: whether the database server is running and can accept
-                  message (means psql can connect to)
+        maybe cannot accept message, this function try to connect the
+        server to check whether the server is really can handle message,
+        exit if it cannot be connected.
         """
         logger.info('TestMode:installcheck, check the PG server is running......')
 
-        child = subprocess.run('ps -ef |grep postgres', shell=True, stdout=subprocess.PIPE)
-        if child.returncode != 0:
-            logger.info('Postgremaster process is NOT running, please confirm your DB is started!')
+        ready, seconds, probes = wait_for_server_ready(_PORT, timeout=5)
+        if not ready:
+            logger.info('DB server cannot be connected, please confirm your DB is ready!')
             exit()
-        else:
-            bin_path = get_installation_bin_path()
-            psql = os.path.join(bin_path, 'psql')
-            lib_path = get_installation_lib_path()
-            logger.debug('DBServer::is_ready() bin: %s, lib: %s'
-                         % (psql, lib_path))
-            #env = {'LD_LIBRARY_PATH': lib_path,'HG_BASE':_INSTALLDIR}
-            env = {'LD_LIBRARY_PATH': lib_path,'PGPASSWORD': config.password,'HG_BASE':_INSTALLDIR}
-            cmd = " ".join([
-                psql, '-U', str(config.user), '-p', str(_PORT), str(_DBNAME), '<', '/dev/null'
-                ])
-            child = subprocess.run(
-                cmd, shell=True, env=env, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-                )
-
-            if child.returncode != 0:
-                logger.debug("psql connect fail for reason %s"
-                             % child.stderr)
-                logger.info('DB server cannot be connected, please confirm your DB is ready!')
-                exit()
+        logger.debug("server is ready after %.3f seconds, %d probes"
+                     % (seconds, probes))
         logger.info('PG server is ready,start to run test......')
 
 
-    def _make_PGServer(self,data_path):
+    def _make_PGServer(self, data_path, port=_PORT, logs_dir=None):
         """initialize a database instance, and start the database service
 
         ..note:
           before start the service, some parameters in configuration should
           be added or changed, they are mainly used to turn on enough logs
+
+        :type port: int
+        :param port: the port of the database service
+
+        :type logs_dir: str
+        :param logs_dir: the directory of postmaster log, default is the
+                         log directory of the checker
         """
+        if logs_dir is None:
+            logs_dir = self.checker._logs_dir
         logger.info('TestMode:check,try to start a PG server......')
-        DBServer.initDB(data_path)
-        DBServer.set_dbconf(data_path,
-                            port=_PORT,
-                            log_autovacuum_min_duration='0',
-                            log_checkpoints='on',
-                            #log_line_prefix="'%m [%p] %q%a '",
-                            log_lock_waits = 'on',
-                            log_temp_files = '128kB',
-                            max_prepared_transactions = '2')
+        DBServer.prepareDB(data_path,
+                           port=port,
+                           log_autovacuum_min_duration='0',
+                           log_checkpoints='on',
+                           #log_line_prefix="'%m [%p] %q%a '",
+                           log_lock_waits = 'on',
+                           log_temp_files = '128kB',
+                           max_prepared_transactions = '2')
         logger.info('TestMode:check,DONE to config file......')
 
-        self.server = DBServer.start(data_path, self.checker._logs_dir)
+        server = DBServer.start(data_path, logs_dir, port)
+        if self.server is None:
+            self.server = server
         
-        while not self.server.is_ready():
-            logger.debug("keep trying to start the PostgreSQL service")
-            time.sleep (1)
+        server.wait_ready()
 
         logger.info('PG server is ready,start to run test......')
 
-    def _clear_PGServer(self,data_path):
+    def _make_PGServers(self):
+        """start the temporary instances for check mode, the first instance
+        use the configured port and the default data directory, the others
+        use the next ports, and have their own data and log directories.
+
+        ..note:
+          the cases of the schedule lines run in sequence on the same
+          database, a later case may use the objects of a earlier one, so
+          only the cases with the declared needs and conflicts are spread
+          over the instances, the others run on a single instance
+        """
+        instances = _CHECK_INSTANCES if self.SUPPORT_INSTANCES else 1
+        if instances > 1 and not self._has_constraints():
+            logger.info("the schedule declares no needs or conflicts, "
+                        "run on a single instance")
+            instances = 1
+        if instances <= 1:
+            data_path = './tmp_instance/data'
+            self._make_PGServer(data_path)
+            self._instances = [(data_path, _PORT)]
+            return
+
+        for i in range(instances):
+            data_path = './tmp_instance/data%d' % i
+            port = _PORT + i
+            logs_dir = os.path.join(self.checker._logs_dir, 'instance%d' % i)
+            create_directory(logs_dir)
+            self._make_PGServer(data_path, port, logs_dir)
+            self._instances.append((data_path, port))
+
+    def _has_constraints(self):
+        return (self.profile.use_schedule()
+                and self.profile.schedule().has_constraints())
+
+    def _clear_PGServers(self):
+        if len(self._instances) <= 1:
+            for data_path, _ in self._instances:
+                self._clear_PGServer(data_path)
+            return
+
+        for i, (data_path, _) in enumerate(self._instances):
+            logs_dir = os.path.join(self.checker._logs_dir, 'instance%d' % i)
+            self._clear_PGServer(data_path, logs_dir)
+
+    def _clear_PGServer(self, data_path, logs_dir=None):
         #DBServer.stopDB(self.server,data_path)
+        if logs_dir is None:
+            logs_dir = self.checker._logs_dir
         logger.info('TestMode:check,try to stop PG server......')
-        DBServer.stopDB(data_path, self.checker._logs_dir)
+        DBServer.stopDB(data_path, logs_dir)
         DBServer.removeDB(data_path)
         if DBServer.check_database_data_exist(data_path):
             raise Exception("fail to remove the DB data")
@@ -147,40 +218,232 @@ class SuperApp(object):
         self._end_time = now
 
     def _start_batch_prompt(self,batch):
-        now = datetime.datetime.now()
-        print("----------start batch of test------------")
-        print(" Start at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
-        for test in batch.tests():
-            print("  %s" % test.name())
-        print("-----------------------------------------")
+        with self._prompt_lock:
+            now = datetime.datetime.now()
+            print("----------start batch of test------------")
+            print(" Start at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
+            for test in batch.tests():
+                print("  %s" % test.name())
+            print("-----------------------------------------")
 
     def _end_batch_prompt(self,batch,results):
-        now = datetime.datetime.now()
-        print("----------end batch of test--------------")
-        print(" End at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
-        tests = batch.tests()
-        for i in range(batch.len()):
-            result = "ok" if results[i] is True else "fail"
-            print("  %s ... %s" % (batch[i].name(), result))
-        print("-----------------------------------------")
+        with self._prompt_lock:
+            now = datetime.datetime.now()
+            print("----------end batch of test--------------")
+            print(" End at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
+            tests = batch.tests()
+            for i in range(batch.len()):
+                result = "ok" if results[i] is True else "fail"
+                print("  %s ... %s" % (batch[i].name(), result))
+            print("-----------------------------------------")
 
 
     def _start_testcase_prompt(self,testcase):
-        now = datetime.datetime.now()
-        print("+----------------------------------------")
-        print(" TestRunner for %s" % testcase.name())
-        print(" Start at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
-        print("----------------------------------------+")
+        with self._prompt_lock:
+            now = datetime.datetime.now()
+            print("+----------------------------------------")
+            print(" TestRunner for %s" % testcase.name())
+            print(" Start at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
+            print("----------------------------------------+")
+        self._case_start[testcase.name()] = trace.now()
 
 
     def _end_testcase_prompt(self,testcase,result):
-        now = datetime.datetime.now()
-        print("+----------------------------------------")
-        #print(" TestRunner for %s" % testcase)
-        print(" Case end at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
-        result = "ok" if result else "fail"
-        print("  %s ... %s" % (testcase.name(), result))
-        print("----------------------------------------+")
+        with self._prompt_lock:
+            now = datetime.datetime.now()
+            print("+----------------------------------------")
+            #print(" TestRunner for %s" % testcase)
+            print(" Case end at %s" % now.strftime("%Y-%m-%d %H:%M:%S"))
+            result = "ok" if result else "fail"
+            print("  %s ... %s" % (testcase.name(), result))
+            print("----------------------------------------+")
+        start = self._case_start.pop(testcase.name(), None)
+        if start is not None:
+            self._record_duration(testcase, time.time() - start)
+            trace.complete('case', 'app', start, case=testcase.name(),
+                           result=result)
+
+    def set_force(self, force):
+        """
+        :type force: Boolean
+        :param force: run all the cases, the cached passes are not used
+        """
+        self._force = force
+
+    def _skip_cached(self, batches):
+        """report the cases passed with the same inputs, after the same
+        cases, as cached passes without running them
+
+        the cases of a batch run after all the cases of the earlier batches
+        on the same database, a case may use the objects of a earlier one,
+        so the key of a case includes the keys of the earlier cases, and
+        only the batches at the end whose cases are all cached passes are
+        skipped, a cached case before a running case still runs.
+
+        :type batches: list of :class:`utils.schedule.TestBatch`
+        :param batches: the batches in the running sequence
+
+        :rtype: list of :class:`utils.schedule.TestBatch`
+        :returns: the batches need to run
+        """
+        if not self.checker._cache_enabled():
+            return batches
+        context = hashlib.sha1()
+        for batch in batches:
+            for case in batch.tests():
+                self.checker._set_cache_context(case, context.hexdigest())
+            for case in batch.tests():
+                context.update(self.checker._cache_key(case).encode('utf-8'))
+        if self._force:
+            return batches
+
+        count = len(batches)
+        while count > 0 and all(self.checker._cached_pass(case) is not None
+                                for case in batches[count - 1].tests()):
+            count -= 1
+        for batch in batches[count:]:
+            for case in batch.tests():
+                self.checker._use_cached_pass(case)
+        return batches[:count]
+
+    def _skip_cached_graph(self, graph):
+        """the graph version of _skip_cached(), the key of a case includes
+        the keys of its prerequisites, and a cached case is skipped only
+        if all the cases need it are skipped too
+
+        :type graph: :class:`utils.schedule.ScheduleGraph`
+
+        :rtype: set of str
+        :returns: the names of the skipped cases
+        """
+        if not self.checker._cache_enabled():
+            return set()
+        cases = dict([(case.name(), case) for case in graph.cases()])
+        names = graph.sorted_names()
+        keys = {}
+        for name in names:
+            context = hashlib.sha1()
+            for other in sorted(graph.needs(name)):
+                context.update(keys[other].encode('utf-8'))
+            self.checker._set_cache_context(cases[name], context.hexdigest())
+            keys[name] = self.checker._cache_key(cases[name])
+        if self._force:
+            return set()
+
+        dependents = graph.dependents()
+        skipped = set()
+        for name in reversed(names):
+            if (all(other in skipped for other in dependents[name])
+                and self.checker._cached_pass(cases[name]) is not None):
+                skipped.add(name)
+        for case in graph.cases():
+            if case.name() in skipped:
+                self.checker._use_cached_pass(case)
+        return skipped
+
+    def _case_key(self, testcase):
+        return "%s/%s" % (self.profile.name, testcase.name())
+
+    def _record_duration(self, testcase, seconds):
+        with self._history_lock:
+            self._history.add(self._case_key(testcase), seconds)
+
+    def _limiter(self, port=None):
+        """the concurrency limiter of the server, the connection budget is
+        got from the server when it is used first time
+
+        :type port: int
+        :param port: the port of the server, None means the default one
+
+        :rtype: :class:`utils.limiter.ConnectionLimiter`
+        """
+        port = _PORT if port is None else port
+        with self._limiters_lock:
+            limiter = self._limiters.get(port)
+            if limiter is None:
+                budget = CONNECTION_BUDGET
+                if budget is None:
+                    budget = server_connection_budget(port)
+                    if budget > 0:
+                        budget = max(budget - self._reserved_connections(),
+                                     1)
+                logger.debug("connection budget of port %d: %d"
+                             % (port, budget))
+                limiter = ConnectionLimiter(budget=budget)
+                self._limiters[port] = limiter
+            return limiter
+
+    def _reserved_connections(self):
+        """the connections kept by the application out of the cases, like
+        the idle connections of the runner pool workers
+        """
+        return 0
+
+    def _case_connections(self, testcase):
+        """the connections the runner of the case opens
+        """
+        return case_connections(testcase.path())
+
+    def _run_runners(self, cases, launch, port=None):
+        """start the runner processes of the cases as many as the limiter
+        admits, the longest case first, and wait for all of them, the
+        duration of a case is recorded as soon as its runner exits
+
+        :type cases: list of :class:`testcase.TestCaseDesc`
+        :param cases: the cases of a batch
+
+        :type launch: function
+        :param launch: start the runner of a case, and return the
+                       :class:`subprocess.Popen`
+        """
+        limiter = self._limiter(port)
+        pending = self._longest_first(cases)
+        running = [] # [(testcase, child, start time, connections)]
+        while pending or running:
+            for testcase in list(pending):
+                demand = self._case_connections(testcase)
+                if not limiter.try_acquire(demand):
+                    continue
+                pending.remove(testcase)
+                running.append((testcase, launch(testcase), time.time(),
+                                demand))
+
+            for runner in list(running):
+                testcase, child, start, demand = runner
+                if child.poll() is None:
+                    continue
+                self._record_duration(testcase, time.time() - start)
+                # the result file is complete only after the output drained
+                self._output.wait(child)
+                limiter.release(demand)
+                running.remove(runner)
+            if running:
+                time.sleep(_WAIT_INTERVAL)
+
+    def _slots(self):
+        """the max cases of a batch running at the same time, 0 means no
+        limit, the application with a runner pool limits it
+        """
+        return 0
+
+    def _longest_first(self, cases):
+        return longest_first(cases, self._estimator.estimate)
+
+    def _unit_estimate(self, unit):
+        """the predicted seconds of a batch or a case
+        """
+        if not hasattr(unit, 'tests'):
+            return self._estimator.estimate(unit)
+        return slots_makespan(
+            [self._estimator.estimate(case) for case in unit.tests()],
+            self._slots()
+            )
+
+    def _print_prediction(self, makespan, cases):
+        known = len([case for case in cases if self._estimator.known(case)])
+        print(" Predicted makespan %s, %d of %d cases have history"
+              % (datetime.timedelta(seconds=int(makespan)), known,
+                 len(cases)))
 
 
     def run(self,test_mode):
@@ -192,40 +455,133 @@ class SuperApp(object):
        
 
         if test_mode == 'check':
-            data_path = './tmp_instance/data'
-            self._make_PGServer(data_path)
+            self._make_PGServers()
         else:
             data_path = config.data_path
             self._check_DB_ready()
 
-        if self.profile.use_schedule():
-            schedule = self.profile.schedule()
-            batch = schedule.next_batch()
+        if self._has_constraints():
+            self._run_schedule_graph()
+        else:
+            batches = []
+            if self.profile.use_schedule():
+                schedule = self.profile.schedule()
+                batch = schedule.next_batch()
+                while batch:
+                    batches.append(batch)
+                    batch = schedule.next_batch()
+            else:
+                case = self.profile.next_case()
+                while case:
+                    batches.append(TestBatch([case]))
+                    case = self.profile.next_case()
+
+            batches = self._skip_cached(batches)
+            self._print_prediction(
+                sum([self._unit_estimate(batch) for batch in batches]),
+                [case for batch in batches for case in batch.tests()]
+                )
 
-            while batch:
+            for batch in batches:
                 if batch.len() > 1:
                     self._start_batch(batch)
                 else:
                     self._start_test(batch.tests()[0])
-                batch = schedule.next_batch()
-        else:
-
-            case = self.profile.next_case()
-            while case:
-                self._start_test(case)
-                case = self.profile.next_case()
 
         logger.debug("cases run out!")
+        self._history.save()
  
         if test_mode == 'check':
-            self._clear_PGServer(data_path)
+            self._clear_PGServers()
 
         self._end_profile_prompt()
         logger.info("calculate the report data")
         self.checker._reportdata_gen(self._start_time,self._end_time)
 
 
-    def _start_batch(self, batch):
+    def _run_schedule_graph(self):
+        """run the cases by the needs and the conflicts of the schedule, a
+        case is started as soon as it is ready, instead of waiting for the
+        whole batch before it, see utils/schedule.py. with the temporary
+        instances, every case takes a free instance.
+        """
+        graph = self.profile.schedule().graph()
+        # the cached passes are done at once, they only keep the ordering
+        cached = self._skip_cached_graph(graph)
+
+        def estimate(case):
+            if case.name() in cached:
+                return 0
+            return self._estimator.estimate(case)
+
+        # the cases on the longest path to the end are started first
+        priorities = graph_priorities(graph, estimate)
+        if len(self._instances) <= 1:
+            workers = _SCHEDULE_WORKERS or self._slots()
+        else:
+            workers = len(self._instances)
+            if _SCHEDULE_WORKERS > 0:
+                workers = min(workers, _SCHEDULE_WORKERS)
+        self._print_prediction(
+            graph_makespan(graph, estimate, workers, priorities),
+            [case for case in graph.cases() if case.name() not in cached]
+            )
+
+        def start_test(case):
+            if case.name() in cached:
+                return
+            demand = self._case_connections(case)
+            limiter = self._limiter()
+            limiter.acquire(demand)
+            try:
+                self._start_test(case)
+            finally:
+                limiter.release(demand)
+
+        if len(self._instances) <= 1:
+            GraphScheduler(graph, workers, priorities).run(start_test)
+            return
+
+        free_ports = queue.Queue()
+        for _, port in self._instances:
+            free_ports.put(port)
+
+        def start(case):
+            if case.name() in cached:
+                return
+            port = free_ports.get()
+            try:
+                self._start_test(case, port)
+            finally:
+                free_ports.put(port)
+
+        GraphScheduler(graph, workers, priorities).run(start)
+
+    def _port_env(self, port=None):
+        """the environment variables which tell the runner (or psql) which
+        instance to connect
+
+        :type port: int
+        :param port: the port of the instance, None means the default one
+
+        :rtype: dict
+        :returns: the environment variables for the port
+        """
+        if port is None:
+            return {}
+        return {SERVER_PORT_ENV: str(port), 'PGPORT': str(port)}
+
+    def _runner_env(self, port=None):
+        """the environment for the runner process
+
+        :rtype: dict
+        :returns: the environment variables for the runner
+        """
+        env = os.environ.copy()
+        env.update(self._port_env(port))
+        return env
+
+    def _start_batch(self, batch, port=None):
         """execute a batch of test cases parallelly
 
         if there is on one test case in the batch, just run it singlly
@@ -233,7 +589,7 @@ class SuperApp(object):
         print("super application function, cutomzied class will re-write it")
 
 
-    def _start_test(self, testcase):
+    def _start_test(self, testcase, port=None):
         """run the test case singly, one by one
         """
         print("application function, cutomzied class will re-write it")
@@ -0,0 +1,250 @@
+"""in process result differ
+
+the result file and the expected file are compared in python, the lines
+which are not stable (like the login information printed by the server)
+are dropped by the line filters when reading the result file, the result
+file itself is not changed. when the files are different, a unified diff
+is written next to the result file.
+
+the result can be compared with several alternative expected files, the
+first alternative which matches stops the compare. before compared, both
+sides are normalized: the masks replace the unstable words (like pids,
+timestamps and oids), and the lines of the unordered blocks are sorted.
+"""
+
+import os
+import re
+import difflib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('Differ')
+
+
+class LineFilter(object):
+    """drop a range of lines, works like sed '/start/,/end/d'
+
+    the line matching the start pattern and the lines after it are dropped
+    until a line matching the end pattern (the end line is dropped too), if
+    the end pattern is None only the start line is dropped.
+
+    :type start: str
+    :param start: regular expression of the first line to drop
+
+    :type end: str
+    :param end: regular expression of the last line to drop
+    """
+    def __init__(self, start, end=None):
+        self._start = re.compile(start)
+        self._end = re.compile(end) if end is not None else None
+
+    def apply(self, lines):
+        """filter the lines
+
+        :type lines: iterable of str
+        :param lines: the lines to filter
+
+        :rtype: generator of str
+        :returns: the lines out of the ranges
+        """
+        in_range = False
+        for line in lines:
+            if in_range:
+                if self._end.search(line):
+                    in_range = False
+                continue
+            if self._start.search(line):
+                in_range = self._end is not None
+                continue
+            yield line
+
+
+class LineMask(object):
+    """replace the unstable words of every line
+
+    :type pattern: str
+    :param pattern: regular expression of the unstable words
+
+    :type repl: str
+    :param repl: the replacement, like '<pid>'
+    """
+    def __init__(self, pattern, repl):
+        self._pattern = re.compile(pattern)
+        self._repl = repl
+
+    def apply(self, lines):
+        for line in lines:
+            yield self._pattern.sub(self._repl, line)
+
+
+class UnorderedBlock(object):
+    """sort the lines between the start line and the end line, used for
+    the query results which have no stable order
+
+    the start line and the end line themselves keep the position, if the
+    end line is not found, the lines to the end of file are sorted. the
+    end line may also start the next block, like the back to back steps.
+
+    :type start: str
+    :param start: regular expression of the line before the block
+
+    :type end: str
+    :param end: regular expression of the line after the block
+    """
+    def __init__(self, start, end):
+        self._start = re.compile(start)
+        self._end = re.compile(end)
+
+    def apply(self, lines):
+        block = None
+        for line in lines:
+            if block is not None:
+                if not self._end.search(line):
+                    block.append(line)
+                    continue
+                yield from sorted(block)
+                block = None
+            if self._start.search(line):
+                block = []
+            yield line
+        if block is not None:
+            yield from sorted(block)
+
+
+class ResultDiffer(object):
+    """compare the result file with the expected file
+
+    :type filters: list of :class:`LineFilter`
+    :param filters: the filters applied to the result file lines
+
+    :type normalizers: list of :class:`LineMask` or :class:`UnorderedBlock`
+    :param normalizers: applied to both sides in sequence before compare
+
+    :type workers: int
+    :param workers: the number of threads to diff many cases
+    """
+    def __init__(self, filters=(), normalizers=(), workers=None):
+        self._filters = list(filters)
+        self._normalizers = list(normalizers)
+        self._workers = workers or os.cpu_count() or 1
+
+    def _read_lines(self, path, filtered=False):
+        """read the file lines with the line endings kept, so that the
+        compare is byte exact like the diff command
+        """
+        with open(path, 'r', newline='') as fd:
+            lines = iter(fd)
+            if filtered:
+                for f in self._filters:
+                    lines = f.apply(lines)
+            for n in self._normalizers:
+                lines = n.apply(lines)
+            for line in lines:
+                yield line
+
+    def is_same(self, expected, result):
+        """stream the two files, and stop at the first different line
+
+        :type result: str or list of str
+        :param result: the result file, or the result lines already read
+
+        :rtype: Boolen
+        :returns: whether the filtered result is same with the expected
+        """
+        expected_lines = self._read_lines(expected)
+        if isinstance(result, str):
+            result_lines = self._read_lines(result, filtered=True)
+        else:
+            result_lines = iter(result)
+        sentinel = object()
+        while True:
+            e = next(expected_lines, sentinel)
+            r = next(result_lines, sentinel)
+            if e is not r and e != r:
+                return False
+            if e is sentinel:
+                return True
+
+    def unified_diff(self, expected, result, result_lines=None):
+        """
+        :type result_lines: list of str
+        :param result_lines: the filtered result lines if already read
+
+        :rtype: str
+        :returns: the unified diff between expected and filtered result
+        """
+        if result_lines is None:
+            result_lines = list(self._read_lines(result, filtered=True))
+        return "".join(difflib.unified_diff(
+            list(self._read_lines(expected)), result_lines,
+            fromfile=expected, tofile=result
+            ))
+
+    def _closest(self, expecteds, result_lines):
+        """find the alternative which has the least different lines
+
+        :rtype: str
+        :returns: the closest expected file
+        """
+        best, best_changes = expecteds[0], None
+        for expected in expecteds:
+            matcher = difflib.SequenceMatcher(
+                None, list(self._read_lines(expected)), result_lines,
+                autojunk=False
+                )
+            same_lines = sum(b.size for b in matcher.get_matching_blocks())
+            changes = (len(matcher.a) + len(matcher.b) - 2*same_lines)
+            if best_changes is None or changes < best_changes:
+                best, best_changes = expected, changes
+        return best
+
+    def diff(self, expecteds, result, diff_file=None):
+        """compare the result with the alternative expected files in
+        sequence, the first matched alternative stops the compare. write
+        the unified diff against the closest alternative to diff_file if
+        none matches, or remove the out of date diff_file if matched.
+
+        :type expecteds: str or list of str
+        :param expecteds: the expected file, or the alternatives
+
+        :type diff_file: str
+        :param diff_file: the path to save the unified diff
+
+        :rtype: tuple
+        :returns: whether the files are same, the matched (or the closest)
+                  expected file, and the diff content
+        """
+        if isinstance(expecteds, str):
+            expecteds = [expecteds]
+
+        # a single alternative is streamed, and the result is read only
+        # once for many alternatives
+        result_lines = None
+        if len(expecteds) > 1:
+            result_lines = list(self._read_lines(result, filtered=True))
+
+        for expected in expecteds:
+            if self.is_same(expected,
+                            result if result_lines is None else result_lines):
+                if diff_file and os.path.exists(diff_file):
+                    os.remove(diff_file)
+                return True, expected, ''
+
+        expected = expecteds[0]
+        if result_lines is not None:
+            expected = self._closest(expecteds, result_lines)
+        content = self.unified_diff(expected, result, result_lines)
+        if diff_file:
+            with open(diff_file, 'w') as fd:
+                fd.write(content)
+        return False, expected, content
+
+    def map(self, func, items):
+        """run func for each item in the thread pool, the results keep
+        the sequence of the items
+        """
+        items = list(items)
+        if len(items) <= 1 or self._workers <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            return list(pool.map(func, items))
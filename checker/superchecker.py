@@ -1,12 +1,30 @@
 import os
 import sys
 import time
+import shutil
 import logging
-import subprocess
+import threading
+import config
 from report import ProfileReport
 from utils.file import create_directory
+from utils import trace
+from utils.result_cache import ResultCache
+from checker.differ import LineFilter, LineMask, UnorderedBlock, ResultDiffer
 logger = logging.getLogger('SuperChk')
 
+# the line ranges dropped from the result before comparing, each one is a
+# (start, end) regular expression pair, works like sed '/start/,/end/d'
+_RESULT_FILTERS = getattr(config, 'result_filters',
+                          [('Login User:', 'Valied Until')])
+# the (pattern, replacement) pairs to mask the unstable words of both the
+# result and the expected, like pids, timestamps and oids
+_RESULT_MASKS = getattr(config, 'result_masks', [])
+# the (start, end) regular expression pairs, the lines between them are
+# compared without order
+_RESULT_UNORDERED = getattr(config, 'result_unordered', [])
+# the number of threads to diff a batch of cases, None means cpu count
+_DIFF_WORKERS = getattr(config, 'diff_workers', None)
+
 class SuperChk(object):
     """
     This class is used to check the difference between profile's result and expected result, 
@@ -21,6 +39,19 @@ class SuperChk(object):
         self._report_html = os.path.join(self._outputs_dir, "report.html")
         self._report_txt = os.path.join(self._outputs_dir, "report.txt")
         self._report = ProfileReport(profile.name)
+        self._differ = ResultDiffer(
+            [LineFilter(start, end) for start, end in _RESULT_FILTERS],
+            [LineMask(pattern, repl) for pattern, repl in _RESULT_MASKS] +
+            [UnorderedBlock(start, end) for start, end in _RESULT_UNORDERED],
+            _DIFF_WORKERS
+            )
+        self._result_cache = ResultCache()
+        # the cache context of the cases, {case name: context}
+        self._cache_context = {}
+        # the cases checked in threads do not interleave their prints
+        self._print_lock = threading.Lock()
+        # the runners run part of the permutations only
+        self._partial_run = False
         self._check_directories()
 
     def _check_directories(self):
@@ -41,7 +72,8 @@ class SuperChk(object):
 
 
     def _make_many_diff(self,manycases):
-        """have a verify of specified test cases
+        """have a verify of specified test cases, the cases are compared
+        in a thread pool, and reported in sequence
 
         :type manycases: list of :class:`testcase.TestCaseDesc`
         :param manycase: specified test cases to make diff
@@ -49,17 +81,23 @@ class SuperChk(object):
         :rtype: list of Boolean
         :returns: the diff results of specified test cases
         """
+        compared = self._differ.map(self._compare_case, manycases)
         results = []
-        for case in manycases:
-            results.append(self._make_diff(case))
+        for case, (same, expected, diff) in zip(manycases, compared):
+            results.append(self._report_diff(case, same, expected, diff))
 
         return results
 
     def _make_diff(self, case):
         """have a verify of specified test cases
 
-        the verification will only use the simple diff command.
-        verification support multiple version of result compare
+        the verification use the in process differ, the unstable lines of
+        the result are filtered when reading, and the unified diff is saved
+        next to the result file as <case>.diff
+
+        verification support multiple version of result compare, the
+        alternative expected files are named as <case>_1.out, <case>_2.out
+        and so on, the result matching any of them is treated as success
 
         :type case: :class:`testcase.TestCaseDesc`
         :param case: specified test case to make diff
@@ -67,42 +105,144 @@ class SuperChk(object):
         :rtype: Boolean
         :returns: the diff result of specified test case
         """
-        expected = os.path.join(self._expected_dir, case.name()+".out")
+        same, expected, diff = self._compare_case(case)
+        return self._report_diff(case, same, expected, diff)
+
+    def _case_files(self, case):
         result = os.path.join(self._results_dir, case.name()+".out")
-        print("** case %s, make diff" % case.name())
-        print("result:", result)
-        print("expect:", expected)
+        diff_file = os.path.join(self._results_dir, case.name()+".diff")
+        return self._expected_files(case), result, diff_file
+
+    def _expected_files(self, case):
+        """find the expected file and its alternatives of the case
+
+        :rtype: list of str
+        :returns: the existing expected files, <case>.out is the first one
+        """
+        expecteds = []
+        main = os.path.join(self._expected_dir, case.name()+".out")
+        if os.path.exists(main):
+            expecteds.append(main)
+        i = 1
+        while True:
+            alternative = os.path.join(self._expected_dir,
+                                       "%s_%d.out" % (case.name(), i))
+            if not os.path.exists(alternative):
+                break
+            expecteds.append(alternative)
+            i += 1
+        return expecteds
+
+    def _set_partial_run(self, partial):
+        """
+        :type partial: Boolean
+        :param partial: the runners run a range of the permutations only,
+                        the result cannot be compared with the expected
+                        file of all the permutations, so it is skipped
+        """
+        self._partial_run = partial
+
+    def _compare_case(self, case):
+        """compare the result with the expected files of the case
+
+        :rtype: tuple
+        :returns: whether same (None if no file to compare), the matched
+                  or the closest expected file, and the diff
+        """
+        expecteds, result, diff_file = self._case_files(case)
+        if not os.path.exists(result) or not expecteds or self._partial_run:
+            return None, None, ''
+        with trace.span('diff', 'checker', case=case.name()):
+            return self._differ.diff(expecteds, result, diff_file)
+
+    def _report_diff(self, case, same, expected, diff):
+        """print the diff information and add it to the report
+
+        :rtype: Boolean
+        :returns: the diff result of specified test case
+        """
+        with self._print_lock:
+            expecteds, result, diff_file = self._case_files(case)
+            print("** case %s, make diff" % case.name())
+            print("result:", result)
+            print("expect:", expected or
+                  os.path.join(self._expected_dir, case.name()+".out"))
         
-        if not os.path.exists(result):
-            logger.error('There is NO result file for ',case.name())
+            if not os.path.exists(result):
+                logger.error('There is NO result file for %s' % case.name())
  
-        try:
-            #sed_command = "sed -i \'/NOTICE:/,/Valied Until/d\'  %s"%result
-            sed_command = "sed -i '/Login User:/,/Valied Until/d'  %s"%result
-            res = subprocess.check_call(sed_command,shell=True,
-                                  stdout=sys.stdout,
-                                  stderr=sys.stderr)
-        except subprocess.CalledProcessError as exc:
-            logger.error('Handle the resutl file failed with ',exc.output)
-            #print('Handle the resutl file failed with ',exc.output)
-
-        if not os.path.exists(expected):
-            logger.error('there is NO expected file for ',case.name())
-            #print('there is NO expected file for ',case.name())
-
-        else:
-            complete = subprocess.run(['diff', expected, result],
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE)
-
-            if complete.returncode == 0:
+            if not expecteds:
+                logger.error('there is NO expected file for %s' % case.name())
+                #print('there is NO expected file for ',case.name())
+
+            elif self._partial_run:
+                self._report.add_case_info(case,'skip',
+                                           '只运行了部分排列，未对比结果')
+                return True
+
+            elif same:
                 self._report.add_case_info(case,'True','目标结果对比成功')
+                self._result_cache.store(
+                    case, expecteds, result,
+                    self._cache_context.get(case.name(), ''))
                 return True
-                
+
             else:
-                self._report.add_case_info(case,'False','目标结果对比错误')
+                self._report.add_case_info(case,'False','目标结果对比错误',
+                                           diff)
                 return False
 
+    def _cache_enabled(self):
+        return self._result_cache.enabled() and not self._partial_run
+
+    def _set_cache_context(self, case, context):
+        """
+        :type context: str
+        :param context: the hash of the cache keys of the cases run before
+                        the case on the same database
+        """
+        self._cache_context[case.name()] = context
+
+    def _cache_key(self, case):
+        """
+        :rtype: str
+        :returns: the cache key of the case in its context
+        """
+        return self._result_cache.case_key(
+            case, self._expected_files(case),
+            self._cache_context.get(case.name(), ''))
+
+    def _cached_pass(self, case):
+        """
+        :rtype: str
+        :returns: the saved result of the case passed with the same inputs
+                  and context before, None if not found
+        """
+        if not self._cache_enabled():
+            return None
+        return self._result_cache.lookup(
+            case, self._expected_files(case),
+            self._cache_context.get(case.name(), ''))
+
+    def _use_cached_pass(self, case):
+        """if the case passed with the same inputs before, put the saved
+        result to the results directory, and report it as passed
+
+        :rtype: Boolean
+        :returns: whether the case is a cached pass, which need not run
+        """
+        expecteds, result, diff_file = self._case_files(case)
+        cached = self._cached_pass(case)
+        if cached is None:
+            return False
+
+        shutil.copyfile(cached, result)
+        if os.path.exists(diff_file):
+            os.remove(diff_file)
+        print("** case %s, inputs unchanged, cached pass" % case.name())
+        self._report.add_case_info(case,'True','输入未变化，沿用上次通过的结果')
+        return True
+
     def _reportdata_gen(self,start_time,end_time):
         self._report.set_start_time(
             start_time.strftime("%Y-%m-%d %H:%M:%S")
@@ -111,5 +251,6 @@ class SuperChk(object):
             end_time.strftime("%Y-%m-%d %H:%M:%S")
             )
         self._report._gen_statistic()
-        self._report.generate_report_html(self._report_html)
-        self._report.generate_report_text(self._report_txt)
+        with trace.span('report', 'checker'):
+            self._report.generate_report_html(self._report_html)
+            self._report.generate_report_text(self._report_txt)
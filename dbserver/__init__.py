@@ -8,6 +8,10 @@ import logging
 import time
 import subprocess
 import threading
+import shutil
+import json
+import hashlib
+import psycopg2
 import config
 import pexpect
 sys.path.append('.')
@@ -16,6 +20,9 @@ logger = logging.getLogger('DBServer')
 _PORT = config.port
 _DBNAME = config.dbname
 _INSTALLDIR = config.installation
+# the directory holding the initialized "golden" cluster, empty means
+# always run initdb
+_INITDB_CACHE_DIR = getattr(config, 'initdb_cache_dir', '')
 
 def get_installation_bin_path():
     import config
@@ -25,6 +32,143 @@ def get_installation_lib_path():
     import config
     return os.path.join(config.installation, 'lib')
 
+def read_postmaster_status(data_path):
+    """read the status line of the postmaster.pid file, the server writes
+    `starting`, `ready`, `stopping` or `standby` there (PostgreSQL 10+)
+
+    :type data_path: str
+    :param data_path: the database instance data directory path
+
+    :rtype: str
+    :returns: the status, None if no pid file or no status line
+    """
+    if data_path is None:
+        return None
+    postmaster_file = os.path.join(data_path, 'postmaster.pid')
+    try:
+        with open(postmaster_file, 'r') as fd:
+            lines = fd.read().splitlines()
+    except OSError:
+        return None
+    if len(lines) < 8:
+        return None
+    return lines[7].strip()
+
+def probe_server(port, data_path=None):
+    """try to connect the database server once, the connection is closed
+    immediately
+
+    :type port: int
+    :param port: the port of the database server
+
+    :type data_path: str
+    :param data_path: the data directory, if the postmaster.pid says the
+                      server is not ready, no connection is tried
+
+    :rtype: Boolen
+    :returns: whether the server accept the connection
+    """
+    status = read_postmaster_status(data_path)
+    if status is not None and status != 'ready':
+        logger.debug("postmaster status is %s" % status)
+        return False
+    try:
+        conn = psycopg2.connect(database=_DBNAME, user=config.user,
+                                password=config.password, host=config.host,
+                                port=port, connect_timeout=5)
+    except psycopg2.Error as e:
+        logger.debug("connect fail for reason %s" % str(e).strip())
+        return False
+    conn.close()
+    return True
+
+def wait_for_server_ready(port, data_path=None, timeout=60, alive=None):
+    """probe the database server with backoff, until it accept connection
+
+    the first probe is sent at once, and the interval is doubled from 10ms
+    to 500ms, so the function returns very soon after the server is ready
+
+    :type timeout: float
+    :param timeout: the max seconds to wait
+
+    :type alive: function
+    :param alive: the function to check whether the server process is
+                  still alive, the waiting stops if it returns False
+
+    :rtype: tuple
+    :returns: whether it is ready, the seconds and the probes it takes
+    """
+    start_time = time.time()
+    interval = 0.01
+    probes = 0
+    while True:
+        probes += 1
+        if probe_server(port, data_path):
+            return True, time.time() - start_time, probes
+        if alive is not None and not alive():
+            return False, time.time() - start_time, probes
+        if time.time() - start_time > timeout:
+            return False, time.time() - start_time, probes
+        time.sleep(interval)
+        interval = min(interval * 2, 0.5)
+
+def get_installation_fingerprint():
+    """the fingerprint of the installation, it changes when the binaries
+    were rebuilt or reinstalled
+
+    :rtype: str
+    :returns: the hash of the installation path, the `postgres --version`
+              output and the name, size, mtime of the binaries
+    """
+    bin_path = get_installation_bin_path()
+    postgres = os.path.join(bin_path, 'postgres')
+    lib_path = get_installation_lib_path()
+    env = {'LD_LIBRARY_PATH': lib_path,'HG_BASE':_INSTALLDIR}
+    version = ''
+    try:
+        version = subprocess.run([postgres, '--version'], env=env,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 universal_newlines=True).stdout
+    except OSError as e:
+        logger.debug("fail to get the version of %s: %s" % (postgres, e))
+
+    h = hashlib.sha1()
+    h.update(os.path.realpath(config.installation).encode())
+    h.update(version.encode())
+    if os.path.isdir(bin_path):
+        for name in sorted(os.listdir(bin_path)):
+            st = os.stat(os.path.join(bin_path, name))
+            h.update(("%s:%d:%d;" % (name, st.st_size, st.st_mtime_ns))
+                     .encode())
+    return h.hexdigest()
+
+def copy_cluster(src, dst):
+    """copy a database data directory, use the copy-on-write clone when
+    the file system support it (cp --reflink=auto), or a normal copy
+
+    ..note:
+      hard link cannot be used here, the database server writes the data
+      files in place, that will change the source cluster too
+
+    :type src: str
+    :param src: the source data directory
+
+    :type dst: str
+    :param dst: the target data directory, it should not exist
+    """
+    if os.path.isdir(dst) and not os.listdir(dst):
+        os.rmdir(dst)
+    child = subprocess.run(['cp', '-a', '--reflink=auto', src, dst],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if child.returncode == 0:
+        return
+    logger.debug("cp --reflink fail for reason %s, use the normal copy"
+                 % child.stderr)
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    shutil.copytree(src, dst, symlinks=True)
+
 def set_parameter_in_conf_file(conf, name, value):
     """the function will change a value of a parameter
 
@@ -104,9 +248,10 @@ class DBServer(object):
     :type pid: int
     :param pid: the database init process id
     """
-    def __init__(self, popen, port):
+    def __init__(self, popen, port, data_path=None):
         self._popen = popen
         self._port = port
+        self._data_path = data_path
         if not self.is_running():
             logger.debug(
                 'PostgreSQL Init process fail for %s' % self.exit_code()
@@ -134,6 +279,114 @@ class DBServer(object):
         for name, value in params.items():
             set_parameter_in_conf_file(conf_file, name, value)
 
+    @staticmethod
+    def prepareDB(data_path, **params):
+        """initialize the data store for a database and set the parameters,
+        when the initdb cache is configured, the data store is copied from
+        a cached cluster instead of running initdb every time.
+
+        the cached cluster is keyed by the installation fingerprint, the
+        user, password and the parameters (the port is excluded, it is set
+        for every copy), any change will make a new cached cluster. the
+        cached clusters of the same installation directory, user and
+        parameters, but older binaries, are removed as out of date.
+
+        :type data_path: str
+        :param data_path: the directory of the database data store
+
+        :type params: dict
+        :param params: the parameters and values to change or add
+        """
+        if not _INITDB_CACHE_DIR:
+            DBServer.initDB(data_path)
+            DBServer.set_dbconf(data_path, **params)
+            return
+
+        port = params.pop('port', _PORT)
+        key = {
+            'installation': get_installation_fingerprint(),
+            'user': config.user,
+            'password': hashlib.sha1(config.password.encode()).hexdigest(),
+            'params': params,
+            }
+        digest = hashlib.sha1(
+            json.dumps(key, sort_keys=True).encode()
+            ).hexdigest()
+        golden = os.path.join(_INITDB_CACHE_DIR, digest)
+
+        if not os.path.exists(os.path.join(golden, 'PG_VERSION')):
+            DBServer._build_golden_cluster(golden, key)
+
+        if not os.path.exists(os.path.join(golden, 'PG_VERSION')):
+            logger.info("initdb cache is not available, run initdb")
+            DBServer.initDB(data_path)
+            DBServer.set_dbconf(data_path, port=port, **params)
+            return
+
+        logger.info("copy the cached cluster %s to %s" % (golden, data_path))
+        copy_cluster(golden, data_path)
+        DBServer.set_dbconf(data_path, port=port)
+
+    @staticmethod
+    def _build_golden_cluster(golden, key):
+        """run initdb into a temporary directory, and rename it to the
+        cached cluster, the key is saved next to it as <digest>.json
+
+        ..note:
+          the cache directory may be shared by the other installations,
+          profiles and running instances, only the broken cluster of the
+          same digest and the clusters of the older binaries of the same
+          installation are removed, the building directories of the
+          others (<digest>.<pid>) are never touched
+        """
+        cache_dir = os.path.dirname(golden)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        if os.path.exists(golden):
+            logger.info("remove broken cached cluster %s" % golden)
+            shutil.rmtree(golden, ignore_errors=True)
+        DBServer._remove_old_golden_clusters(cache_dir, key)
+
+        building = "%s.%d" % (golden, os.getpid())
+        logger.info("build the cached cluster %s" % golden)
+        DBServer.initDB(building)
+        if not os.path.exists(os.path.join(building, 'PG_VERSION')):
+            shutil.rmtree(building, ignore_errors=True)
+            return
+        DBServer.set_dbconf(building, **key['params'])
+        with open(building + '.json', 'w') as fd:
+            json.dump(dict(key, directory=_INSTALLDIR), fd, sort_keys=True)
+        try:
+            os.replace(building + '.json', golden + '.json')
+            os.rename(building, golden)
+        except OSError:
+            # someone else has built it
+            shutil.rmtree(building, ignore_errors=True)
+
+    @staticmethod
+    def _remove_old_golden_clusters(cache_dir, key):
+        """remove the cached clusters built by the older binaries of the
+        same installation directory, with the same user and parameters
+        """
+        for name in os.listdir(cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(cache_dir, name)
+            try:
+                with open(path, 'r') as fd:
+                    other = json.load(fd)
+            except (OSError, ValueError):
+                continue
+            if (other.get('directory') != _INSTALLDIR
+                or other.get('installation') == key['installation']
+                or any(other.get(item) != key[item]
+                       for item in ('user', 'password', 'params'))):
+                continue
+            digest = name[:-len('.json')]
+            logger.info("remove out of date cached cluster %s" % digest)
+            shutil.rmtree(os.path.join(cache_dir, digest), ignore_errors=True)
+            os.remove(path)
+
     @staticmethod
     def initDB(data_path):
         """initialize the data store for a database
@@ -228,7 +481,7 @@ class DBServer(object):
         return 'running'
     
     @staticmethod
-    def start(data_path, log_path=None):
+    def start(data_path, log_path=None, port=_PORT):
         """start the postgresql server
 
         :type data_path: str
@@ -237,6 +490,9 @@ class DBServer(object):
         :type log_path: str
         :param log_path: the log file absolute path
 
+        :type port: int
+        :param port: the port configured for the server
+
         :rtype: :class:`DBServer`
         :returns: a server instance who will accept the test
         """
@@ -267,11 +523,7 @@ class DBServer(object):
                                  args=(child, "%s/postmaster.log"%log_path))
             t.start()
 
-        # sleep for a very short time to wait the process start at
-        # os level
-        time.sleep(0.2)
-
-        return DBServer(child, _PORT)
+        return DBServer(child, port, data_path)
 
     @staticmethod
     def stopDB(data_path,log_path=None):
@@ -331,42 +583,42 @@ class DBServer(object):
         """whether PostgreSQL is accepting message
 
         although the process of the database server may be up, but it
-        maybe cannot accept message, this function use psql to send
-        message to check whether the server is really can handle message
+        maybe cannot accept message, this function try to connect the
+        server to check whether the server is really can handle message
 
         :rtype: Boolen
         :returns: whether the database server is running and can accept
-                  message (means psql can connect to)
+                  message
         """
         if not self.is_running():
             logger.debug(
                 'PostgreSQL Init process fail for %s' % self.exit_code()
                 )
-            logger.debug(self._popen.stderr.read())
             raise Exception("DBServer is not ready")
-        
-        bin_path = get_installation_bin_path()
-        psql = os.path.join(bin_path, 'psql')
-        lib_path = get_installation_lib_path()
-        logger.debug('DBServer::is_ready() bin: %s, lib: %s'
-                     % (psql, lib_path))
-        #env = {'LD_LIBRARY_PATH': lib_path,'PGPASSWORD':config.password}
-        env = {'LD_LIBRARY_PATH': lib_path,'PGPASSWORD': config.password,'HG_BASE':_INSTALLDIR}
-        cmd = " ".join([
-            psql, '-U', str(config.user), '-p', str(self._port), str(_DBNAME), '<', '/dev/null'
-            ])
-        child = subprocess.run(
-            cmd, shell=True, env=env, 
-            stdout=sys.stdout,
-            stderr=sys.stderr
-            )
-        
-        if child.returncode != 0:
-            logger.debug("psql connect fail for reason %s"
-                         % child.stderr)
-            return False
 
-        return True
+        return probe_server(self._port, self._data_path)
+
+    def wait_ready(self, timeout=60):
+        """wait until the server accept connection
+
+        :type timeout: float
+        :param timeout: the max seconds to wait
+
+        :rtype: float
+        :returns: the seconds it takes for the server to be ready
+        """
+        ready, seconds, probes = wait_for_server_ready(
+            self._port, self._data_path, timeout, self.is_running
+            )
+        if not ready:
+            logger.debug(
+                'PostgreSQL process exit code %s' % self.exit_code()
+                )
+            raise Exception("DBServer is not ready after %.3f seconds"
+                            % seconds)
+        logger.info("server on port %d is ready after %.3f seconds, "
+                    "%d probes" % (self._port, seconds, probes))
+        return seconds
     
     def is_running(self):
         """PostgreSQL process is running
@@ -24,6 +24,9 @@ test_data_dir = config.testcases
 
 def show_help_info():
     """show the help info of the main.py 
+
+    :rtype: :class:`argparse.Namespace`
+    :returns: the parsed arguments
     """
     import argparse
     
@@ -31,8 +34,12 @@ def show_help_info():
     parser.add_argument('test mode', choices=['installcheck','check'],
                                      help='''installcheck: this will use an already installed DB                        
                                              check       : this will start a new temparory DB instance''')
+    parser.add_argument('--force', action='store_true',
+                        help='''run all the cases, even if they passed with the same
+                                inputs before (see result_cache_dir in config)''')
     
     args = parser.parse_args()
+    return args
 
 def all_profiles():
     """list all the valid test profiles
@@ -75,7 +82,8 @@ def parse_strategy():
 
 # main
 if __name__ == "__main__":
-    show_help_info()
+    args = show_help_info()
+    test_mode = getattr(args, 'test mode')
     parse_strategy()
     for profile in all_profiles():
         profile = Profile(profile, use_schedule=True)
@@ -86,9 +94,10 @@ if __name__ == "__main__":
         chk_mod = importlib.import_module('checker.'+strategy_map[profile._ptype][2])
         chk = chk_mod.Checker(profile)
         app = app_mod.Application(profile,chk)
+        app.set_force(args.force)
 
         try:
-            app.run(sys.argv[1])
+            app.run(test_mode)
         except Exception as e:
             logger.error(str(e))
             logger.debug(traceback.format_exc())
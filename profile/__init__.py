@@ -1,6 +1,7 @@
 import os
 import logging
 from utils.schedule import ScheduleCase
+from testcase import TestCaseDesc
 
 logger = logging.getLogger('profile')
 
@@ -96,7 +97,7 @@ class Profile(object):
             return
 
         # old loop all method
-        for filename in os.listdir(self.path):
+        for filename in sorted(os.listdir(self.path)):
             if not filename.endswith('.spec'):
                 continue
 
@@ -109,8 +110,9 @@ class Profile(object):
             #testcase = TestCase(self, filename)
             #testcase.build()
             
-            full_case_path = os.path.join(self.path, filename)
-            self._cases.append(full_case_path)
+            # the applications take the case description, like the
+            # cases in a schedule
+            self._cases.append(TestCaseDesc(filename, self.path))
 
     def is_end(self):
         if self._current_case_pos + 1 >= len(self._cases):
@@ -29,24 +29,30 @@ class ProfileReport(object):
         self._title = title
         self._columns = ['用例名称', '是否通过', '说明']
         self._case_info = []
+        # the unified diff of the failed cases, {case name: diff}
+        self._case_diff = {}
         self._start_time = ""
         self._end_time = ""
         self._total= 0
         self._succeed = 0
         self._fail = 0
+        self._skip = 0
         registe_report(self._title, self)
 
     def set_title(self, title):
         self._title = title
 
-    def add_case_info(self, case, result, note):
+    def add_case_info(self, case, result, note, diff=''):
         """normally the result should be limited to ok, and fail,
         so if the result is Boolen, it will be converted to ok and
-        fail.
+        fail. skip is for the case whose result is not compared.
+
+        :type diff: str
+        :param diff: the unified diff of the result and expected
         """
         while True:
             print ("result is:",result)
-            if result in ['ok', 'fail']:
+            if result in ['ok', 'fail', 'skip']:
                 break
             if result in ['True', 'False']:
                 result = 'ok' if result=='True' else 'fail'
@@ -54,10 +60,15 @@ class ProfileReport(object):
             break
 
         self._case_info.append((case, result, note))
+        if diff:
+            self._case_diff[str(case)] = diff
 
     def get_case_info(self):
         return self._case_Info
 
+    def get_case_diff(self, case):
+        return self._case_diff.get(str(case), '')
+
     def set_start_time(self, start):
         """
         :type start: str
@@ -76,9 +87,12 @@ class ProfileReport(object):
         self._total = len(self._case_info)
         self._succeed = 0
         self._fail = 0
+        self._skip = 0
         for case in self._case_info:
             if case[1] == 'ok':
                 self._succeed += 1
+            elif case[1] == 'skip':
+                self._skip += 1
             else:
                 self._fail += 1
 
@@ -1 +1 @@
-from .testrunner import TestRunner
+from .testrunner_spec import TestRunner
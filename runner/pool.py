@@ -0,0 +1,148 @@
+"""long-lived runner worker pool
+
+starting `python3 -u runner/testrunner_spec.py <case>` for every case pays
+the interpreter startup and the import of psycopg2, ply and the parser
+tables again and again. the pool here forks a fixed number of worker
+processes once, every worker imports the runner module a single time and
+then runs the TestRunner of many cases in its own process.
+
+the output of a case is the same as the subprocess way, the stdout and
+stderr file descriptors of the worker are pointed to the case result file
+during the case running, so everything the runner prints (including the
+logging messages and the traceback of a crashed runner) goes to the result
+file in the same sequence as the subprocess way.
+"""
+
+import os
+import sys
+import time
+import logging
+import importlib
+import traceback
+import multiprocessing
+
+logger = logging.getLogger('RunnerPool')
+
+_RUNNER_MODULE = None
+
+
+def _init_worker(runner_module):
+    """worker process initializer, import the runner module once, and
+    make the stdout unbuffered as the `python3 -u` does
+
+    :type runner_module: str
+    :param runner_module: the runner module name, like runner.testrunner_spec
+    """
+    global _RUNNER_MODULE
+    sys.path.append('.')
+    _RUNNER_MODULE = importlib.import_module(runner_module)
+    sys.stdout.reconfigure(write_through=True)
+    sys.stderr.reconfigure(write_through=True)
+
+
+def _run_case(case_path, result_file, run_args, env):
+    """run one test case in the worker process, the output of the runner
+    is written to the result file directly
+
+    :type case_path: str
+    :param case_path: the absolute path of the test case
+
+    :type result_file: str
+    :param result_file: the result file absolute path
+
+    :type run_args: tuple
+    :param run_args: the arguments passed to TestRunner.run()
+
+    :type env: dict
+    :param env: the environment variables set for this case only
+
+    :rtype: float
+    :returns: the seconds of the case running
+    """
+    start = time.time()
+    saved_env = dict((name, os.environ.get(name)) for name in env)
+    os.environ.update(env)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout = os.dup(1)
+    saved_stderr = os.dup(2)
+    try:
+        with open(result_file, 'w') as fd:
+            os.dup2(fd.fileno(), 1)
+            os.dup2(fd.fileno(), 2)
+            try:
+                _RUNNER_MODULE.TestRunner(case_path).run(*run_args)
+            except SystemExit:
+                # the runner use exit() for some fatal errors, the worker
+                # should survive for the next case
+                pass
+            except Exception:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+    finally:
+        os.dup2(saved_stdout, 1)
+        os.dup2(saved_stderr, 2)
+        os.close(saved_stdout)
+        os.close(saved_stderr)
+        for name, value in saved_env.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+    return time.time() - start
+
+
+class RunnerPool(object):
+    """a pool of pre-forked processes which run the TestRunner in process
+
+    :type size: int
+    :param size: the number of the worker processes
+
+    :type runner_module: str
+    :param runner_module: the module which provide the TestRunner class
+
+    :type run_args: tuple
+    :param run_args: the arguments passed to TestRunner.run()
+    """
+    def __init__(self, size, runner_module, run_args=()):
+        self._size = size
+        self._run_args = tuple(run_args)
+        ctx = multiprocessing.get_context('fork')
+        self._pool = ctx.Pool(processes=size, initializer=_init_worker,
+                              initargs=(runner_module,))
+        logger.info("start runner pool with %d workers for %s"
+                    % (size, runner_module))
+
+    def size(self):
+        return self._size
+
+    def submit(self, case_path, result_file, env=None, callback=None):
+        """run the case in a free worker asynchronously
+
+        :type env: dict
+        :param env: the environment variables set for the case running
+
+        :type callback: function
+        :param callback: called with the case seconds after the case is
+                         completed, in a thread of the pool
+
+        :rtype: :class:`multiprocessing.pool.AsyncResult`
+        :returns: the handle to wait for the case completion
+        """
+        logger.debug("submit case %s to runner pool" % case_path)
+        return self._pool.apply_async(
+            _run_case, (case_path, result_file, self._run_args, env or {}),
+            callback=callback, error_callback=callback
+            )
+
+    def run(self, case_path, result_file, env=None):
+        """run the case in a free worker and wait for its completion
+        """
+        self.submit(case_path, result_file, env).wait()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        logger.debug("runner pool is closed")
@@ -24,17 +24,27 @@ __author__      = "denny wang (denny.wangliang@gmail.com)"
 __copyright__   = "Copyright 2018, Highgo LLC"
 
 import os
+import io
 import sys
 
 sys.path.append('.')
 from utils.connection import PGConnectionManager, SQLBlockExecutorHelper
+from utils.connection import wait_any_readable, BLOCK_TIME
+from utils.timeouts import POLL_MAX_TIME
+from utils.connection import SERVER_PORT_ENV
+from utils.lockstatus import LockStatus
+from utils.connpool import get_connection_pool
+from utils import trace
+from utils.history import step_history
 from testcase import TestCase
+from testcase.permutations import PERMUTATION_RANGE_ENV, parse_range
 from utils.sql import parse_sqls
 from testcase.modules import SQLBlock
 import time
 import logging
 import datetime
 import xml.dom.minidom
+import config
 
 from exc import (
     WaitDataTimeoutException,
@@ -50,6 +60,21 @@ logger = logging.getLogger("TestRunner")
 STEP_NOBLOCK = 0x1
 STEP_RETRY = 0x2
 
+# run the setup sqls once into a template database, and run each
+# permutation in a clone of the template database
+SETUP_TEMPLATE_DB = getattr(config, 'setup_template_db', False)
+
+# run the number of randomly chosen permutations only, 0 means all, the
+# same seed always choose the same permutations
+PERMUTATION_SAMPLE = getattr(config, 'permutation_sample', 0)
+PERMUTATION_SEED = getattr(config, 'permutation_seed', 0)
+# send at most the number of setup/teardown sqls in one round trip of the
+# maint session, 0 means one by one
+SETUP_BATCH_SIZE = getattr(config, 'setup_batch_size', 0)
+# skip the implicit permutations which only swap the independent steps,
+# '' for off, 'annotated' or 'infer', see testcase/reduction.py
+PERMUTATION_REDUCTION = getattr(config, 'permutation_reduction', '')
+
 
 class TestRunner(object):
     """Test case running tool
@@ -74,11 +99,18 @@ class TestRunner(object):
     """
     def __init__(self, case_path):
         self._testcase = TestCase(case_path)
+        self._port = int(os.environ.get(SERVER_PORT_ENV, config.port))
         self._maint_session = None
         self._sessions = {}
         self._waitings = []
         self._backend_pids = []
+        self._lock_status = None
         self._errorsteps = {} # {step: errormsg}
+        # the timestamps of the steps sent and blocked, {tag: time}
+        self._step_start = {}
+        self._wait_start = {}
+        # the step duration history, recorded in the adaptive timeout mode
+        self._history = None
 
     #def run(self, dry_run=False):
     def run(self,case_type):
@@ -102,6 +134,8 @@ class TestRunner(object):
           file for detail reason
         """
         self._testcase.build()
+        self._select_permutations()
+        self._apply_timeouts()
 
        # if dry_run:
         #    self._start_dry_run()
@@ -110,8 +144,18 @@ class TestRunner(object):
        # if case_type == 'python':
        #     self._start_exec_keywords()       
 
-        self._make_maint_session()
-        self._make_test_sessions()
+        case = self._testcase.name
+        with trace.span('connect', 'runner', case=case, session='Maint'):
+            self._make_maint_session()
+
+        if SETUP_TEMPLATE_DB and self._testcase.setups():
+            self._start_permutations_on_template()
+            self._clear_maint_session()
+            self._save_history()
+            return
+
+        with trace.span('connect', 'runner', case=case, session='all'):
+            self._make_test_sessions()
 
         self._collect_backend_pids()
         
@@ -119,6 +163,7 @@ class TestRunner(object):
 
         self._clear_test_sessions()
         self._clear_maint_session()
+        self._save_history()
 
    # def _start_exec_keywords(self):
    #    command_list = self._parse_keywords_list()
@@ -165,21 +210,25 @@ class TestRunner(object):
         logger.debug("LOADING SETUP SQLS")
         for setup in self._testcase.setups():
             helper = setup.sqlhelper()
-            helper.execute(self._maint_session)
-            output = helper.output()
-            if output:
-                print(output)
+            helper.execute(self._maint_session, SETUP_BATCH_SIZE)
+            if helper.write(sys.stdout):
+                print()
 
-    def _load_teardown_sqls(self):
+    def _load_teardown_sqls(self, session=None):
         """get the sqls from testcase teardown module, and execute them
+
+        :type session: :class:`utils.connection.PGConnection`
+        :param session: the connection to run the sqls, default is the
+                        maint session
         """
         logger.debug("LOADING TEARDOWN SQLS")
+        if session is None:
+            session = self._maint_session
         for teardown in self._testcase.teardowns():
             helper = teardown.sqlhelper()
-            helper.execute(self._maint_session)
-            output = helper.output()
-            if output:
-                print(output)
+            helper.execute(session, SETUP_BATCH_SIZE)
+            if helper.write(sys.stdout):
+                print()
 
     def _load_session_setup_sqls(self):
         """get the sqls from each session level setup module, and execute
@@ -196,9 +245,8 @@ class TestRunner(object):
             
             helper = setup.sqlhelper()
             helper.execute(dbsession)
-            output = helper.output()
-            if output:
-                print(output)
+            if helper.write(sys.stdout):
+                print()
 
     def _load_session_teardown_sqls(self):
         """get the sqls from each session level teardown model, and execute
@@ -215,9 +263,8 @@ class TestRunner(object):
                                 % session_tag)
             helper = teardown.sqlhelper()
             helper.execute(dbsession)
-            output = helper.output()
-            if output:
-                print(output)
+            if helper.write(sys.stdout):
+                print()
 
     def _start_dry_run(self):
         """only print the sqls for setup, teardown, permutation in sequence
@@ -254,6 +301,39 @@ class TestRunner(object):
             print()
             round_num += 1
 
+    def _select_permutations(self):
+        """run part of the permutations only, if a range is given by the
+        environment (the permutations of a big case can be sharded to many
+        runners), or the sampling is configured
+        """
+        if PERMUTATION_REDUCTION:
+            self._testcase.reduce_permutations(PERMUTATION_REDUCTION)
+            logger.info("%d permutations are pruned by the reduction"
+                        % self._testcase.pruned_permutation_num())
+
+        total = self._testcase.permutation_num()
+        start, stop = 0, None
+        value = os.environ.get(PERMUTATION_RANGE_ENV)
+        if value:
+            start, stop = parse_range(value, total)
+        self._testcase.select_permutations(start, stop, PERMUTATION_SAMPLE,
+                                           PERMUTATION_SEED)
+        logger.debug("%d permutations, range %s, sample %d"
+                     % (total, value or 'all', PERMUTATION_SAMPLE))
+
+    def _apply_timeouts(self):
+        """set the timeouts of the steps, in the adaptive mode, the step
+        durations of this run are recorded for the later runs
+        """
+        history = step_history(self._testcase.path)
+        policy = self._testcase.apply_timeouts(history)
+        if policy.adaptive():
+            self._history = history
+
+    def _save_history(self):
+        if self._history is not None:
+            self._history.save()
+
     def _start_permutations(self):
         """run the steps for each permutation, look up session by the
         step tag, and run step sqls in its session.
@@ -270,8 +350,12 @@ class TestRunner(object):
             print("starting permutation: %s"
                   % " ".join([step.tag() for step in steps]))
             self._clear_tmp_data()
-            self._load_setup_sqls()
-            self._load_session_setup_sqls()
+            case = self._testcase.name
+            permutation = " ".join([step.tag() for step in steps])
+            start = trace.now()
+            with trace.span('setup', 'runner', case=case):
+                self._load_setup_sqls()
+                self._load_session_setup_sqls()
 
             logger.debug('LOADING PERMUTATION STEPS SQLS')
             for step in steps:
@@ -279,11 +363,131 @@ class TestRunner(object):
 
             self._final_complete_waiting_steps()
 
-            self._load_session_teardown_sqls()
-            self._load_teardown_sqls()
+            with trace.span('teardown', 'runner', case=case):
+                self._load_session_teardown_sqls()
+                self._load_teardown_sqls()
+            trace.complete('permutation', 'runner', start, case=case,
+                           permutation=permutation)
 
             round_num += 1
 
+    def _start_permutations_on_template(self):
+        """run the steps for each permutation in a clone of a template
+        database, the setup sqls are run only once into the template
+        database, and for each permutation a fresh database is created by
+        `CREATE DATABASE ... TEMPLATE`, and dropped after the permutation,
+        instead of running the setup sqls again and again. the teardown
+        sqls are still run in the clone for each permutation, to clean up
+        the objects outside of the database (like roles).
+        """
+        template = "pgregress_tmpl_%d" % os.getpid()
+        setup_output = self._build_template_db(template)
+
+        round_num = 1
+        print("Parsed test spec with %d sessions"
+              % len(self._testcase.session_tags()))
+        try:
+            for steps in self._testcase.next_permutation_steps():
+                print()
+                print("starting permutation: %s"
+                      % " ".join([step.tag() for step in steps]))
+                self._clear_tmp_data()
+                case = self._testcase.name
+                start = trace.now()
+                clone = "%s_%d" % (template, round_num)
+                dropped = False
+                try:
+                    with trace.span('clone', 'runner', case=case):
+                        self._maint_session.execute(
+                            'CREATE DATABASE "%s" TEMPLATE "%s"'
+                            % (clone, template)
+                            )
+                    with trace.span('connect', 'runner', case=case,
+                                    session='all'):
+                        self._make_test_sessions(clone)
+                    self._collect_backend_pids()
+                    sys.stdout.write(setup_output)
+                    with trace.span('setup', 'runner', case=case):
+                        self._load_session_setup_sqls()
+
+                    logger.debug('LOADING PERMUTATION STEPS SQLS')
+                    for step in steps:
+                        self._run_step_sqls(step)
+
+                    self._final_complete_waiting_steps()
+
+                    with trace.span('teardown', 'runner', case=case):
+                        self._load_session_teardown_sqls()
+                        session = self._new_template_session(clone)
+                        try:
+                            self._load_teardown_sqls(session)
+                        finally:
+                            session.close()
+                        self._drop_clone_db(clone)
+                        dropped = True
+                finally:
+                    # a failed permutation should not leak the sessions and
+                    # the clone database
+                    if not dropped:
+                        self._drop_clone_db(clone)
+                trace.complete('permutation', 'runner', start, case=case,
+                               permutation=" ".join(
+                                   [step.tag() for step in steps]))
+
+                round_num += 1
+        finally:
+            self._drop_template_db(template)
+
+    def _build_template_db(self, template):
+        """create the template database, and run the setup sqls in it
+
+        :type template: str
+        :param template: the template database name
+
+        :rtype: str
+        :returns: the output of the setup sqls, which will be printed for
+                  each permutation
+        """
+        logger.debug("LOADING SETUP SQLS INTO TEMPLATE %s" % template)
+        self._maint_session.execute('DROP DATABASE IF EXISTS "%s"' % template)
+        self._maint_session.execute('CREATE DATABASE "%s"' % template)
+        session = self._new_template_session(template)
+        # rendered same as _load_setup_sqls does
+        output = io.StringIO()
+        for setup in self._testcase.setups():
+            helper = setup.sqlhelper()
+            helper.execute(session, SETUP_BATCH_SIZE)
+            if helper.write(output):
+                output.write("\n")
+        # no other connection is allowed when the template is cloned
+        session.close()
+        return output.getvalue()
+
+    def _drop_clone_db(self, clone):
+        """close the test sessions, and drop the clone database of a
+        permutation
+        """
+        try:
+            self._clear_test_sessions()
+        finally:
+            self._sessions = {}
+            self._maint_session.execute('DROP DATABASE IF EXISTS "%s"'
+                                        % clone)
+
+    def _drop_template_db(self, template):
+        """drop the template database
+        """
+        self._maint_session.execute('DROP DATABASE "%s"' % template)
+
+    def _new_template_session(self, template):
+        session = PGConnectionManager.new_connection(
+            template, config.user, config.password,
+            config.host, self._port)
+        session.set_name('Template')
+        session.autocommit(True)
+        session.execute("SET client_min_messages = warning;")
+        return session
+
     def _run_step_sqls(self, step):
         """ execute one step sqls, firstly need to know which session the
         sqls need to executed in.
@@ -336,7 +540,11 @@ class TestRunner(object):
         #    wait = self._try_complete_step(step, STEP_NOBLOCK)
         #    if wait:
         #        break
-        helper.sendSQL(dbsession, self._check_lock)
+        self._lock_status.new_tick()
+        self._step_start[step.tag()] = time.time()
+        with trace.span('send', 'step', case=self._testcase.name,
+                        step=step.tag()):
+            helper.sendSQL(dbsession, self._check_lock)
         
         try:
             wait = self._new_try_complete_step(step, STEP_NOBLOCK)
@@ -397,9 +605,20 @@ class TestRunner(object):
         # remove it at last
         to_del = []
 
+        # wait for all the waiting sessions at the same time instead of
+        # waiting a block time for each of them one by one, after that
+        # every waiting step only need to have a look at its result
+        first_wait = None
+        if self._waitings:
+            sessions = [self._get_session_by_tag(step.session())
+                        for step in self._waitings]
+            wait_any_readable(sessions, BLOCK_TIME)
+            first_wait = 0
+            self._lock_status.new_tick()
+
         for step in self._waitings:
             wait = False
-            wait = self._new_try_complete_step(step, flags)
+            wait = self._new_try_complete_step(step, flags, first_wait)
 
             if wait:
                 # still waiting, just keep it in the wait list
@@ -437,8 +656,9 @@ class TestRunner(object):
         or some other reason to hold, if it is surely due to lock, just
         return True to indicate the step is locked and wait to unlock by
         the other session. for the case it is hang there not due to a lock,
-        and it is wait for 60 seconds, and try to cancel the last step, if
-        still no response and it take about 75 seconds, just quit.
+        and it is wait for the cancel timeout (60 seconds by default), and try
+        to cancel the last step, if still no response after the abort
+        timeout (75 seconds by default), just quit.
 
         a retry mode should be support, we normally call this function
         firstly when just send the sql, and to see whether the sql is
@@ -448,7 +668,7 @@ class TestRunner(object):
         .. note:
            here is problem is that although you provide a nonblock flag in
            the function parameter, if it is hang not for a lock, it will
-           still block there for 60 or 75 seconds, this is an original
+           still block there until the timeouts, this is an original
            design, since it is enough to handle the requirement, no change
            to be done here.
 
@@ -499,13 +719,14 @@ class TestRunner(object):
                     return True
                 
             now = time.time()
-            if now - start_time > 60 and not canceled:
+            limits = sqlhelper.timeout()
+            if now - start_time > limits.cancel and not canceled:
                 dbsession.cancel_backend()
                 canceled = True
 
-            if now - start_time > 75:
-                raise Exception("step %s timeout after 75 seconds"
-                                % step.tag())
+            if now - start_time > limits.abort:
+                raise Exception("step %s timeout after %s seconds"
+                                % (step.tag(), limits.abort))
                         
         if flags & STEP_RETRY:
             print("step %s: <... completed>" % step.tag())
@@ -516,23 +737,38 @@ class TestRunner(object):
 
             print("step %s: %s" % (step.tag(), step.sql()))
 
-        print(sqlhelper.get_result().output())
+        sqlhelper.get_result().write(sys.stdout)
+        print()
         
         return False
 
-    def _new_try_complete_step(self, step, flags):
+    def _new_try_complete_step(self, step, flags, first_wait=None):
         session_tag = step.session()
         dbsession = self._get_session_by_tag(session_tag)
         sqlhelper = step.sqlhelper()
+        poll_time = BLOCK_TIME
+        blocked_since = None
         while True:
             try:
                 sqlhelper.try_complete_current_execution(
-                    dbsession, self._check_lock
+                    dbsession, self._check_lock, first_wait
                     )
                 break
             except WaitDataLockedException as e:
+                first_wait = None
+                if not (flags & STEP_NOBLOCK):
+                    # nothing else can release the lock while waiting here
+                    # except the running sqls, the lock status is checked
+                    # less and less frequently, and the watchdog still
+                    # counts for a lock never released
+                    if blocked_since is None:
+                        blocked_since = time.time()
+                    sqlhelper.watch(dbsession, blocked_since)
+                    first_wait = poll_time
+                    poll_time = min(poll_time * 2, POLL_MAX_TIME)
                 if flags & STEP_NOBLOCK:
                     if not (flags & STEP_RETRY):
+                        self._wait_start[step.tag()] = time.time()
                         print("step %s: %s <waiting ...>" %
                               (step.tag(), step.raw_sql()))
                     return True
@@ -542,48 +778,64 @@ class TestRunner(object):
                 self._errorsteps[step.tag()] = str(e)
                 break
 
+        # the completed step may release some locks, the cached lock
+        # status is out of date
+        self._lock_status.new_tick()
+        self._step_completed(step)
+
         if flags & STEP_RETRY:
             print("step %s: <... completed>" % step.tag())
         else:
             print("step %s: %s" % (step.tag(), step.raw_sql()))
 
-        output = sqlhelper.output()
-        if output:
-            print(output)
+        if sqlhelper.write(sys.stdout):
+            print()
         
         return False
 
-    def _check_lock(self, pid):
-        """send a Maint prepare message to get the lock status for session
-        execute the internal lock check function to check whether the pid
-        specified is locked, if it is locked, the function will return True,
+    def _step_completed(self, step):
+        """trace the step from sent to completed, and the lock waiting, the
+        duration of the step which is not blocked and succeed is recorded
+        in the history
+        """
+        tag = step.tag()
+        error = self._errorsteps.get(tag, '')
+        wait_start = self._wait_start.pop(tag, None)
+        start = self._step_start.pop(tag, None)
+        if start is None:
+            return
+        end = time.time()
+        if self._history is not None and wait_start is None and not error:
+            self._history.add(tag, end - start)
 
-        ..note:
-          pg_isolation_test_session_is_blocked function is involved in 9.6
+        if not trace.enabled():
+            return
+        case = self._testcase.name
+        if wait_start is not None:
+            trace.complete('lock wait', 'step', wait_start, end, case=case,
+                           step=tag)
+        trace.complete('step', 'step', start, end, case=case, step=tag,
+                       waited=wait_start is not None, error=error)
+
+    def _check_lock(self, pid):
+        """get the lock status for session, whether the pid specified is
+        locked, if it is locked, the function will return True. the status
+        of all the test sessions are checked by the maint session in one
+        query, and cached until a step completed or the tick ended.
 
         :type pid: str or int
         :param pid: the process id or backend id need to check block status
         """
-        # join operation need string type list
-        pids = [str(x) for x in self._backend_pids]
-        sql = (
-            "SELECT pg_catalog.pg_isolation_test_session_is_blocked"
-            "({pid}, '{{{pids}}}')"
-            ).format(pid=pid, pids=','.join(pids))
-
-        result = self._maint_session.execute(sql)
-        
-        rows = result.rows
-        return rows[0][0]
+        return self._lock_status.is_blocked(pid)
 
     def _make_maint_session(self):
         """setup the maintainance db connection which is used for setup
         sqls and some management work.
         """
         import config
-        self._maint_session = PGConnectionManager.new_connection(
+        self._maint_session = get_connection_pool().acquire(
             config.dbname, config.user, config.password,
-            config.host, config.port)
+            config.host, self._port)
         self._maint_session.set_name('Maint')
         # we need to set the autocommit exeplicitly for maint session,
         # in PG code, we cannot see the autocommit setting, because the
@@ -597,13 +849,13 @@ class TestRunner(object):
         """
         for tag, conn in self._sessions.items():
             logger.debug("conn(%s) has been cleared" % tag)
-            conn.close()
+            get_connection_pool().release(conn)
 
     def _clear_maint_session(self):
         """kill the maintainance related db connection
         """
         logger.debug("Maint conn has been cleared")
-        self._maint_session.close()
+        get_connection_pool().release(self._maint_session)
 
     def _get_session_by_tag(self, tag):
         """each step was binded to a session, use the step session tag
@@ -617,17 +869,28 @@ class TestRunner(object):
         """
         return self._sessions.get(tag, None)
 
-    def _make_test_sessions(self):
+    def _make_test_sessions(self, dbname=None):
         """setup sessions which are used for permutation test run,
         session number should meet the testcase requirement, and each
         session should identified with the sesstion tag.
+
+        :type dbname: str
+        :param dbname: the database to connect, default is config.dbname
         """
         tags = self._testcase.session_tags()
-        import config
+        if dbname is None:
+            dbname = config.dbname
         for tag in tags:
-            self._sessions[tag] = PGConnectionManager.new_async_connection(
-                config.dbname, config.user, config.password,
-                config.host, config.port)
+            if dbname == config.dbname:
+                self._sessions[tag] = get_connection_pool().acquire(
+                    dbname, config.user, config.password,
+                    config.host, self._port, async_=True)
+            else:
+                # the connections to a template clone database are not
+                # pooled, the clone is dropped after the permutation
+                self._sessions[tag] = PGConnectionManager.new_async_connection(
+                    dbname, config.user, config.password,
+                    config.host, self._port)
             # the test session are all async connection, and there is no
             # autocommit property, since the default is autocommit
             # self._sessions[tag].autocommit(True)
@@ -648,10 +911,15 @@ class TestRunner(object):
             if backendpid:
                 self._backend_pids.append(backendpid)
 
+        candidate_pids = []
         for tag, conn in self._sessions.items():
             backendpid = conn.get_backend_pid()
             if backendpid:
                 self._backend_pids.append(backendpid)
+                candidate_pids.append(backendpid)
+
+        self._lock_status = LockStatus(self._maint_session,
+                                       self._backend_pids, candidate_pids)
 
     def _report_error_message(self, step):
         """a error report method only report the target step error mssage
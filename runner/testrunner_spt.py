@@ -28,7 +28,14 @@ import sys
 
 sys.path.append('.')
 from utils.connection import PGConnectionManager, SQLBlockExecutorHelper
+from utils.connection import wait_any_readable, BLOCK_TIME
+from utils.timeouts import POLL_MAX_TIME
+from utils.history import step_history
+from utils.connection import SERVER_PORT_ENV
+from utils.lockstatus import LockStatus
+from utils.connpool import get_connection_pool
 from testcase import TestCase
+from testcase.permutations import PERMUTATION_RANGE_ENV, parse_range
 from utils.sql import parse_sqls
 from testcase.modules import SQLBlock
 import time
@@ -53,6 +60,17 @@ logger = logging.getLogger("TestRunner")
 STEP_NOBLOCK = 0x1
 STEP_RETRY = 0x2
 
+# run the number of randomly chosen permutations only, 0 means all, the
+# same seed always choose the same permutations
+PERMUTATION_SAMPLE = getattr(config, 'permutation_sample', 0)
+PERMUTATION_SEED = getattr(config, 'permutation_seed', 0)
+# send at most the number of setup/teardown sqls in one round trip of the
+# maint session, 0 means one by one
+SETUP_BATCH_SIZE = getattr(config, 'setup_batch_size', 0)
+# skip the implicit permutations which only swap the independent steps,
+# '' for off, 'annotated' or 'infer', see testcase/reduction.py
+PERMUTATION_REDUCTION = getattr(config, 'permutation_reduction', '')
+
 #def parse_keywords_list(keywords_list):
 #    '''
 #    keywords_list: type:list,the shell commands block
@@ -117,11 +135,18 @@ class TestRunner(object):
     """
     def __init__(self, case_path):
         self._testcase = TestCase(case_path)
+        self._port = int(os.environ.get(SERVER_PORT_ENV, config.port))
         self._maint_session = None
         self._sessions = {}
         self._waitings = []
         self._backend_pids = []
+        self._lock_status = None
         self._errorsteps = {} # {step: errormsg}
+        # the timestamps of the steps sent and blocked, {tag: time}
+        self._step_start = {}
+        self._wait_start = {}
+        # the step duration history, recorded in the adaptive timeout mode
+        self._history = None
 
     #def run(self, dry_run=False):
     def run(self):
@@ -145,6 +170,8 @@ class TestRunner(object):
           file for detail reason
         """
         self._testcase.build()
+        self._select_permutations()
+        self._apply_timeouts()
 
         if len(self._testcase._keywords)!=0:
         #    exec_keywords(self._testcase.keywords())       
@@ -162,6 +189,7 @@ class TestRunner(object):
             self._clear_test_sessions()
             self._load_teardown_sqls()
             self._clear_maint_session()
+        self._save_history()
 
     def _run_all_keywords(self):
         for keyword in self._testcase.keywords():
@@ -183,10 +211,9 @@ class TestRunner(object):
         logger.debug("LOADING SETUP SQLS")
         for setup in self._testcase.setups():
             helper = setup.sqlhelper()
-            helper.execute(self._maint_session)
-            output = helper.output()
-            if output:
-                print(output)
+            helper.execute(self._maint_session, SETUP_BATCH_SIZE)
+            if helper.write(sys.stdout):
+                print()
 
     def _load_teardown_sqls(self):
         """get the sqls from testcase teardown module, and execute them
@@ -194,10 +221,9 @@ class TestRunner(object):
         logger.debug("LOADING TEARDOWN SQLS")
         for teardown in self._testcase.teardowns():
             helper = teardown.sqlhelper()
-            helper.execute(self._maint_session)
-            output = helper.output()
-            if output:
-                print(output)
+            helper.execute(self._maint_session, SETUP_BATCH_SIZE)
+            if helper.write(sys.stdout):
+                print()
 
     def _load_session_setup_sqls(self):
         """get the sqls from each session level setup module, and execute
@@ -214,9 +240,8 @@ class TestRunner(object):
             
             helper = setup.sqlhelper()
             helper.execute(dbsession)
-            output = helper.output()
-            if output:
-                print(output)
+            if helper.write(sys.stdout):
+                print()
 
     def _load_session_teardown_sqls(self):
         """get the sqls from each session level teardown model, and execute
@@ -233,9 +258,8 @@ class TestRunner(object):
                                 % session_tag)
             helper = teardown.sqlhelper()
             helper.execute(dbsession)
-            output = helper.output()
-            if output:
-                print(output)
+            if helper.write(sys.stdout):
+                print()
 
     def _start_dry_run(self):
         """only print the sqls for setup, teardown, permutation in sequence
@@ -272,6 +296,39 @@ class TestRunner(object):
             print()
             round_num += 1
 
+    def _select_permutations(self):
+        """run part of the permutations only, if a range is given by the
+        environment (the permutations of a big case can be sharded to many
+        runners), or the sampling is configured
+        """
+        if PERMUTATION_REDUCTION:
+            self._testcase.reduce_permutations(PERMUTATION_REDUCTION)
+            logger.info("%d permutations are pruned by the reduction"
+                        % self._testcase.pruned_permutation_num())
+
+        total = self._testcase.permutation_num()
+        start, stop = 0, None
+        value = os.environ.get(PERMUTATION_RANGE_ENV)
+        if value:
+            start, stop = parse_range(value, total)
+        self._testcase.select_permutations(start, stop, PERMUTATION_SAMPLE,
+                                           PERMUTATION_SEED)
+        logger.debug("%d permutations, range %s, sample %d"
+                     % (total, value or 'all', PERMUTATION_SAMPLE))
+
+    def _apply_timeouts(self):
+        """set the timeouts of the steps, in the adaptive mode, the step
+        durations of this run are recorded for the later runs
+        """
+        history = step_history(self._testcase.path)
+        policy = self._testcase.apply_timeouts(history)
+        if policy.adaptive():
+            self._history = history
+
+    def _save_history(self):
+        if self._history is not None:
+            self._history.save()
+
     def _start_permutations(self):
         """run the steps for each permutation, look up session by the
         step tag, and run step sqls in its session.
@@ -366,6 +423,8 @@ class TestRunner(object):
         #    wait = self._try_complete_step(step, STEP_NOBLOCK)
         #    if wait:
         #        break
+        self._lock_status.new_tick()
+        self._step_start[step.tag()] = time.time()
         helper.sendSQL(dbsession, self._check_lock)
         
         try:
@@ -427,9 +486,20 @@ class TestRunner(object):
         # remove it at last
         to_del = []
 
+        # wait for all the waiting sessions at the same time instead of
+        # waiting a block time for each of them one by one, after that
+        # every waiting step only need to have a look at its result
+        first_wait = None
+        if self._waitings:
+            sessions = [self._get_session_by_tag(step.session())
+                        for step in self._waitings]
+            wait_any_readable(sessions, BLOCK_TIME)
+            first_wait = 0
+            self._lock_status.new_tick()
+
         for step in self._waitings:
             wait = False
-            wait = self._new_try_complete_step(step, flags)
+            wait = self._new_try_complete_step(step, flags, first_wait)
 
             if wait:
                 # still waiting, just keep it in the wait list
@@ -546,23 +616,36 @@ class TestRunner(object):
 
             print("step %s: %s" % (step.tag(), step.sql()))
 
-        print(sqlhelper.get_result().output())
+        sqlhelper.get_result().write(sys.stdout)
+        print()
         
         return False
 
-    def _new_try_complete_step(self, step, flags):
+    def _new_try_complete_step(self, step, flags, first_wait=None):
         session_tag = step.session()
         dbsession = self._get_session_by_tag(session_tag)
         sqlhelper = step.sqlhelper()
+        poll_time = BLOCK_TIME
+        blocked_since = None
         while True:
             try:
                 sqlhelper.try_complete_current_execution(
-                    dbsession, self._check_lock
+                    dbsession, self._check_lock, first_wait
                     )
                 break
             except WaitDataLockedException as e:
+                first_wait = None
+                if not (flags & STEP_NOBLOCK):
+                    # check the lock status less and less frequently, the
+                    # watchdog still counts for a lock never released
+                    if blocked_since is None:
+                        blocked_since = time.time()
+                    sqlhelper.watch(dbsession, blocked_since)
+                    first_wait = poll_time
+                    poll_time = min(poll_time * 2, POLL_MAX_TIME)
                 if flags & STEP_NOBLOCK:
                     if not (flags & STEP_RETRY):
+                        self._wait_start[step.tag()] = time.time()
                         print("step %s: %s <waiting ...>" %
                               (step.tag(), step.raw_sql()))
                     return True
@@ -572,48 +655,52 @@ class TestRunner(object):
                 self._errorsteps[step.tag()] = str(e)
                 break
 
+        # the completed step may release some locks, the cached lock
+        # status is out of date
+        self._lock_status.new_tick()
+        self._step_completed(step)
+
         if flags & STEP_RETRY:
             print("step %s: <... completed>" % step.tag())
         else:
             print("step %s: %s" % (step.tag(), step.raw_sql()))
 
-        output = sqlhelper.output()
-        if output:
-            print(output)
+        if sqlhelper.write(sys.stdout):
+            print()
         
         return False
 
-    def _check_lock(self, pid):
-        """send a Maint prepare message to get the lock status for session
-        execute the internal lock check function to check whether the pid
-        specified is locked, if it is locked, the function will return True,
+    def _step_completed(self, step):
+        """the duration of the step which is not blocked and succeed is
+        recorded in the history
+        """
+        tag = step.tag()
+        wait_start = self._wait_start.pop(tag, None)
+        start = self._step_start.pop(tag, None)
+        if start is None or self._history is None:
+            return
+        if wait_start is None and not self._errorsteps.get(tag, ''):
+            self._history.add(tag, time.time() - start)
 
-        ..note:
-          pg_isolation_test_session_is_blocked function is involved in 9.6
+    def _check_lock(self, pid):
+        """get the lock status for session, whether the pid specified is
+        locked, if it is locked, the function will return True. the status
+        of all the test sessions are checked by the maint session in one
+        query, and cached until a step completed or the tick ended.
 
         :type pid: str or int
         :param pid: the process id or backend id need to check block status
         """
-        # join operation need string type list
-        pids = [str(x) for x in self._backend_pids]
-        sql = (
-            "SELECT pg_catalog.pg_isolation_test_session_is_blocked"
-            "({pid}, '{{{pids}}}')"
-            ).format(pid=pid, pids=','.join(pids))
-
-        result = self._maint_session.execute(sql)
-        
-        rows = result.rows
-        return rows[0][0]
+        return self._lock_status.is_blocked(pid)
 
     def _make_maint_session(self):
         """setup the maintainance db connection which is used for setup
         sqls and some management work.
         """
         import config
-        self._maint_session = PGConnectionManager.new_connection(
+        self._maint_session = get_connection_pool().acquire(
             config.dbname, config.user, config.password,
-            config.host, config.port)
+            config.host, self._port)
         self._maint_session.set_name('Maint')
         # we need to set the autocommit exeplicitly for maint session,
         # in PG code, we cannot see the autocommit setting, because the
@@ -628,13 +715,13 @@ class TestRunner(object):
         for tag, conn in self._sessions.items():
             if tag != 'shell':
                 logger.debug("conn(%s) has been cleared" % tag)
-                conn.close()
+                get_connection_pool().release(conn)
 
     def _clear_maint_session(self):
         """kill the maintainance related db connection
         """
         logger.debug("Maint conn has been cleared")
-        self._maint_session.close()
+        get_connection_pool().release(self._maint_session)
 
     def _get_session_by_tag(self, tag):
         """each step was binded to a session, use the step session tag
@@ -659,9 +746,9 @@ class TestRunner(object):
             if tag == "shell":
                 self._sessions[tag] = tag
             else:
-                self._sessions[tag] = PGConnectionManager.new_async_connection(
+                self._sessions[tag] = get_connection_pool().acquire(
                     config.dbname, tag, config.password,
-                    config.host, config.port)
+                    config.host, self._port, async_=True)
                 # the test session are all async connection, and there is no
                 # autocommit property, since the default is autocommit
                 # self._sessions[tag].autocommit(True)
@@ -682,11 +769,16 @@ class TestRunner(object):
             if backendpid:
                 self._backend_pids.append(backendpid)
 
+        candidate_pids = []
         for tag, conn in self._sessions.items():
             if tag != 'shell':
                 backendpid = conn.get_backend_pid()
                 if backendpid:
                     self._backend_pids.append(backendpid)
+                    candidate_pids.append(backendpid)
+
+        self._lock_status = LockStatus(self._maint_session,
+                                       self._backend_pids, candidate_pids)
 
     def _report_error_message(self, step):
         """a error report method only report the target step error mssage
@@ -0,0 +1,39 @@
+"""tests of the result normalizers, run from the top directory by
+
+    PYTHONPATH=. python3 -m unittest discover -s test -p 'test_*.py'
+"""
+
+import unittest
+from checker.differ import UnorderedBlock
+
+
+class UnorderedBlockTest(unittest.TestCase):
+    def setUp(self):
+        # the example of result_unordered in config.py.*
+        self.block = UnorderedBlock(r'^step .*: SELECT',
+                                    r'^(step |starting permutation)')
+
+    def test_sorted_block(self):
+        lines = ['step s1a: SELECT * FROM t;\n', 'b\n', 'a\n',
+                 'step s1b: COMMIT;\n']
+        self.assertEqual(list(self.block.apply(lines)),
+                         ['step s1a: SELECT * FROM t;\n', 'a\n', 'b\n',
+                          'step s1b: COMMIT;\n'])
+
+    def test_back_to_back_selects(self):
+        lines = ['step s1a: SELECT * FROM t;\n', 'b\n', 'a\n',
+                 'step s2a: SELECT * FROM u;\n', 'd\n', 'c\n',
+                 'starting permutation: s1a s2a\n']
+        self.assertEqual(list(self.block.apply(lines)),
+                         ['step s1a: SELECT * FROM t;\n', 'a\n', 'b\n',
+                          'step s2a: SELECT * FROM u;\n', 'c\n', 'd\n',
+                          'starting permutation: s1a s2a\n'])
+
+    def test_block_to_end_of_file(self):
+        lines = ['step s1a: SELECT * FROM t;\n', 'b\n', 'a\n']
+        self.assertEqual(list(self.block.apply(lines)),
+                         ['step s1a: SELECT * FROM t;\n', 'a\n', 'b\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+"""tests of the runner output capturing, run from the top directory by
+
+    PYTHONPATH=. python3 -m unittest discover -s test -p 'test_*.py'
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+from utils.output import OutputMultiplexer, _Capture
+
+
+class TranslateTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.capture = _Capture(None, os.path.join(self.tmpdir, 'out'), None)
+
+    def tearDown(self):
+        self.capture.fd.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_line_endings(self):
+        self.assertEqual(self.capture.translate(b'a\r\nb\rc\n'),
+                         b'a\nb\nc\n')
+
+    def test_split_crlf(self):
+        self.assertEqual(self.capture.translate(b'a\r'), b'a')
+        self.assertEqual(self.capture.translate(b'\nb'), b'\nb')
+
+    def test_split_cr(self):
+        self.assertEqual(self.capture.translate(b'a\r'), b'a')
+        self.assertEqual(self.capture.translate(b'b'), b'\nb')
+
+
+class OutputMultiplexerTest(unittest.TestCase):
+    def test_capture(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            logfile = os.path.join(tmpdir, 'out')
+            proc = subprocess.Popen(
+                [sys.executable, '-c',
+                 'import sys; sys.stdout.buffer.write(b"a\\r\\nb\\rc\\r")'],
+                stdout=subprocess.PIPE)
+            output = OutputMultiplexer()
+            output.add(proc, logfile, to_screen=False)
+            proc.wait()
+            output.wait(proc)
+            with open(logfile, 'rb') as fd:
+                self.assertEqual(fd.read(), b'a\nb\nc\n')
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,15 @@
 import os
 import json
 import logging
-from .case_parser import parse_testcase_structure
+import itertools
+from . import spec_cache
+from .permutations import (count_interleavings, iter_interleavings,
+                           unrank_interleaving, interleaving_to_tags,
+                           sample_ranks)
+from .reduction import (REDUCTION_OFF, REDUCTION_INFER, parse_footprints,
+                        infer_footprint, has_hidden_dependency,
+                        iter_reduced_interleavings)
+from utils.timeouts import TimeoutPolicy, parse_timeout_directives
 from .modules import (SQLBlock, StepCmdModule, SessionModule, SetupModule,
                       TearDownModule, Permutation)
 
@@ -58,8 +66,20 @@ class TestCase(object):
         self._teardowns = []
         self._sessions = []
         self._permutations = []
-        # here is just a cache, also can do a list search each form the
-        # sessions  each time
+        # the step tags of each session, used for the implicit permutations
+        # which are generated lazily
+        self._implicit_groups = None
+        # the selected permutations, (start, stop, sample, seed)
+        self._selection = (0, None, 0, 0)
+        # the steps of each permutation, for the explicit permutations
+        self._permutation_steps = []
+        # the steps of each session, for the implicit permutations
+        self._implicit_steps = None
+        # the footprint of each step of each session, set when the partial
+        # order reduction is used
+        self._footprints = None
+        self._reduced_num = None
+        # the step tag to the step module, {tag: StepCmdModule}
         self._step_mapping = {}
 
     def reset(self):
@@ -77,9 +97,33 @@ class TestCase(object):
         if self._structure is not None:
             return
         self._read_file_content()
+        cached = spec_cache.load(self._file_content)
+        if cached is not None:
+            self._structure = cached
+            self._build_internals()
+            self._build_implicit_permutations()
+            return
+
+        # the parser is imported here, so that the ply lexer and parser
+        # tables are not loaded at all when the spec is cached
+        from .case_parser import parse_testcase_structure
         self._structure = parse_testcase_structure(self._file_content)
         self._build_internals()
         self._build_implicit_permutations()
+        if self._is_cacheable():
+            spec_cache.store(self._file_content, self._structure)
+
+    def _is_cacheable(self):
+        """the keywords and shell commands read the keywords.xml and print
+        messages when parsing, the spec which has them is always parsed
+        """
+        if self._structure is None or self._keywords:
+            return False
+        for session in self._sessions:
+            for step in session.steps():
+                if step.command() is not None:
+                    return False
+        return True
 
     def _build_internals(self):
         """extract the data from the raw structures, and this will make
@@ -92,6 +136,11 @@ class TestCase(object):
         self._teardowns = list(self._structure['teardown'])
         self._sessions = list(self._structure['sessions'])
         self._permutations = list(self._structure['permutations'])
+        self._build_step_mapping()
+        self._permutation_steps = [
+            self._permutation_tag_to_steps(permutation)
+            for permutation in self._permutations
+            ]
 
     def __str__(self):
         """reurn two types of case description, one is builded version,
@@ -103,7 +152,7 @@ class TestCase(object):
         setup_num = len(self._setups)
         teardown_num = len(self._teardowns)
         session_num = len(self._sessions)
-        permutation_num = len(self._permutations)
+        permutation_num = self.permutation_num()
         
         return ("caseName: %s; "
                 "structure: %d setup clauses, %d teardown clauses, "
@@ -156,52 +205,48 @@ class TestCase(object):
         #     self._permutations.append(tags)
         #
         # ---above is the old simple permutation algorithm, below is new
-        # ---which is wrap the C version to python with the same output
-        
-        def compute_permutations(sessions, nsteps, steps):
-            found = False
-            for i in range(nsessions):
-                if piles[i] < len(sessions[i]):
-                    steps[nsteps] = sessions[i][piles[i]]
-                    piles[i] += 1
-                    yield from compute_permutations(sessions, nsteps+1, steps)
-                    piles[i] -= 1
-                    found = True
-
-            if found is False:    
-                #self._permutations.append(list(steps))
-                 yield list(steps)
+        # ---which is wrap the C version to python with the same output,
+        # ---the permutations are generated lazily, see permutations.py
 
         groups_of_tags = []
-        nsteps = 0
+        groups_of_steps = []
         # MUST use the session sequence as the sort keys, shince it is the
         # session definition sequence which will compliant with offical
         # implementation, it will generate same output data, it not, the
         # different sequence will make new output which is different from
         # expected output
         for session in self._sessions:
-            step_tags = session.step_tags()
-            nsteps += len(step_tags)
-            groups_of_tags.append(step_tags)
-        
-        nsessions = len(self._sessions)
-        steps = [''] * nsteps
-        piles = [0] * nsessions
-        for steps in compute_permutations(groups_of_tags, 0, steps):
-            permutation = Permutation(steps)
-            self._permutations.append(permutation)
+            groups_of_tags.append(session.step_tags())
+            groups_of_steps.append(list(session.steps()))
+
+        self._implicit_groups = groups_of_tags
+        self._implicit_steps = groups_of_steps
 
     def _build_step_mapping(self):
-        pass
+        """build the step tag to step module index, the step tag should
+        be unique in the whole spec
+        """
+        self._step_mapping = {}
+        for session in self._sessions:
+            for step in session.steps():
+                if step.tag() in self._step_mapping:
+                    raise Exception("duplicate step name %s in %s"
+                                    % (step.tag(), self.path))
+                self._step_mapping[step.tag()] = step
 
     def get_session_by_step(self, step):
-        """two solutions, can buld a cache for step to session mapping,
-        and also can search the session from the structure each time.
-        since it is not a performance sensitive application, for easy
-        implementation, just do structure search each time, and this
-        will reduce a cache variable usage, made program easy to read
-        and maintain"""
-        return 'session'
+        """get the session tag of the step by the step index
+
+        :type step: str
+        :param step: the step tag
+
+        :rtype: str
+        :returns: the session tag, None if no such step
+        """
+        module = self._step_mapping.get(step)
+        if module is None:
+            return None
+        return module.session()
 
     def _get_command_by_step(self, step):
         pass
@@ -223,13 +268,164 @@ class TestCase(object):
         return self._sessions
 
     def permutations(self):
-        return self._permutations
+        """the selected permutations, the implicit permutations are
+        generated lazily
+
+        :rtype: generator of :class:`testcase.modules.Permutation`
+        """
+        if self._implicit_groups is None:
+            yield from self._selected(None, self._permutations)
+            return
+
+        for tags in self._selected(self._implicit_groups, None):
+            yield Permutation(tags)
+
+    def _selected(self, groups, items):
+        """yield the selected permutations
+
+        :type groups: list of list
+        :param groups: the step tags (or the steps) of each session, used
+                       for the implicit permutations
+
+        :type items: list
+        :param items: the explicit permutations (or their steps)
+        """
+        start, stop, sample, seed = self._selection
+        total = self.permutation_num()
+        stop = total if stop is None else min(stop, total)
+
+        if groups is None:
+            if sample:
+                for rank in sample_ranks(start, stop, sample, seed):
+                    yield items[rank]
+            else:
+                yield from items[start:stop]
+            return
+
+        if self._footprints is not None:
+            reduced = iter_reduced_interleavings(groups, self._footprints)
+            if not sample:
+                yield from itertools.islice(reduced, start, stop)
+                return
+            ranks = sample_ranks(start, stop, sample, seed)
+            chosen = set(ranks)
+            for rank, item in enumerate(itertools.islice(reduced,
+                                                         ranks[-1] + 1
+                                                         if ranks else 0)):
+                if rank in chosen:
+                    yield item
+            return
+
+        if sample:
+            counts = [len(group) for group in groups]
+            for rank in sample_ranks(start, stop, sample, seed):
+                sequence = unrank_interleaving(counts, rank)
+                yield interleaving_to_tags(groups, sequence)
+            return
+
+        yield from iter_interleavings(groups, start, stop)
+
+    def select_permutations(self, start=0, stop=None, sample=0, seed=0):
+        """run part of the permutations only, the range is applied first,
+        and then the sampling in the range
+
+        :type start: int
+        :param start: the first permutation to run, start from 0
+
+        :type stop: int
+        :param stop: the permutation to stop at (excluded), None for all
+
+        :type sample: int
+        :param sample: run the number of randomly chosen permutations, the
+                       chosen permutations keep the sequence, 0 for all
+
+        :type seed: int
+        :param seed: the random seed, the same seed choose the same ones
+        """
+        self._selection = (start, stop, sample, seed)
+
+    def reduce_permutations(self, mode):
+        """skip the implicit permutations which only swap the independent
+        steps, see reduction.py
+
+        :type mode: str
+        :param mode: '' for no reduction, 'annotated' to use the footprint
+                     directives only, 'infer' to infer the footprint from
+                     the sql text for the steps without directive
+        """
+        if mode == REDUCTION_OFF or self._implicit_steps is None:
+            return
+
+        declared = parse_footprints(self._file_content)
+        infer = mode == REDUCTION_INFER
+        if infer:
+            sqls = []
+            for setup in self._setups:
+                sqls.extend(setup.sql().get_sqls())
+            if has_hidden_dependency(sqls):
+                logger.debug("setup of %s has hidden dependencies, only the "
+                             "declared footprints are used" % self.name)
+                infer = False
+
+        footprints = []
+        for steps in self._implicit_steps:
+            group = []
+            for step in steps:
+                footprint = declared.get(step.tag())
+                if footprint is None and infer and step.sql() is not None:
+                    footprint = infer_footprint(step.sql().get_sqls())
+                group.append(footprint)
+            footprints.append(group)
+
+        self._footprints = footprints
+        self._reduced_num = None
+
+    def apply_timeouts(self, history=None):
+        """set the timeouts of the steps by the config, the profile timeout
+        file and the timeout directives, see utils/timeouts.py
+
+        :type history: :class:`utils.history.DurationHistory`
+        :param history: the step duration history for the adaptive mode
+
+        :rtype: :class:`utils.timeouts.TimeoutPolicy`
+        """
+        spec_settings, step_settings = parse_timeout_directives(
+            self._file_content
+            )
+        policy = TimeoutPolicy(os.path.dirname(os.path.abspath(self.path)),
+                               spec_settings, step_settings, history)
+        for tag, step in self._step_mapping.items():
+            if step.sqlhelper() is not None:
+                step.sqlhelper().set_timeout(policy.for_step(tag))
+        return policy
+
+    def pruned_permutation_num(self):
+        """the number of the implicit permutations skipped by the reduction
+        """
+        return self._full_permutation_num() - self.permutation_num()
 
     def session_definition_sequence(self):
         return self._session_sequence
 
     def permutation_num(self):
-        return len(self._permutations)
+        """the number of all the permutations, the implicit permutations
+        are counted without generating, but the reduced permutations have
+        to be generated once to count
+        """
+        if self._footprints is None:
+            return self._full_permutation_num()
+        if self._reduced_num is None:
+            self._reduced_num = sum(1 for _ in iter_reduced_interleavings(
+                self._implicit_groups, self._footprints
+                ))
+        return self._reduced_num
+
+    def _full_permutation_num(self):
+        if self._implicit_groups is None:
+            return len(self._permutations)
+        return count_interleavings(
+            [len(group) for group in self._implicit_groups]
+            )
 
     def session_num(self):
         return len(self._sessions.keys())
@@ -257,8 +453,14 @@ class TestCase(object):
         return results
 
     def next_permutation_steps(self):
-        for permutation in self._permutations:
-            yield self._permutation_tag_to_steps(permutation)
+        """
+        :rtype: generator of list of :class:`testcase.module.StepCmdModule`
+        :returns: the steps of each selected permutation
+        """
+        if self._implicit_steps is None:
+            yield from self._selected(None, self._permutation_steps)
+        else:
+            yield from self._selected(self._implicit_steps, None)
 
     def _permutation_tag_to_steps(self, permutation):
         """
@@ -267,14 +469,9 @@ class TestCase(object):
         """
         results = []
         for step in permutation.step_tags():
-            found = False
-            for session in self._sessions:
-                for step_module in session.steps():
-                    if step != step_module.tag():
-                        continue
-                    results.append(step_module)
-                    found = True
-            if found == False:
-                raise Exception("cannot find the step %s in sessions", step)
+            step_module = self._step_mapping.get(step)
+            if step_module is None:
+                raise Exception("cannot find the step %s in sessions" % step)
+            results.append(step_module)
 
         return results
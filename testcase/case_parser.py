@@ -235,6 +235,11 @@ def p_error(p):
 parser = yacc.yacc()
 
 def parse_testcase_structure(data):
+    # the statements is a module level holder which the grammar rules
+    # append to, a clean one is required when many cases are parsed in
+    # the same process (like the runner pool worker)
+    for key in statements:
+        statements[key] = []
     return parser.parse(data)
     
 
@@ -0,0 +1,162 @@
+"""implicit permutations of the session steps
+
+when there is no permutation in the spec, all the interleavings of the
+session steps are tested, the steps of a session keep their sequence. the
+number of the interleavings is the multinomial coefficient of the step
+counts, which grows very fast, so the interleavings are never built all at
+once, they are generated one by one in the same sequence as the offical C
+version (try the sessions by the definition sequence for each position).
+
+an interleaving is represented by the sequence of the session indexes, the
+generation sequence is the lexicographic sequence of the index sequences,
+so the interleavings can be counted, ranked and unranked, which make the
+sampling and the sharding (run the range i..j only) cheap.
+"""
+
+import random
+from math import factorial
+
+# the environment variable which tell the runner to run a range of the
+# permutations only, like '100:200', the start is included and the stop
+# is excluded. the application does not split the cases itself, the range
+# set for the whole run is passed to every runner, and the results are
+# reported as skipped instead of compared with the expected files
+PERMUTATION_RANGE_ENV = 'PGREGRESS_PERMUTATIONS'
+
+def count_interleavings(counts):
+    """
+    :type counts: list of int
+    :param counts: the step count of each session
+
+    :rtype: int
+    :returns: the number of the interleavings
+    """
+    total = factorial(sum(counts))
+    for count in counts:
+        total //= factorial(count)
+    return total
+
+def unrank_interleaving(counts, rank):
+    """get the interleaving at the rank of the generation sequence
+
+    :type counts: list of int
+    :param counts: the step count of each session
+
+    :type rank: int
+    :param rank: the position in the generation sequence, start from 0
+
+    :rtype: list of int
+    :returns: the session index sequence
+    """
+    remaining = list(counts)
+    left = sum(remaining)
+    total = count_interleavings(remaining)
+    if rank < 0 or rank >= total:
+        raise Exception("permutation rank %d is out of range 0..%d"
+                        % (rank, total - 1))
+    sequence = []
+    while left:
+        for i, count in enumerate(remaining):
+            if count == 0:
+                continue
+            # the number of the interleavings start with session i
+            sub = total * count // left
+            if rank < sub:
+                sequence.append(i)
+                remaining[i] -= 1
+                left -= 1
+                total = sub
+                break
+            rank -= sub
+    return sequence
+
+def next_interleaving(sequence):
+    """change the sequence to the next one in the generation sequence,
+    it is the next permutation of a multiset in lexicographic sequence
+
+    :type sequence: list of int
+    :param sequence: the session index sequence, changed in place
+
+    :rtype: Boolen
+    :returns: False if the sequence is already the last one
+    """
+    i = len(sequence) - 2
+    while i >= 0 and sequence[i] >= sequence[i+1]:
+        i -= 1
+    if i < 0:
+        return False
+    j = len(sequence) - 1
+    while sequence[j] <= sequence[i]:
+        j -= 1
+    sequence[i], sequence[j] = sequence[j], sequence[i]
+    sequence[i+1:] = reversed(sequence[i+1:])
+    return True
+
+def interleaving_to_tags(groups, sequence):
+    """
+    :type groups: list of list of str
+    :param groups: the step tags (or the steps) of each session
+
+    :rtype: list of str
+    :returns: the step tags (or the steps) of the interleaving
+    """
+    piles = [0] * len(groups)
+    tags = []
+    for i in sequence:
+        tags.append(groups[i][piles[i]])
+        piles[i] += 1
+    return tags
+
+def iter_interleavings(groups, start=0, stop=None):
+    """generate the interleavings lazily
+
+    :type groups: list of list of str
+    :param groups: the step tags (or the steps) of each session
+
+    :type start: int
+    :param start: the rank of the first interleaving
+
+    :type stop: int
+    :param stop: the rank to stop at (excluded), None means to the end
+
+    :rtype: generator of list of str
+    :returns: the step tags of each interleaving
+    """
+    counts = [len(group) for group in groups]
+    total = count_interleavings(counts)
+    stop = total if stop is None else min(stop, total)
+    if start >= stop:
+        return
+    sequence = unrank_interleaving(counts, start)
+    for _ in range(stop - start):
+        yield interleaving_to_tags(groups, sequence)
+        if not next_interleaving(sequence):
+            break
+
+def sample_ranks(start, stop, num, seed):
+    """choose num ranks from start..stop randomly, the same seed always
+    choose the same ranks
+
+    :rtype: list of int
+    :returns: the sorted ranks
+    """
+    if num >= stop - start:
+        return list(range(start, stop))
+    rng = random.Random(seed)
+    ranks = set()
+    while len(ranks) < num:
+        ranks.add(rng.randrange(start, stop))
+    return sorted(ranks)
+
+def parse_range(value, total):
+    """parse the permutation range like 'i:j', 'i:' or ':j'
+
+    :rtype: tuple
+    :returns: the start and stop rank
+    """
+    start, sep, stop = value.partition(':')
+    if not sep:
+        raise Exception("invalid permutation range %s, i:j required" % value)
+    start = int(start) if start.strip() else 0
+    stop = int(stop) if stop.strip() else total
+    return max(start, 0), min(stop, total)
@@ -0,0 +1,240 @@
+"""partial order reduction of the implicit permutations
+
+two steps of different sessions are independent if their footprints do not
+conflict (no object written by one is read or written by the other), the
+interleavings which only swap adjacent independent steps are equivalent,
+they can not show different results. only one interleaving of each
+equivalent class is kept: the one which is the smallest in the generation
+sequence (the lexicographic normal form of the trace).
+
+the normal form is checked when a step is appended in the depth first
+generation, a step `a` is moved backward over the steps independent of
+it, if it meets a independent step `b` of a greater session index before
+any dependent step, the swapped interleaving is smaller, so the prefix
+(and all the interleavings start with it) is pruned.
+
+the footprint of a step is declared in the spec with a directive comment:
+
+    #@ footprint "s1a" read a, b write c
+
+or inferred from the sql text for some simple statements in infer mode.
+the step without a footprint is dependent on all the other steps.
+
+..note:
+  the reduction is off by default, the kept interleavings is a subset of
+  the full ones, so the expected output should be made with the same mode
+"""
+
+import re
+import logging
+
+logger = logging.getLogger('Reduction')
+
+REDUCTION_OFF = ''
+REDUCTION_ANNOTATED = 'annotated'
+REDUCTION_INFER = 'infer'
+
+_FOOTPRINT_DIRECTIVE = re.compile(
+    r'^\s*#@\s*footprint\s+"(?P<tag>[^"]+)"(?P<body>.*)$', re.M
+    )
+_FOOTPRINT_PART = re.compile(
+    r'\b(?P<kind>reads?|writes?)\b(?P<objects>[^\n]*?)(?=\breads?\b|\bwrites?\b|$)'
+    )
+
+# the objects which make the writes on a table touch other tables, the
+# footprint can not be inferred from the sql text
+_HIDDEN_DEPENDENCY = re.compile(
+    r'\b(REFERENCES|FOREIGN\s+KEY|TRIGGER|RULE|INHERITS|PARTITION|POLICY)\b',
+    re.I
+    )
+_TRANSACTION_START = re.compile(
+    r'^\s*(BEGIN|START\s+TRANSACTION)\b[\w\s,]*;?\s*$', re.I
+    )
+_SELECT = re.compile(r'^\s*SELECT\b', re.I)
+_SELECT_LOCKING = re.compile(r'\bFOR\s+(UPDATE|SHARE|NO\s+KEY|KEY)\b', re.I)
+_INSERT = re.compile(r'^\s*INSERT\s+INTO\s+(?P<table>[\w.]+)', re.I)
+_UPDATE = re.compile(r'^\s*UPDATE\s+(ONLY\s+)?(?P<table>[\w.]+)', re.I)
+_DELETE = re.compile(r'^\s*DELETE\s+FROM\s+(ONLY\s+)?(?P<table>[\w.]+)',
+                     re.I)
+_FROM_LIST = re.compile(
+    r'\b(FROM|JOIN|USING)\s+(?P<tables>[\w.]+(\s*(\s+(AS\s+)?\w+)?\s*,\s*'
+    r'[\w.]+)*)', re.I
+    )
+_CALL = re.compile(r'\w\s*\(')
+_QUOTED = re.compile(r"'(''|[^'])*'")
+
+
+class Footprint(object):
+    """the objects read and written by a step
+
+    :type reads: set of str
+    :param reads: the names of the objects read
+
+    :type writes: set of str
+    :param writes: the names of the objects written
+    """
+    def __init__(self, reads=(), writes=()):
+        self.reads = set(reads)
+        self.writes = set(writes)
+
+    def conflicts(self, other):
+        return bool(self.writes & (other.reads | other.writes)
+                    or self.reads & other.writes)
+
+    def __repr__(self):
+        return ("read %s write %s"
+                % (",".join(sorted(self.reads)), ",".join(sorted(self.writes))))
+
+
+def _names(text):
+    return set(name.strip().lower() for name in text.split(',')
+               if name.strip())
+
+def parse_footprints(content):
+    """get the footprint directives from the spec content
+
+    :type content: str
+    :param content: the spec file content
+
+    :rtype: dict
+    :returns: {step tag: :class:`Footprint`}
+    """
+    footprints = {}
+    for match in _FOOTPRINT_DIRECTIVE.finditer(content):
+        reads, writes = set(), set()
+        for part in _FOOTPRINT_PART.finditer(match.group('body')):
+            if part.group('kind').lower().startswith('read'):
+                reads |= _names(part.group('objects'))
+            else:
+                writes |= _names(part.group('objects'))
+        footprints[match.group('tag')] = Footprint(reads, writes)
+    return footprints
+
+def _from_tables(sql):
+    tables = set()
+    for match in _FROM_LIST.finditer(sql):
+        for item in match.group('tables').split(','):
+            tables.add(item.split()[0].lower())
+    return tables
+
+def infer_statement_footprint(sql):
+    """infer the footprint of a simple statement, only the statements
+    without function calls and sub queries are inferred
+
+    :type sql: str
+    :param sql: the sql statement
+
+    :rtype: :class:`Footprint`
+    :returns: the footprint, None if it can not be inferred
+    """
+    if _TRANSACTION_START.match(sql):
+        return Footprint()
+
+    text = _QUOTED.sub("''", sql)
+
+    if _SELECT.match(text):
+        if _SELECT_LOCKING.search(text) or '(' in text:
+            return None
+        return Footprint(reads=_from_tables(text))
+
+    match = _INSERT.match(text)
+    if match:
+        rest = text[match.end():]
+        # only a column list and the VALUES lists are allowed
+        rest = re.sub(r'^\s*\([\w\s,]*\)', '', rest)
+        rest = re.sub(r'\bVALUES\s*', '', rest, flags=re.I)
+        if (_CALL.search(rest) or re.search(r'\b(SELECT|RETURNING|ON)\b',
+                                            rest, re.I)):
+            return None
+        return Footprint(writes=[match.group('table').lower()])
+
+    for pattern in (_UPDATE, _DELETE):
+        match = pattern.match(text)
+        if match:
+            if (_CALL.search(text)
+                or re.search(r'\bRETURNING\b', text, re.I)):
+                return None
+            table = match.group('table').lower()
+            reads = _from_tables(text[match.end():])
+            return Footprint(reads=reads, writes=[table])
+
+    return None
+
+def infer_footprint(sqls):
+    """
+    :type sqls: list of str
+    :param sqls: the sql statements of a step
+
+    :rtype: :class:`Footprint`
+    :returns: the union footprint, None if any one can not be inferred
+    """
+    footprint = Footprint()
+    for sql in sqls:
+        one = infer_statement_footprint(sql)
+        if one is None:
+            return None
+        footprint.reads |= one.reads
+        footprint.writes |= one.writes
+    return footprint
+
+def has_hidden_dependency(sqls):
+    """whether the sqls create objects which make the footprint inferred
+    from the sql text not trustable, like foreign keys and triggers
+    """
+    return any(_HIDDEN_DEPENDENCY.search(sql) for sql in sqls)
+
+def dependent(a, b):
+    if a is None or b is None:
+        return True
+    return a.conflicts(b)
+
+def iter_reduced_interleavings(groups, footprints):
+    """generate the interleavings in lexicographic normal form, in the same
+    sequence as the full generation
+
+    :type groups: list of list
+    :param groups: the step tags (or the steps) of each session
+
+    :type footprints: list of list of :class:`Footprint`
+    :param footprints: the footprint of each step, None means unknown
+
+    :rtype: generator of list
+    :returns: the kept interleavings
+    """
+    nsessions = len(groups)
+    total = sum(len(group) for group in groups)
+    piles = [0] * nsessions
+    # (session index, footprint) of the steps in the prefix
+    prefix = []
+
+    def is_normal(session, footprint):
+        for other, other_footprint in reversed(prefix):
+            if other == session or dependent(footprint, other_footprint):
+                return True
+            if session < other:
+                return False
+        return True
+
+    def generate():
+        if len(prefix) == total:
+            yield [groups[i][n] for i, n in _replay(prefix, nsessions)]
+            return
+        for i in range(nsessions):
+            if piles[i] >= len(groups[i]):
+                continue
+            footprint = footprints[i][piles[i]]
+            if not is_normal(i, footprint):
+                continue
+            prefix.append((i, footprint))
+            piles[i] += 1
+            yield from generate()
+            piles[i] -= 1
+            prefix.pop()
+
+    yield from generate()
+
+def _replay(prefix, nsessions):
+    counters = [0] * nsessions
+    for i, _ in prefix:
+        yield i, counters[i]
+        counters[i] += 1
@@ -0,0 +1,115 @@
+"""on disk cache of the built test case structure
+
+every runner process builds its test case from the spec file, that is the
+ply lexer and yacc parser, the sql splitting of every block and the
+implicit permutations expanding. the built structure is pickled into the
+cache directory, keyed by the spec content hash and the parser version (a
+hash of the source files which produce the pickled objects), so an
+unchanged spec is never parsed again, and a parser change will make all
+the cached structures out of date.
+"""
+
+import os
+import sys
+import pickle
+import hashlib
+import logging
+import tempfile
+import contextlib
+import config
+
+logger = logging.getLogger('SpecCache')
+
+# the directory to keep the built test case structures, empty means no cache
+SPEC_CACHE_DIR = getattr(config, 'spec_cache_dir', '')
+
+# the source files (relative to the package root) whose change will change
+# the built structure or the pickled classes
+_PARSER_SOURCES = [
+    'testcase/__init__.py',
+    'testcase/case_parser.py',
+    'testcase/case_tokens.py',
+    'testcase/modules.py',
+    'testcase/permutations.py',
+    'testcase/reduction.py',
+    'utils/sql.py',
+    'utils/connection.py',
+    'utils/timeouts.py',
+    ]
+
+_parser_version = None
+
+def get_parser_version():
+    """
+    :rtype: str
+    :returns: the hash of the parser sources and the python version
+    """
+    global _parser_version
+    if _parser_version is not None:
+        return _parser_version
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sha = hashlib.sha1()
+    sha.update(sys.version.encode('utf-8'))
+    for source in _PARSER_SOURCES:
+        with open(os.path.join(root, source), 'rb') as fd:
+            sha.update(fd.read())
+    _parser_version = sha.hexdigest()
+    return _parser_version
+
+def _cache_file(content):
+    sha = hashlib.sha1()
+    sha.update(get_parser_version().encode('utf-8'))
+    sha.update(content.encode('utf-8'))
+    return os.path.join(SPEC_CACHE_DIR, sha.hexdigest() + '.pickle')
+
+def load(content):
+    """get the built structure of the spec content from the cache
+
+    :type content: str
+    :param content: the spec file content
+
+    :rtype: object
+    :returns: the cached structure, None if not cached
+    """
+    if not SPEC_CACHE_DIR:
+        return None
+
+    path = _cache_file(content)
+    try:
+        with open(path, 'rb') as fd:
+            return pickle.load(fd)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug("drop broken spec cache %s: %s" % (path, str(e)))
+        return None
+
+def store(content, structure):
+    """save the built structure of the spec content to the cache, the
+    file is written to a temp file and renamed, so the runners running at
+    the same time will never read a partial file
+
+    :type content: str
+    :param content: the spec file content
+
+    :type structure: object
+    :param structure: the built structure to pickle
+    """
+    if not SPEC_CACHE_DIR:
+        return
+
+    path = _cache_file(content)
+    tmp = None
+    try:
+        os.makedirs(SPEC_CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=SPEC_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(structure, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.debug("cannot save spec cache %s: %s" % (path, str(e)))
+        # the cache directory may be shared by many runners
+        if tmp:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
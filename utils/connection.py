@@ -1,8 +1,14 @@
 import psycopg2
 import logging
-import select
+import asyncio
 import datetime
 import time
+import os
+import re
+import hashlib
+import config
+from utils import trace
+from utils.timeouts import DEFAULT_TIMEOUT, POLL_MAX_TIME
 
 from exc import (
     WaitDataTimeoutException,
@@ -12,83 +18,254 @@ from exc import (
 
 logger = logging.getLogger('connection')
 
+# the environment variable which tell the runner the port of the database
+# server, the check mode may start many servers on different ports
+SERVER_PORT_ENV = 'PGREGRESS_PORT'
+
 """
 We divide the PostgreSQL connection into two types of connection, libpq
 dosen't have such case, we use the same libpq connection structure to
 handle the sync and async function calls. but psycopg2 have the limitation
 that the connection which is created without async=1 parameter will not
 support async function calls.
+
+the waiting for the async connection is driven by an asyncio event loop,
+the socket of the connection is registered to the loop, and the waiting
+is waked up by the socket readiness instead of a select() timeout polling.
+the sync style interfaces (wait_async, getResult, ...) just run the
+awaitables in a per process event loop.
 """
 
+_event_loop = None
+_event_loop_pid = None
+
+def get_event_loop():
+    """get the event loop which drives the async connections, the loop is
+    created for each process, a forked runner pool worker will not share
+    the loop with its parent
+
+    :rtype: :class:`asyncio.AbstractEventLoop`
+    :returns: the event loop for current process
+    """
+    global _event_loop, _event_loop_pid
+    if (_event_loop is None or _event_loop.is_closed()
+        or _event_loop_pid != os.getpid()):
+        _event_loop = asyncio.new_event_loop()
+        _event_loop_pid = os.getpid()
+    return _event_loop
+
+def run_until_complete(awaitable):
+    """run a awaitable in the event loop of current process, and return
+    its result, this is the bridge for the sync style interfaces
+    """
+    return get_event_loop().run_until_complete(awaitable)
+
+async def wait_fds(readers=(), writers=(), deadline=None):
+    """wait until any of the file descriptors is ready
+
+    :type readers: list of int
+    :param readers: the file descriptors waiting for read readiness
+
+    :type writers: list of int
+    :param writers: the file descriptors waiting for write readiness
+
+    :type deadline: float
+    :param deadline: the loop time to give up waiting, None means forever
+
+    :rtype: Boolen
+    :returns: True for some file descriptor ready, False for timeout
+    """
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+
+    def wakeup(ready):
+        if not waiter.done():
+            waiter.set_result(ready)
+
+    for fd in readers:
+        loop.add_reader(fd, wakeup, True)
+    for fd in writers:
+        loop.add_writer(fd, wakeup, True)
+    timer = None
+    if deadline is not None:
+        timer = loop.call_at(deadline, wakeup, False)
+
+    try:
+        return await waiter
+    finally:
+        for fd in readers:
+            loop.remove_reader(fd)
+        for fd in writers:
+            loop.remove_writer(fd)
+        if timer is not None:
+            timer.cancel()
+
+def wait_any_readable(sessions, seconds):
+    """wait for at most specified seconds, until any of the async sessions
+    has data arrived
+
+    :type sessions: list of :class:`PGAsyncConnection`
+    :param sessions: the sessions to wait for
+
+    :type seconds: float
+    :param seconds: the max seconds to wait
+
+    :rtype: Boolen
+    :returns: whether some session has data arrived
+    """
+    fds = [session.fileno() for session in sessions]
+    if not fds:
+        return False
+
+    async def waiter():
+        deadline = asyncio.get_running_loop().time() + seconds
+        return await wait_fds(readers=fds, deadline=deadline)
+
+    return run_until_complete(waiter())
+
+# the rows converted from the cursor each time when rendering the result,
+# the cursor is a client side one, the whole result is already received
+# by libpq, it only bounds the python rows copied at a time
+RESULT_FETCH_SIZE = 1000
+# print at most the number of rows for a result, 0 means no limit
+RESULT_ROW_CAP = getattr(config, 'result_row_cap', 0)
+# print the row count and the digest of the rows instead of the rows
+RESULT_DIGEST = getattr(config, 'result_digest', False)
+
+def convert_result(value):
+    """currently python has different value print as c style, below
+    is the convertion to do:
+    * python style False/True to C style f/t
+    * python style None to C style `[nil]`(blank)
+    """
+    if value is False:
+        return 'f'
+    if value is True:
+        return 't'
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        # ugly convertion, but no choice, c version code output a
+        # floag with no .0 suffix for integer like value
+        value = str(value)
+        if value.endswith('.0'):
+            return value[:-2]
+    elif isinstance(value, datetime.date):
+        return value.strftime('%m-%d-%Y')
+
+    return value
+
 class ExecutionResult(object):
-    def __init__(self, descriptions=[], rows=[]):
-        self.descriptions = descriptions
-        self.rows = rows
+    """the result got from database, the rows are kept in the cursor and
+    fetched in pieces when rendering, so a huge result will not be copied
+    into python lists again and again.
 
-    def is_empty(self):
-        return len(self.descriptions) == 0 and len(self.rows) == 0
+    ..note:
+      this streams the output only, the memory of the result received by
+      libpq is not bounded. a server side (named) cursor is not used, the
+      async connections do not support it, and declaring a cursor for the
+      step sqls would change when their locks are taken
 
-    def output(self):
-        """print the result to screen, the result is got from database
+    :type descriptions: list
+    :param descriptions: the column names in the result
 
-        :type descriptions: list
-        :param descriptions: the column names in the result
+    :type rows: list of lists
+    :param rows: entry rows for the result of a db query
 
-        :type rows: list of lists
-        :param rows: entry rows for the result of a db query
-          
+    :type cursor: :class:`psycopg2.extensions.cursor`
+    :param cursor: the cursor holding the rows, used instead of the rows
+    """
+    def __init__(self, descriptions=[], rows=[], cursor=None):
+        self.descriptions = descriptions
+        self._rows = rows
+        self._cursor = cursor
+
+    @property
+    def rows(self):
+        """all the rows in a list, the rows in the cursor are materialized
+        """
+        if self._cursor is not None:
+            self._rows = [list(row) for row in self.iter_rows()]
+            self._cursor = None
+        return self._rows
+
+    def row_count(self):
+        if self._cursor is not None:
+            return self._cursor.rowcount
+        return len(self._rows)
+
+    def iter_rows(self):
+        """iterate the rows, the cursor is fetched with fetchmany()
         """
-        def convert_result(value):
-            """currently python has different value print as c style, below
-            is the convertion to do:
-            * python style False/True to C style f/t
-            * python style None to C style `[nil]`(blank)
-            """
-            if value is False:
-                return 'f'
-            if value is True:
-                return 't'
-            if value is None:
-                return ''
-            if isinstance(value, float):
-                # ugly convertion, but no choice, c version code output a
-                # floag with no .0 suffix for integer like value
-                value = str(value)
-                if value.endswith('.0'):
-                    return value[:-2]
-            elif isinstance(value, datetime.date):
-                return value.strftime('%m-%d-%Y')
-
-            return value
-                
-        #if not descriptions or not rows:
-        #    return
-        if self.descriptions is None or self.rows is None:
-            return ""
+        if self._cursor is None:
+            yield from self._rows
+            return
+        # rewind, so that the result can be rendered more than once
+        self._cursor.scroll(0, mode='absolute')
+        while True:
+            rows = self._cursor.fetchmany(RESULT_FETCH_SIZE)
+            if not rows:
+                break
+            yield from rows
 
-        if self.is_empty():
-            return ""
+    def is_empty(self):
+        return len(self.descriptions) == 0 and self.row_count() == 0
 
-        outputs = []
-        line = ""
-        
-        for desc in self.descriptions:
-            line += ("%-15s" % desc)
+    def iter_lines(self):
+        """render the result line by line, a header line, a blank line and
+        the row lines, the rows are limited by the result_row_cap, or
+        replaced by a digest line in result_digest mode
+        """
+        if self.descriptions is None or self._rows is None:
+            return
 
-        if line != "":
-            outputs.append(line)
-            
-        outputs.append("")
+        if self.is_empty():
+            return
 
-        for row in self.rows:
-            line = ""
-            for t in row:
-                t = convert_result(t)
-                line += ("%-15s" % t)
-            outputs.append(line)
+        line = "".join(["%-15s" % desc for desc in self.descriptions])
+        if line != "":
+            yield line
+
+        yield ""
+
+        digest = hashlib.sha1() if RESULT_DIGEST else None
+        count = 0
+        for row in self.iter_rows():
+            line = "".join(["%-15s" % convert_result(t) for t in row])
+            count += 1
+            if digest is not None:
+                digest.update(line.encode('utf-8'))
+                digest.update(b"\n")
+            elif not RESULT_ROW_CAP or count <= RESULT_ROW_CAP:
+                yield line
+
+        if digest is not None:
+            yield "(%d rows, sha1 %s)" % (count, digest.hexdigest())
+        elif RESULT_ROW_CAP and count > RESULT_ROW_CAP:
+            yield "(%d rows, %d not shown)" % (count, count - RESULT_ROW_CAP)
+
+    def write(self, stream):
+        """write the result to the stream line by line, it is same as
+        writing output() but without building the whole string
+
+        :type stream: file object
+        :param stream: the stream to write, like sys.stdout
+
+        :rtype: Boolen
+        :returns: whether something was written
+        """
+        written = False
+        for line in self.iter_lines():
+            if written:
+                stream.write("\n")
+            stream.write(line)
+            written = True
+        return written
 
-        pstr = "\n".join(outputs)
-        return pstr
+    def output(self):
+        """print the result to screen, the result is got from database
+        """
+        return "\n".join(self.iter_lines())
         
 
 class SQLBlockExecutionStatus(object):
@@ -99,20 +276,58 @@ class SQLBlockExecutionStatus(object):
     FAILED = 4
     
 
-INITIALIZE_SLOTS = 20
+# the statements which return no rows and can run in a transaction block,
+# they are safe to be sent together in one multi-statement query
+_BATCHABLE_SQL = re.compile(
+    r'^\s*(CREATE|DROP|ALTER|INSERT|UPDATE|DELETE|GRANT|REVOKE|COMMENT|'
+    r'TRUNCATE)\b', re.I
+    )
+_NOT_BATCHABLE_SQL = re.compile(
+    r'\b(DATABASE|TABLESPACE|CONCURRENTLY|SUBSCRIPTION|SYSTEM|RETURNING|'
+    r'ADD\s+VALUE)\b', re.I
+    )
+
+def is_batchable_sql(sql):
+    """whether the sql can be sent in a multi-statement query, the sql
+    should return no rows, and should not be the one which cannot run
+    inside a transaction block (a multi-statement query is run in a
+    implicit transaction)
+    """
+    return bool(_BATCHABLE_SQL.match(sql)
+                and not _NOT_BATCHABLE_SQL.search(sql))
+
+# the shared result of the sqls which return nothing
+_EMPTY_RESULT = ExecutionResult()
+# the max seconds to wait for the data before checking the lock status
+BLOCK_TIME = 0.02
 class SQLBlockExecutorHelper(object):
     """this is a exectutor helper for a sqlblock, ad sqlblock always have
     many sub sqls, and the helper will track the exection status, hold the
     temp result when doing middle of the sqls.
+
+    the helper is reset for every permutation, so the storage is allocated
+    once with the number of the sqls, and only the used slots are cleared
+    when reset. only the results which have something to output are kept.
     """
+    __slots__ = ('_sqlblock', '_sqls', '_num_of_sqls', '_pos', '_results',
+                 '_errors', '_warns', '_status', '_timeout', '_started',
+                 '_canceled')
+
     def __init__(self, sqlblock):
         self._sqlblock = sqlblock
-        #self._status = SQLBlockExecutionStatus.INITIALIZED
-        self._num_of_sqls = self._sqlblock.num()
+        self._status = SQLBlockExecutionStatus.INITIALIZED
+        self._sqls = [self.simecolonCompletion(sql)
+                      for sql in self._sqlblock.get_sqls()]
+        self._num_of_sqls = len(self._sqls)
         self._pos = -1
-        self._results = [ExecutionResult()] * INITIALIZE_SLOTS
-        self._errors = [''] * INITIALIZE_SLOTS
-        self._warns = [''] * INITIALIZE_SLOTS
+        self._results = [None] * self._num_of_sqls
+        self._errors = [''] * self._num_of_sqls
+        self._warns = [''] * self._num_of_sqls
+        self._timeout = DEFAULT_TIMEOUT
+        # when the current sql was sent (or last seen lock blocked), and
+        # whether it was canceled, for the watchdog
+        self._started = None
+        self._canceled = False
 
     #def start(self):
     #    if self._status == SQLBlockExecutionStatus.INITIALIZED:
@@ -122,23 +337,15 @@ class SQLBlockExecutorHelper(object):
         if self.is_completed():
             return None
         if showonly:
-            self._pos += 1
-            sql = self._sqlblock[self._pos]
-            sql = self.simecolonCompletion(sql)
-            self._pos -= 1
-            return sql
+            return self._sqls[self._pos + 1]
         
         self._pos += 1
-        sql = self._sqlblock[self._pos]
-        sql = self.simecolonCompletion(sql)
-        return sql
+        return self._sqls[self._pos]
 
     def current_sql(self):
         if self._pos == -1:
             return None
-        sql = self._sqlblock[self._pos]
-        sql = self.simecolonCompletion(sql)
-        return sql
+        return self._sqls[self._pos]
 
     def status(self):
         return self._status
@@ -155,10 +362,13 @@ class SQLBlockExecutorHelper(object):
     def set_result(self, result):
         if not isinstance(result, ExecutionResult):
             raise Exception("the result should be a ExecutionResult class")
-        self._results[self._pos] = result
+        # the empty result output nothing, no need to keep it
+        self._results[self._pos] = None if result.is_empty() else result
 
     def get_result(self):
-        return self._results[self._pos]
+        if self._pos < 0:
+            return _EMPTY_RESULT
+        return self._results[self._pos] or _EMPTY_RESULT
 
     def output(self):
         results = []
@@ -166,22 +376,77 @@ class SQLBlockExecutorHelper(object):
             executionresult = self._results[i]
             if executionresult is None:
                 continue
-            if executionresult.is_empty():
-                continue
             result = executionresult.output()
             results.append(result)
             
         return "\n".join(results)
 
+    def write(self, stream):
+        """write the output() to the stream result by result, the rows are
+        streamed from the cursors instead of building a whole string
+
+        :rtype: Boolen
+        :returns: whether something was written
+        """
+        written = False
+        for i in range(self._pos+1):
+            executionresult = self._results[i]
+            if executionresult is None:
+                continue
+            if written:
+                stream.write("\n")
+            executionresult.write(stream)
+            written = True
+        return written
+
     def get_error(self):
+        if self._pos < 0:
+            return ''
         return self._errors[self._pos]
 
     def set_warn(self, warn):
         self._warns[self._pos] = warn
 
     def get_warn(self):
+        if self._pos < 0:
+            return ''
         return self._warns[self._pos]
 
+    def set_timeout(self, timeout):
+        """
+        :type timeout: :class:`utils.timeouts.StepTimeout`
+        :param timeout: the timeouts of the sqls
+        """
+        self._timeout = timeout
+
+    def timeout(self):
+        return self._timeout
+
+    def watch(self, session, since):
+        """the watchdog of current sql, cancel it after the cancel timeout,
+        and give up after the abort timeout
+
+        :type since: float
+        :param since: the time to count from
+
+        ..note:
+          WaitDataTimeoutException is raised for giving up
+        """
+        elapsed = time.time() - since
+        if elapsed > self._timeout.cancel and not self._canceled:
+            trace.instant('cancel', 'step', session=session.name,
+                          pid=session.get_backend_pid())
+            logger.debug("cancel sql %s after %.1f seconds"
+                           % (self.current_sql(), elapsed))
+            session.cancel_backend()
+            self._canceled = True
+
+        if elapsed > self._timeout.abort:
+            raise WaitDataTimeoutException(
+                "sql %s timeout after %.1f seconds"
+                % (self.current_sql(), elapsed)
+                )
+
     def __repr__(self):
         lines = []
         counter = 0
@@ -207,17 +472,70 @@ class SQLBlockExecutorHelper(object):
         return sql + ';'
 
     def reset(self):
+        """clear the used slots only, the storage is reused
+        """
+        for i in range(self._pos + 1):
+            self._results[i] = None
+            self._errors[i] = ''
+            self._warns[i] = ''
         self._pos = -1
-        self._results = [ExecutionResult()] * INITIALIZE_SLOTS
-        self._errors = [''] * INITIALIZE_SLOTS
-        self._warns = [''] * INITIALIZE_SLOTS
+        self._status = SQLBlockExecutionStatus.INITIALIZED
+
+    def execute(self, session, batch_size=0):
+        """execute all the sqls in the sqlblock
+
+        :type batch_size: int
+        :param batch_size: send at most the number of continuous batchable
+                           sqls in one round trip, 0 means one by one
+        """
+        if batch_size > 1:
+            self._execute_batched(session, batch_size)
+            return
 
-    def execute(self, session):
         while not self.is_completed():
             sql = self.next_sql()
             result = session.execute(sql)
             self.set_result(result)
 
+    def _execute_batched(self, session, batch_size):
+        """the continuous batchable sqls are sent as a multi-statement
+        query, they return no rows so the results keep empty, the other
+        sqls are executed one by one as normal.
+
+        ..note:
+          a multi-statement query is run in a implicit transaction, if it
+          fails, nothing is done, so the sqls are executed again one by one
+          to get the same error (and the same partial work) as before
+        """
+        while not self.is_completed():
+            sql = self.next_sql()
+            if not is_batchable_sql(sql):
+                self.set_result(session.execute(sql))
+                continue
+
+            start = self._pos
+            batch = [sql]
+            while (len(batch) < batch_size and not self.is_completed()
+                   and is_batchable_sql(self.next_sql(showonly=True))):
+                batch.append(self.next_sql())
+
+            if len(batch) == 1:
+                self.set_result(session.execute(sql))
+                continue
+
+            try:
+                session.execute("\n".join(batch))
+            except psycopg2.Error as e:
+                logger.debug("batch of %d sqls failed, execute them one by "
+                             "one: %s" % (len(batch), str(e)))
+                self._pos = start - 1
+                for _ in batch:
+                    self.set_result(session.execute(self.next_sql()))
+                continue
+
+            for pos in range(start, self._pos + 1):
+                self._results[pos] = None
+
     def sendSQL(self, session, check_lock):
         """execute the sql in the sqlblock one by one, until the waiting lock
         case 
@@ -230,6 +548,8 @@ class SQLBlockExecutorHelper(object):
             
         while not self.is_completed():
             sql = self.next_sql()
+            self._started = time.time()
+            self._canceled = False
             session.sendSQL(sql)
             try:
                 self.try_complete_current_execution(session, check_lock)
@@ -238,8 +558,25 @@ class SQLBlockExecutorHelper(object):
             
         self._status = SQLBlockExecutionStatus.COMPLETED
 
-    def try_complete_current_execution(self, session, check_lock):
+    def try_complete_current_execution(self, session, check_lock,
+                                       first_wait=None):
+        """sync style interface of complete_current_execution()
+        """
+        return run_until_complete(
+            self.complete_current_execution(session, check_lock, first_wait)
+            )
+
+    async def complete_current_execution(self, session, check_lock,
+                                         first_wait=None):
+        """wait for the result of current sql, the waiting is waked up as
+        soon as the data arrived, if there is no data after the block time,
+        check whether the session is locked.
 
+        :type first_wait: float
+        :param first_wait: the max seconds of the first waiting, the caller
+                           may already wait for the session, None means
+                           the normal block time
+        """
         if not callable(check_lock):
             raise Exception(
                 "SQLHelper::sendSQLUtilWait() need a check_lock function"
@@ -248,12 +585,13 @@ class SQLBlockExecutorHelper(object):
         if self.get_error():
             raise WaitDataErrorException(self.get_error())
 
-        block_time = 0.02 # block 100ms
-        descriptions, rows = [], []
-        start_time = time.time()
+        block_time = BLOCK_TIME
+        wait_time = block_time if first_wait is None else first_wait
+        if self._started is None:
+            self._started = time.time()
         while True:
             try:
-                executionresult = session.getResult(block_time)
+                executionresult = await session.result(wait_time)
                 break
             except WaitDataErrorException as e:
                 self.set_error(str(e))
@@ -261,14 +599,16 @@ class SQLBlockExecutorHelper(object):
             except WaitDataTimeoutException as e:
                 if check_lock(session.get_backend_pid()):
                     self._status = SQLBlockExecutionStatus.BLOCKED
+                    # waiting for a lock is not a hang, the watchdog
+                    # counts from the time it goes on
+                    self._started = time.time()
                     raise WaitDataLockedException(str(e))
-                now = time.time()
-                if now - start_time > 60:
-                    session.cancel_backend()
-                    
-                if now - start_time > 75:
-                    raise WaitDataTimeoutException("sql %s timeout" % sql)
+                self.watch(session, self._started)
 
+                # the waiting is waked up as soon as the data arrived, a
+                # longer wait only makes the lock status checked less
+                wait_time = min(max(wait_time, block_time) * 2,
+                                POLL_MAX_TIME)
                 continue
             except Exception as e:
                 # there is tricky workarround for handling try_complete
@@ -318,16 +658,13 @@ class PGConnection(object):
             )
         cursor = self._conn.cursor()
         cursor.execute(sql)
-        try:
-            dbrows = cursor.fetchall()
-        except Exception as e:
+        if cursor.description is None:
             logger.debug(
                 "there is no response for sql %s" % sql)
             return ExecutionResult([], [])
 
         descriptions = [desc[0] for desc in cursor.description]
-        rows = [list(row) for row in dbrows]
-        return ExecutionResult(descriptions, rows)
+        return ExecutionResult(descriptions, cursor=cursor)
 
     def sendSQL(self):
         raise Exception("sync connection cannot support sendSQL async call")
@@ -347,6 +684,14 @@ class PGConnection(object):
     def close(self):
         self._conn.close()
 
+    def is_idle(self):
+        """whether the connection is open and not in a transaction, only
+        a idle connection can be reused by others
+        """
+        return (not self._conn.closed and
+                self._conn.get_transaction_status() ==
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
     def get_backend_pid(self):
         """retrieve the backend related process id
 
@@ -366,23 +711,36 @@ class PGConnection(object):
         _, rows = self.execute(sql)
         #print("PGConnection::cancel_backend", rows)
 
-def wait_async(conn):
+async def wait_async_ready(conn, deadline=None):
     """wait for the connection to be ready for next operation
 
     this is used for a async connection, since async mode connection will
     not block any function call, and after the function call, it maybe
     not finish doing its work, we need to wait for the work completion
+
+    :type deadline: float
+    :param deadline: the loop time to give up waiting, None means forever
+
+    :rtype: Boolen
+    :returns: True for ready, False for timeout
     """
     while 1:
         state = conn.poll()
         if state == psycopg2.extensions.POLL_OK:
-            break
+            return True
         elif state == psycopg2.extensions.POLL_WRITE:
-            select.select([], [conn.fileno()], [])
+            ready = await wait_fds(writers=[conn.fileno()], deadline=deadline)
         elif state == psycopg2.extensions.POLL_READ:
-            select.select([conn.fileno()], [], [])
+            ready = await wait_fds(readers=[conn.fileno()], deadline=deadline)
         else:
             raise psycopg2.OperationalError("poll() returned %s" % state)
+        if not ready:
+            return False
+
+def wait_async(conn):
+    """sync style interface of wait_async_ready()
+    """
+    run_until_complete(wait_async_ready(conn))
             
 class PGAsyncConnection(object):
     """PostgresSQL sync mode connection class which provide some basic
@@ -419,17 +777,13 @@ class PGAsyncConnection(object):
         self._async_cursor.execute(sql)
 
         wait_async(self._conn)
-    
-        try:
-            dbrows = self._async_cursor.fetchall()
-        except Exception as e:
-            return ExecutionResult([], [])
 
-        descriptions = [desc[0] for desc in self._async_cursor.description]
-        rows = [list(row) for row in dbrows]
-        self._async_cursor.close()
+        cursor, self._async_cursor = self._async_cursor, None
+        if cursor.description is None:
+            return ExecutionResult([], [])
 
-        return ExecutionResult(descriptions, rows)
+        descriptions = [desc[0] for desc in cursor.description]
+        return ExecutionResult(descriptions, cursor=cursor)
 
     def sendSQL(self, sql):
         """send sql in async to postgresql server, nothing will be returned
@@ -454,75 +808,63 @@ class PGAsyncConnection(object):
     def close(self):
         self._conn.close()
 
+    def fileno(self):
+        return self._conn.fileno()
+
     def getResult(self, seconds=0):
+        """sync style interface of result(), when seconds=0, it only polls
+        the response without waiting, None means wait forever.
+        """
+        return run_until_complete(self.result(seconds))
+
+    async def result(self, seconds=None):
         """a async get result function, if the response is not ready, just
-        wait for specified seconds at most, when seconds=0, it will be
-        a blocked call.
+        wait for specified seconds at most, the waiting is waked up by the
+        event loop as soon as the socket of the connection is readable.
 
         ..note:
           actually this function is mainly merged from C version code,
-          part of the isolationtester.c::try_complete_step(), there is
-          a problem that is not very accurate. when there is some data
-          arrived(not all data), the select will returned, but now poll
-          status is no OK, so go on to select more data, but the timeout
-          time is still the same with the first time, if some times of
-          of such case happened, every select wait for same timeout,
-          the total timeout will be more than expected timeout. there
-          is a solution that before every select, minor the duration
-          of last select occupied time, this seems to be more complex,
-          and will have very little impact with the tool execution
-          context. most of the time, the function is called just after
-          the sendSQL(), if lock happen, no data will be received, and
-          the timeout will be accurate.
-
-        :type second: int
-        :param second: seconds the function will wait for , 0 means wait
-                       forever, normally use a very little number for a
-                       async wait
-        :rtype: list of tuples
-        :returns: descriptions and rows, (None, None) for timeout 
+          part of the isolationtester.c::try_complete_step(), when there
+          is some data arrived(not all data), the poll status is not OK,
+          so go on to wait for more data, the deadline is computed once,
+          so the total waiting will not be more than expected timeout.
+
+        :type second: float
+        :param second: seconds the function will wait for , None means
+                       wait forever, normally use a very little number for
+                       a async wait
+        :rtype: :class:`ExecutionResult`
+        :returns: descriptions and rows, WaitDataTimeoutException is raised
+                  for timeout
         """
         if self._async_cursor is None or self._async_cursor.closed:
             raise Exception(
                 "PGAsyncConnection::getResult() cursor is None or closed"
                 )
-        
-        is_timeout = False
-        while 1:
-            if is_timeout:
-                raise WaitDataTimeoutException()
-            try:
-                state = self._conn.poll()
-            except Exception as e:
-                diag = e.diag
-                # only raise the primary error message
-                errormsg = "%s:  %s" % (diag.severity, diag.message_primary)
-                raise WaitDataErrorException(errormsg)
-            
-            if state == psycopg2.extensions.POLL_OK:
-                break
-            else:
-                t = select.select([self._conn.fileno()], [], [], seconds)
-                if t == ([], [], []): # timeout case, triple empty list
-                    is_timeout = True
-                else:
-                    continue
-
-        descriptions = []
-        if hasattr(self._async_cursor, "description") \
-           and self._async_cursor.description is not None:
-            descriptions = [desc[0] for desc in self._async_cursor.description]
-            
+
+        deadline = None
+        if seconds is not None:
+            deadline = asyncio.get_running_loop().time() + seconds
+
         try:
-            dbrows = self._async_cursor.fetchall()
-        except Exception as e:
-            #print("we got some exception for fetchall", str(e))
-            return ExecutionResult(descriptions, [])
-        
-        rows = [list(row) for row in dbrows]
+            ready = await wait_async_ready(self._conn, deadline)
+        except psycopg2.Error as e:
+            diag = e.diag
+            # only raise the primary error message
+            errormsg = "%s:  %s" % (diag.severity, diag.message_primary)
+            raise WaitDataErrorException(errormsg)
+
+        if not ready:
+            raise WaitDataTimeoutException()
+
+        # the rows are kept in the cursor and fetched when rendering, the
+        # cursor is detached, so that getting the result again will raise
+        cursor, self._async_cursor = self._async_cursor, None
+        if cursor.description is None:
+            return ExecutionResult([], [])
 
-        self._async_cursor.close()
-        return ExecutionResult(descriptions, rows)
+        descriptions = [desc[0] for desc in cursor.description]
+        return ExecutionResult(descriptions, cursor=cursor)
         
     # def get_backend_id(self):
     #     """get the connection related server backend process id
@@ -539,6 +881,14 @@ class PGAsyncConnection(object):
     #     _, rows = self.execute(sql)
     #     return rows[0][0]
 
+    def is_idle(self):
+        """whether the connection is open and has no query running or
+        transaction opened
+        """
+        return (not self._conn.closed and not self._conn.isexecuting() and
+                self._conn.get_transaction_status() ==
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
     # above get_backend_pid is a old implementation, below is the new
     def get_backend_pid(self):
         return self._backend_pid
@@ -547,9 +897,10 @@ class PGAsyncConnection(object):
         logger.debug(
             'PGConnection::cancel_backend() Conn(%s)' % (self.name)
             )
-        sql = ("select pg_cancel_backend({0})").format(self._backend_pid)
-        self._async_cursor = self._conn.cursor()
-        self._async_cursor.execute(sql)
+        # a async connection cannot run another query before the result
+        # of current one is got, so the cancel request is sent by libpq
+        # in a separate connection, it works as pg_cancel_backend()
+        self._conn.cancel()
 
         # because it is a caancel operation , so the next wait poll will
         # fail with exception
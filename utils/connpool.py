@@ -0,0 +1,133 @@
+"""database connection pool of the runner process
+
+the runner opens the maint session and a async session for each test
+session of every case, the connecting (the backend fork and the password
+authentication) is a visible cost for the short cases. the pool keeps the
+released idle connections, and hands them out again to the later cases in
+the same process (like the runner pool worker), the connection is reset to
+a clean session state before reused.
+"""
+
+import os
+import logging
+import config
+from utils.connection import PGConnectionManager, PGAsyncConnection
+
+logger = logging.getLogger('ConnPool')
+
+# the max idle connections kept for each database, 0 means no pool
+CONNECTION_POOL_SIZE = getattr(config, 'connection_pool_size', 0)
+
+# it works as DISCARD ALL, but DISCARD ALL cannot run in a multi-statement
+# query (a implicit transaction block), so the sub commands are used
+_RESET_SQL = (
+    "CLOSE ALL; SET SESSION AUTHORIZATION DEFAULT; RESET ALL; "
+    "DEALLOCATE ALL; SELECT pg_catalog.pg_advisory_unlock_all(); "
+    "DISCARD PLANS; DISCARD TEMP; DISCARD SEQUENCES; UNLISTEN *;"
+    )
+
+
+class ConnectionPool(object):
+    """keep the idle connections by the connection parameters
+
+    :type size: int
+    :param size: the max idle connections kept for each kind of connection
+    """
+    def __init__(self, size=CONNECTION_POOL_SIZE):
+        self._size = size
+        self._idle = {} # {(async, database, user, password, host, port): []}
+        self._keys = {} # {id(connection): key}
+
+    def acquire(self, database, user, password, host, port, async_=False):
+        """get a healthy connection, a idle one is reset and reused, or a
+        new one is created
+
+        :type async_: Boolen
+        :param async_: True for a :class:`utils.connection.PGAsyncConnection`
+
+        :rtype: :class:`utils.connection.PGConnection`
+        :returns: the connection in a clean session state
+        """
+        key = (async_, database, user, password, host, port)
+        idle = self._idle.get(key, [])
+        while idle:
+            conn = idle.pop()
+            if self._reset(conn):
+                logger.debug("reuse connection of backend %d"
+                             % conn.get_backend_pid())
+                self._keys[id(conn)] = key
+                return conn
+            self._close(conn)
+
+        if async_:
+            conn = PGConnectionManager.new_async_connection(
+                database, user, password, host, port)
+        else:
+            conn = PGConnectionManager.new_connection(
+                database, user, password, host, port)
+        if self._size > 0:
+            self._keys[id(conn)] = key
+        return conn
+
+    def release(self, conn):
+        """give back the connection, it is kept if it is idle and the pool
+        is not full, or it is closed
+        """
+        key = self._keys.pop(id(conn), None)
+        if key is None or not conn.is_idle():
+            self._close(conn)
+            return
+
+        idle = self._idle.setdefault(key, [])
+        if len(idle) >= self._size:
+            self._close(conn)
+            return
+        idle.append(conn)
+
+    def clear(self):
+        """close all the idle connections
+        """
+        for idle in self._idle.values():
+            for conn in idle:
+                self._close(conn)
+        self._idle = {}
+
+    def _reset(self, conn):
+        """reset the session state, and it is also a health check
+
+        :rtype: Boolen
+        :returns: whether the connection is healthy
+        """
+        try:
+            if not conn.is_idle():
+                return False
+            if not isinstance(conn, PGAsyncConnection):
+                conn.autocommit(True)
+            conn.execute(_RESET_SQL)
+            conn.set_name('unknown')
+            return True
+        except Exception as e:
+            logger.debug("drop the broken connection: %s" % str(e))
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_pid = None
+
+def get_connection_pool():
+    """get the connection pool of current process, a forked process will
+    not share the connections with its parent
+
+    :rtype: :class:`ConnectionPool`
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ConnectionPool()
+        _pool_pid = os.getpid()
+    return _pool
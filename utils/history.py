@@ -0,0 +1,134 @@
+"""duration history of the test runs
+
+the durations of the recent runs are kept in json files under the history
+directory, they are used to predict the durations of the next run, like
+the adaptive step timeouts. only the latest durations of each key are
+kept, so the history follows the changes of the cases and the servers.
+"""
+
+import os
+import json
+import logging
+import tempfile
+import config
+
+logger = logging.getLogger('History')
+
+# the directory to keep the duration history, empty means no history
+HISTORY_DIR = getattr(config, 'history_dir', './history')
+# the max durations kept for each key
+HISTORY_SIZE = getattr(config, 'history_size', 50)
+
+
+class DurationHistory(object):
+    """the recent durations (in seconds) by keys, loaded from and saved to
+    a json file
+
+    :type path: str
+    :param path: the json file path, None means nothing loaded or saved
+
+    :type size: int
+    :param size: the max durations kept for each key
+    """
+    def __init__(self, path, size=HISTORY_SIZE):
+        self._path = path
+        self._size = size
+        self._durations = None # {key: [seconds]}
+        self._changed = False
+
+    def _load(self):
+        if self._durations is not None:
+            return
+        self._durations = {}
+        if not self._path:
+            return
+        try:
+            with open(self._path, 'r') as fd:
+                self._durations = json.load(fd)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.debug("ignore the broken history %s: %s"
+                         % (self._path, str(e)))
+
+    def durations(self, key):
+        """
+        :rtype: list of float
+        :returns: the recent durations of the key, the oldest first
+        """
+        self._load()
+        return self._durations.get(key, [])
+
+    def all_durations(self):
+        """
+        :rtype: list of list
+        :returns: the recent durations of all the keys
+        """
+        self._load()
+        return list(self._durations.values())
+
+    def add(self, key, seconds):
+        self._load()
+        durations = self._durations.setdefault(key, [])
+        durations.append(round(seconds, 6))
+        del durations[:-self._size]
+        self._changed = True
+
+    def percentile(self, key, pct):
+        """the nearest rank percentile of the recent durations
+
+        :type pct: float
+        :param pct: the percentile, like 99
+
+        :rtype: float
+        :returns: the duration, None if there is no history
+        """
+        durations = sorted(self.durations(key))
+        if not durations:
+            return None
+        rank = -(-len(durations) * pct // 100)
+        return durations[max(int(rank), 1) - 1]
+
+    def save(self):
+        """write the history if something added, the file is replaced
+        atomically, so a reader never sees a partial file
+        """
+        if not self._changed or not self._path:
+            return
+        directory = os.path.dirname(self._path) or '.'
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._durations, f)
+            os.replace(tmp, self._path)
+            self._changed = False
+        except OSError as e:
+            logger.debug("fail to save the history %s: %s"
+                         % (self._path, str(e)))
+
+def step_history(case_path):
+    """the step duration history of a case, the cases of different
+    profiles may have the same name, so they are kept by profiles
+
+    :type case_path: str
+    :param case_path: the spec file path
+
+    :rtype: :class:`DurationHistory`
+    """
+    if not HISTORY_DIR:
+        return DurationHistory(None)
+    profile = os.path.basename(os.path.dirname(os.path.abspath(case_path)))
+    name = os.path.splitext(os.path.basename(case_path))[0]
+    path = os.path.join(HISTORY_DIR, 'steps', profile, name + '.json')
+    return DurationHistory(path)
+
+def case_history():
+    """the case duration history of all the profiles, the key is like
+    <profile name>/<case name>
+
+    :rtype: :class:`DurationHistory`
+    """
+    if not HISTORY_DIR:
+        return DurationHistory(None)
+    return DurationHistory(os.path.join(HISTORY_DIR, 'cases.json'))
@@ -0,0 +1,165 @@
+"""limit the cases running at the same time on a server
+
+every spec runner opens a maint connection and a connection for each
+session, a wide batch may use up the max_connections of the server, or
+overload the cpu and make the steps timeout. a case is admitted only if
+the running cases are less than the workers, and the connections of the
+running cases and it fit in the budget. the budget is derived from the
+max_connections of the server by default. a case is always admitted when
+nothing is running, so a case wider than the budget still runs alone.
+"""
+
+import io
+import logging
+import threading
+import contextlib
+import config
+from utils.connection import PGConnectionManager
+
+logger = logging.getLogger('Limiter')
+
+# the max cases running at the same time on a server, 0 means no limit
+MAX_WORKERS = getattr(config, 'max_workers', 0)
+# the max connections used by the running cases, None means derived from
+# the max_connections of the server, 0 means no limit
+CONNECTION_BUDGET = getattr(config, 'connection_budget', None)
+# the connections kept free when the budget is derived from the server
+CONNECTION_RESERVE = getattr(config, 'connection_reserve', 3)
+
+# the session of the spt case which runs the shell commands, it has no
+# database connection
+_SHELL_SESSION = 'shell'
+
+_case_connections = {} # {spec file path: connections}
+_case_connections_lock = threading.Lock()
+
+
+def case_connections(path):
+    """the connections a runner opens for the case, the maint session, the
+    database sessions of the parsed spec, and the template session if the
+    setup template database is used. the spec is parsed once (or loaded
+    from the spec cache) for a process
+
+    :type path: str
+    :param path: the spec file path
+
+    :rtype: int
+    """
+    with _case_connections_lock:
+        if path in _case_connections:
+            return _case_connections[path]
+
+    # the import is here, the parser is only loaded by the applications
+    # which limit the cases
+    from testcase import TestCase
+    testcase = TestCase(path)
+    try:
+        # the keywords print messages when parsing
+        with contextlib.redirect_stdout(io.StringIO()):
+            testcase.build()
+        sessions = len([tag for tag in testcase.session_tags()
+                        if tag != _SHELL_SESSION])
+    except Exception as e:
+        logger.debug("cannot parse %s, count it as one connection: %s"
+                     % (path, str(e)))
+        sessions = 0
+    if (sessions and getattr(config, 'setup_template_db', False)
+        and testcase.setups()):
+        sessions += 1
+
+    with _case_connections_lock:
+        _case_connections[path] = 1 + sessions
+    return 1 + sessions
+
+def server_connection_budget(port):
+    """the connections can be used by the cases, the max_connections of
+    the server, without the superuser reserved ones, the ones already
+    used, and the configured reserve
+
+    :rtype: int
+    :returns: the budget, 0 means no limit (the server can not be asked)
+    """
+    try:
+        conn = PGConnectionManager.new_connection(
+            config.dbname, config.user, config.password, config.host, port)
+    except Exception as e:
+        logger.warning("cannot get max_connections of port %s: %s"
+                       % (port, str(e)))
+        return 0
+    try:
+        rows = conn.execute(
+            "SELECT current_setting('max_connections')::int - "
+            "current_setting('superuser_reserved_connections')::int - "
+            "(SELECT count(*) FROM pg_stat_activity "
+            " WHERE datid IS NOT NULL)::int"
+            ).rows
+        # the connection asking is closed, so it is not counted
+        return max(rows[0][0] + 1 - CONNECTION_RESERVE, 1)
+    except Exception as e:
+        logger.warning("cannot get max_connections of port %s: %s"
+                       % (port, str(e)))
+        return 0
+    finally:
+        conn.close()
+
+
+class ConnectionLimiter(object):
+    """admit the cases by the workers and the connection budget
+
+    :type workers: int
+    :param workers: the max cases running at the same time, 0 means no
+                    limit
+
+    :type budget: int
+    :param budget: the max connections of the running cases, 0 means no
+                   limit
+    """
+    def __init__(self, workers=MAX_WORKERS, budget=0):
+        self._workers = workers
+        self._budget = budget
+        self._running = 0
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def budget(self):
+        return self._budget
+
+    def _admits(self, demand):
+        if self._running == 0:
+            return True
+        if self._workers > 0 and self._running >= self._workers:
+            return False
+        if self._budget > 0 and self._used + demand > self._budget:
+            return False
+        return True
+
+    def try_acquire(self, demand):
+        """
+        :type demand: int
+        :param demand: the connections of the case
+
+        :rtype: Boolean
+        :returns: whether the case is admitted, it should be released
+                  after the case finished if admitted
+        """
+        with self._cond:
+            if not self._admits(demand):
+                return False
+            self._running += 1
+            self._used += demand
+            return True
+
+    def acquire(self, demand):
+        """wait until the case is admitted
+        """
+        with self._cond:
+            while not self._admits(demand):
+                self._cond.wait()
+            self._running += 1
+            self._used += demand
+
+    def release(self, demand):
+        with self._cond:
+            self._running -= 1
+            self._used -= demand
+            self._cond.notify_all()
@@ -0,0 +1,91 @@
+"""lock status service for the test sessions
+
+the runner need to know whether a session which has no response is
+blocked by a lock, asking the maint session one pid by one pid will make
+the round trips grow with the number of the waiting sessions. here all the
+candidate backend pids are checked in one query, and the result is cached
+for a scheduling tick, the later checks in the same tick just read the
+cache.
+"""
+
+import time
+import logging
+from utils.connection import BLOCK_TIME
+
+logger = logging.getLogger('LockStatus')
+
+
+class LockStatus(object):
+    """batched pg_isolation_test_session_is_blocked checker
+
+    the cache is dropped when a new tick starts, a tick is ended by the
+    runner (normally a step completed, which may release some locks), or
+    the cache is older than the tick length.
+
+    ..note:
+      pg_isolation_test_session_is_blocked function is involved in 9.6
+
+    :type maint_session: :class:`utils.connection.PGConnection`
+    :param maint_session: the session which send the lock check query
+
+    :type backend_pids: list of int
+    :param backend_pids: all the backend pids of the test, the locks held
+                         by these pids are interesting
+
+    :type candidate_pids: list of int
+    :param candidate_pids: the backend pids which may be blocked, normally
+                           the pids of the test sessions
+
+    :type tick: float
+    :param tick: the max seconds the cached status is valid
+    """
+    def __init__(self, maint_session, backend_pids, candidate_pids,
+                 tick=BLOCK_TIME):
+        self._maint_session = maint_session
+        self._backend_pids = list(backend_pids)
+        self._candidate_pids = list(candidate_pids)
+        self._tick = tick
+        self._status = {}
+        self._refreshed_at = None
+
+    def new_tick(self):
+        """drop the cached status, the next check will query again
+        """
+        self._refreshed_at = None
+
+    def is_blocked(self, pid):
+        """whether the backend is blocked by a lock
+
+        :type pid: int
+        :param pid: the backend process id
+
+        :rtype: Boolen
+        :returns: True if the backend is waiting for a lock
+        """
+        now = time.time()
+        if (self._refreshed_at is None
+            or now - self._refreshed_at >= self._tick
+            or pid not in self._status):
+            self.refresh(pid)
+        return self._status.get(pid, False)
+
+    def refresh(self, pid=None):
+        """check all the candidate pids in one round trip
+
+        :type pid: int
+        :param pid: a extra pid need to be checked besides the candidates
+        """
+        pids = list(self._candidate_pids)
+        if pid is not None and pid not in pids:
+            pids.append(pid)
+
+        sql = (
+            "SELECT pid, pg_catalog.pg_isolation_test_session_is_blocked"
+            "(pid, '{{{pids}}}') FROM unnest('{{{candidates}}}'::integer[])"
+            " AS pid"
+            ).format(pids=','.join([str(x) for x in self._backend_pids]),
+                     candidates=','.join([str(x) for x in pids]))
+
+        result = self._maint_session.execute(sql)
+        self._status = dict((row[0], row[1]) for row in result.rows)
+        self._refreshed_at = time.time()
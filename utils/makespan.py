@@ -0,0 +1,147 @@
+"""predict the case durations and the makespan of a run
+
+the duration of a case is predicted by the median of its recent durations
+in the history, a case without history is predicted as the average of the
+known cases. the cases are started longest first when there is a choice
+(the longest processing time first rule), so a long case does not start
+last and stretch the run, and the makespan is predicted by simulating the
+same scheduling.
+"""
+
+import heapq
+
+
+class CaseEstimator(object):
+    """predict the case durations by the history
+
+    :type history: :class:`utils.history.DurationHistory`
+    :param history: the case duration history
+
+    :type key: function
+    :param key: get the history key of a case
+    """
+    def __init__(self, history, key):
+        self._history = history
+        self._key = key
+        self._default = None
+
+    def known(self, case):
+        return bool(self._history.durations(self._key(case)))
+
+    def estimate(self, case):
+        """
+        :rtype: float
+        :returns: the predicted seconds of the case
+        """
+        seconds = self._history.percentile(self._key(case), 50)
+        if seconds is not None:
+            return seconds
+        return self._default_estimate()
+
+    def _default_estimate(self):
+        if self._default is None:
+            medians = [sorted(durations)[(len(durations) - 1) // 2]
+                       for durations in self._history.all_durations()
+                       if durations]
+            self._default = sum(medians) / len(medians) if medians else 0
+        return self._default
+
+
+def longest_first(items, estimate):
+    """sort the items by the predicted durations, the longest first, the
+    items of the same duration keep their sequence
+    """
+    return sorted(items, key=estimate, reverse=True)
+
+def slots_makespan(durations, slots=0):
+    """the makespan of running the jobs longest first on the slots, a job
+    takes the slot which is free first
+
+    :type durations: list of float
+    :param durations: the job durations
+
+    :type slots: int
+    :param slots: the number of the slots, 0 means no limit
+
+    :rtype: float
+    """
+    if not durations:
+        return 0
+    if slots <= 0 or slots >= len(durations):
+        return max(durations)
+    finishes = [0] * slots
+    for duration in sorted(durations, reverse=True):
+        heapq.heapreplace(finishes, finishes[0] + duration)
+    return max(finishes)
+
+def graph_priorities(graph, estimate):
+    """the priority of a case is the longest path from it to the end (its
+    own duration and the longest priority of the cases need it), starting
+    the case on the critical path first shortens the makespan
+
+    :type graph: :class:`utils.schedule.ScheduleGraph`
+
+    :rtype: dict
+    :returns: {case name: seconds}
+    """
+    dependents = {case.name(): [] for case in graph.cases()}
+    for case in graph.cases():
+        for name in graph.needs(case.name()):
+            dependents[name].append(case.name())
+    durations = {case.name(): estimate(case) for case in graph.cases()}
+
+    # in the reverse topological sequence, the cases need a case are
+    # computed before it
+    indegree = {name: len(others) for name, others in dependents.items()}
+    ready = [name for name, degree in indegree.items() if degree == 0]
+    priorities = {}
+    while ready:
+        name = ready.pop()
+        priorities[name] = durations[name] + max(
+            [priorities[other] for other in dependents[name]] or [0]
+            )
+        for other in graph.needs(name):
+            indegree[other] -= 1
+            if indegree[other] == 0:
+                ready.append(other)
+    return priorities
+
+def graph_makespan(graph, estimate, workers=0, priorities=None):
+    """simulate the :class:`utils.schedule.GraphScheduler` with the
+    predicted durations
+
+    :rtype: float
+    :returns: the predicted makespan
+    """
+    cases = list(graph.cases())
+    if priorities is not None:
+        cases.sort(key=lambda case: priorities[case.name()], reverse=True)
+    now = 0
+    done = set()
+    running = [] # heap of (finish time, sequence, case name)
+    running_names = set()
+    pending = cases
+    sequence = 0
+    while pending or running:
+        started = True
+        while started:
+            started = False
+            if workers > 0 and len(running) >= workers:
+                break
+            for case in pending:
+                name = case.name()
+                if (graph.needs(name) <= done
+                    and not graph.conflicts(name) & running_names):
+                    pending.remove(case)
+                    heapq.heappush(running,
+                                   (now + estimate(case), sequence, name))
+                    sequence += 1
+                    running_names.add(name)
+                    started = True
+                    break
+        if not running:
+            break
+        now, _, name = heapq.heappop(running)
+        running_names.discard(name)
+        done.add(name)
+    return now
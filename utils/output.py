@@ -0,0 +1,184 @@
+"""capture the output of the runner processes
+
+one thread drains the stdout pipes of all the runners by a selector, the
+output is read in large chunks and written to the result files with
+buffered io, the result file is flushed and closed when the runner closes
+its stdout. the line endings are translated like the universal newlines
+mode of the text pipes, '\r\n' and '\r' are written as '\n'. the output
+duplicated to screen is aggregated, the lines of a runner are logged
+together at most once an interval, so the cost of the application does
+not grow with the width of the batch.
+"""
+
+import os
+import time
+import logging
+import selectors
+import threading
+import config
+
+logger = logging.getLogger('Output')
+
+# the bytes read from a pipe at a time, and the buffer of a result file
+OUTPUT_CHUNK_SIZE = getattr(config, 'output_chunk_size', 65536)
+# the min seconds between two screen echoes of a runner
+OUTPUT_ECHO_INTERVAL = getattr(config, 'output_echo_interval', 0.5)
+
+
+class _Capture(object):
+    """the output capturing of a runner process
+    """
+    def __init__(self, proc, logfile, echo_logger):
+        self.proc = proc
+        self.logfile = logfile
+        self.fd = open(logfile, 'wb', buffering=OUTPUT_CHUNK_SIZE)
+        self.echo_logger = echo_logger
+        self.echo_lines = []
+        self.echo_partial = b''
+        self.echo_time = 0
+        # a '\r' at the end of a chunk may be the half of a '\r\n'
+        self.pending_cr = False
+        self.done = threading.Event()
+
+    def translate(self, data):
+        """translate the line endings of a chunk, the chunks are given in
+        sequence, a trailing '\r' is held until the next chunk
+        """
+        if self.pending_cr:
+            data = b'\r' + data
+            self.pending_cr = False
+        if data.endswith(b'\r'):
+            data = data[:-1]
+            self.pending_cr = True
+        return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+    def echo(self, data, force=False):
+        if self.echo_logger is None:
+            return
+        if data:
+            lines = (self.echo_partial + data).split(b'\n')
+            self.echo_partial = lines.pop()
+            self.echo_lines.extend(lines)
+        if force and self.echo_partial:
+            self.echo_lines.append(self.echo_partial)
+            self.echo_partial = b''
+        now = time.time()
+        if not self.echo_lines:
+            return
+        if not force and now - self.echo_time < OUTPUT_ECHO_INTERVAL:
+            return
+        self.echo_time = now
+        self.echo_logger.info(
+            b'\n'.join(self.echo_lines).decode('utf-8', 'replace').strip()
+            )
+        self.echo_lines = []
+
+    def write(self, data):
+        data = self.translate(data)
+        self.fd.write(data)
+        self.echo(data)
+
+    def close(self):
+        # the translated ending of a '\r' at the end of the output
+        if self.pending_cr:
+            self.pending_cr = False
+            self.fd.write(b'\n')
+            self.echo(b'\n')
+        self.echo(b'', True)
+        try:
+            self.fd.flush()
+            self.fd.close()
+        finally:
+            self.done.set()
+
+
+class OutputMultiplexer(object):
+    """drain the stdout of the runner processes in one thread, the thread
+    is started when the first runner is added
+    """
+    def __init__(self):
+        self._selector = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._adding = [] # captures to be registered by the thread
+        self._captures = {} # {proc: capture}
+        self._wakeup_r, self._wakeup_w = None, None
+
+    def _start(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def add(self, proc, logfile, to_screen=True, logger_name='Runner'):
+        """capture the stdout of the process to the log file, the stdout
+        should be a binary pipe
+
+        :type proc: :class:`subprocess.Popen`
+        :param proc: the return by subprocess.Popen function call
+
+        :type logfile: str
+        :param logfile: the log file absoute path
+
+        :type to_screen: bool
+        :param to_screen: indicate whether duplicated the log to screen
+        """
+        logger.debug("capture log to %s" % logfile)
+        echo_logger = logging.getLogger(logger_name) if to_screen else None
+        capture = _Capture(proc, logfile, echo_logger)
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            self._captures[proc] = capture
+            self._adding.append(capture)
+        os.write(self._wakeup_w, b'x')
+
+    def wait(self, proc):
+        """wait until all the output of the process is written
+        """
+        capture = self._captures.get(proc)
+        if capture is not None:
+            capture.done.wait()
+        with self._lock:
+            self._captures.pop(proc, None)
+
+    def _loop(self):
+        while True:
+            for key, _ in self._selector.select(OUTPUT_ECHO_INTERVAL):
+                if key.data is None:
+                    self._register()
+                else:
+                    self._read(key.data)
+            for capture in self._selector_captures():
+                capture.echo(b'')
+
+    def _selector_captures(self):
+        return [key.data for key in self._selector.get_map().values()
+                if key.data is not None]
+
+    def _register(self):
+        os.read(self._wakeup_r, OUTPUT_CHUNK_SIZE)
+        with self._lock:
+            adding, self._adding = self._adding, []
+        for capture in adding:
+            self._selector.register(capture.proc.stdout,
+                                    selectors.EVENT_READ, capture)
+
+    def _read(self, capture):
+        try:
+            data = os.read(capture.proc.stdout.fileno(), OUTPUT_CHUNK_SIZE)
+        except OSError as e:
+            logger.debug("fail to read the output of %s: %s"
+                         % (capture.logfile, str(e)))
+            data = b''
+        if data:
+            capture.write(data)
+            return
+        # the runner closed its stdout
+        self._selector.unregister(capture.proc.stdout)
+        capture.proc.stdout.close()
+        try:
+            capture.close()
+        except OSError as e:
+            logger.error("fail to write %s: %s" % (capture.logfile, str(e)))
@@ -0,0 +1,132 @@
+"""skip the cases whose inputs are unchanged since the last pass
+
+the key of a case run is the hash of everything the result depends on:
+the spec file, the expected files, the config values which change the
+result, the binaries under the installation bin directory, and the
+context, the keys of the cases run before it on the same database. the
+result of a passed case is saved under the key, when the key is found
+again, the case can be reported as a cached pass without running, and the
+saved result is put to the results directory as if it was run.
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import config
+
+logger = logging.getLogger('ResultCache')
+
+# the directory of the passed results, empty means no cache
+RESULT_CACHE_DIR = getattr(config, 'result_cache_dir', '')
+# the config values in the key
+RESULT_CACHE_CONFIG = getattr(config, 'result_cache_config', [
+    'dbname', 'user', 'installation', 'result_filters', 'result_masks',
+    'result_unordered', 'result_row_cap', 'result_digest',
+    'permutation_sample', 'permutation_seed', 'permutation_reduction',
+    'setup_template_db',
+    ])
+
+_bin_fingerprint = None
+
+def _update_file(sha, path):
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b''):
+            sha.update(chunk)
+
+def get_bin_fingerprint():
+    """the hash of the binaries under the installation bin directory, it
+    is computed once for a process
+
+    :rtype: str
+    """
+    global _bin_fingerprint
+    if _bin_fingerprint is not None:
+        return _bin_fingerprint
+    sha = hashlib.sha1()
+    bindir = os.path.join(config.installation, 'bin')
+    if os.path.isdir(bindir):
+        for name in sorted(os.listdir(bindir)):
+            path = os.path.join(bindir, name)
+            if not os.path.isfile(path):
+                continue
+            sha.update(name.encode('utf-8') + b'\0')
+            _update_file(sha, path)
+    _bin_fingerprint = sha.hexdigest()
+    return _bin_fingerprint
+
+
+class ResultCache(object):
+    """the passed results by the keys of the case inputs
+
+    :type directory: str
+    :param directory: the cache directory, empty means no cache
+    """
+    def __init__(self, directory=RESULT_CACHE_DIR):
+        self._directory = directory
+
+    def enabled(self):
+        return bool(self._directory)
+
+    def case_key(self, case, expecteds, context=''):
+        """
+        :type case: :class:`testcase.TestCaseDesc`
+        :param case: the test case
+
+        :type expecteds: list of str
+        :param expecteds: the expected files of the case
+
+        :type context: str
+        :param context: the hash of the keys of the cases before it
+
+        :rtype: str
+        :returns: the hash of the case inputs
+        """
+        sha = hashlib.sha1()
+        sha.update(case.name().encode('utf-8') + b'\0')
+        _update_file(sha, case.path())
+        for expected in expecteds:
+            sha.update(os.path.basename(expected).encode('utf-8') + b'\0')
+            _update_file(sha, expected)
+        for name in RESULT_CACHE_CONFIG:
+            sha.update(("%s=%r\0" % (name, getattr(config, name, None)))
+                       .encode('utf-8'))
+        sha.update(get_bin_fingerprint().encode('utf-8'))
+        sha.update(context.encode('utf-8'))
+        return sha.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + '.out')
+
+    def lookup(self, case, expecteds, context=''):
+        """
+        :rtype: str
+        :returns: the saved result file of the same inputs, None if the
+                  case did not pass with them
+        """
+        if not self.enabled() or not expecteds:
+            return None
+        path = self._path(self.case_key(case, expecteds, context))
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def store(self, case, expecteds, result, context=''):
+        """save the result of a passed case
+
+        :type result: str
+        :param result: the result file
+        """
+        if not self.enabled() or not expecteds:
+            return
+        path = self._path(self.case_key(case, expecteds, context))
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f, open(result, 'rb') as src:
+                shutil.copyfileobj(src, f)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.debug("cannot save the result of %s: %s"
+                         % (case.name(), str(e)))
@@ -1,9 +1,23 @@
 """parse the test profile schedule file, provide interface to get the
 scheduled testcase
+
+each `test:` line is a batch of cases running at the same time, and a
+batch starts after the previous batch finished. the ordering can be
+declared more precisely with the lines:
+
+    needs: <case> <prerequisite case> ...
+    conflicts: <case> <case> ...
+
+a case with a `needs:` line starts as soon as its prerequisites finished
+(an empty list means it can start at any time), instead of waiting for
+the whole previous batch. the cases in a `conflicts:` line never run at
+the same time. the cases without a `needs:` line keep the batch barrier,
+they start after all the cases of the earlier lines finished.
 """
 
 import sys
 import os
+import threading
 
 import logging
 from testcase import TestCaseDesc
@@ -43,12 +57,172 @@ class TestBatch(object):
         return True
 
     def __str__(self):
-        return " ".join(self._tests)
+        return " ".join([str(t) for t in self._tests])
 
     def __getitem__(self, number):
         return self._tests[number]
 
 
+class ScheduleGraph(object):
+    """the cases and the ordering constraints between them, the cases are
+    kept in the schedule sequence
+    """
+    def __init__(self):
+        self._cases = []
+        self._names = {} # {case name: TestCaseDesc}
+        self._needs = {} # {case name: set of prerequisite case names}
+        self._conflicts = {} # {case name: set of conflicting case names}
+
+    def add(self, case, needs=()):
+        self._cases.append(case)
+        self._names[case.name()] = case
+        self._needs[case.name()] = set(needs)
+        self._conflicts.setdefault(case.name(), set())
+
+    def add_conflict(self, a, b):
+        if a == b:
+            return
+        self._conflicts.setdefault(a, set()).add(b)
+        self._conflicts.setdefault(b, set()).add(a)
+
+    def cases(self):
+        return self._cases
+
+    def has(self, name):
+        return name in self._names
+
+    def needs(self, name):
+        return self._needs[name]
+
+    def conflicts(self, name):
+        return self._conflicts.get(name, set())
+
+    def dependents(self):
+        """
+        :rtype: dict
+        :returns: {case name: list of the case names need it}
+        """
+        dependents = {name: [] for name in self._needs}
+        for name, needs in self._needs.items():
+            for other in needs:
+                dependents[other].append(name)
+        return dependents
+
+    def sorted_names(self):
+        """the case names in a topological sequence, the prerequisites of a
+        case are before it, the ones in or after a cycle are left out
+
+        :rtype: list of str
+        """
+        # kahn's algorithm, the ready cases are taken in schedule sequence
+        indegree = {name: len(needs) for name, needs in self._needs.items()}
+        dependents = self.dependents()
+        ready = [case.name() for case in self._cases
+                 if indegree[case.name()] == 0]
+        names = []
+        while ready:
+            name = ready.pop(0)
+            names.append(name)
+            for other in dependents[name]:
+                indegree[other] -= 1
+                if indegree[other] == 0:
+                    ready.append(other)
+        return names
+
+    def validate(self):
+        """check the names used in the constraints, and the cycles of the
+        prerequisites, a exception is raised for the invalid schedule
+        """
+        for name in set(self._needs) | set(self._conflicts):
+            for other in self._needs.get(name, set()) | self.conflicts(name):
+                if other not in self._names:
+                    raise Exception("unknown case %s in the schedule of %s"
+                                    % (other, name))
+
+        # what is left is in or after a cycle
+        cycle = sorted(set(self._needs) - set(self.sorted_names()))
+        if cycle:
+            raise Exception("cyclic needs in the schedule: %s"
+                            % " ".join(cycle))
+
+
+class GraphScheduler(object):
+    """run the cases of a :class:`ScheduleGraph`, a case is started as
+    soon as its prerequisites finished, no conflicting case is running,
+    and there is a free worker. the cases are tried in the schedule
+    sequence, or by the priorities if given.
+
+    :type graph: :class:`ScheduleGraph`
+    :param graph: the cases and the constraints
+
+    :type workers: int
+    :param workers: the max cases running at the same time, 0 means no
+                    limit
+
+    :type priorities: dict
+    :param priorities: {case name: priority}, the greater one is tried
+                       first
+    """
+    def __init__(self, graph, workers=0, priorities=None):
+        self._graph = graph
+        self._workers = workers
+        self._priorities = priorities
+        self._cond = threading.Condition()
+        self._done = set()
+        self._running = set()
+
+    def run(self, start):
+        """
+        :type start: function
+        :param start: called with the :class:`testcase.TestCaseDesc` in a
+                      new thread to run the case, a exception of it is
+                      logged and the case is treated as finished
+        """
+        pending = list(self._graph.cases())
+        if self._priorities is not None:
+            pending.sort(key=lambda case: self._priorities[case.name()],
+                         reverse=True)
+        threads = []
+        with self._cond:
+            while pending:
+                ready = self._next_ready(pending)
+                if ready is None:
+                    self._cond.wait()
+                    continue
+                pending.remove(ready)
+                self._running.add(ready.name())
+                t = threading.Thread(target=self._run_case,
+                                     args=(start, ready))
+                t.start()
+                threads.append(t)
+
+        for t in threads:
+            t.join()
+
+    def _next_ready(self, pending):
+        if self._workers > 0 and len(self._running) >= self._workers:
+            return None
+        for case in pending:
+            name = case.name()
+            if not self._graph.needs(name) <= self._done:
+                continue
+            if self._graph.conflicts(name) & self._running:
+                continue
+            return case
+        return None
+
+    def _run_case(self, start, case):
+        try:
+            start(case)
+        except Exception as e:
+            logger.error("fail to run case %s: %s" % (case.name(), str(e)))
+        finally:
+            with self._cond:
+                self._running.discard(case.name())
+                self._done.add(case.name())
+                self._cond.notify()
+
+
 class ScheduleCase(object):
     def __init__(self, schedule_file):
         self._file = schedule_file
@@ -57,6 +231,8 @@ class ScheduleCase(object):
             self._raw_data = fd.read()
         self._batches = []
         self._current_batches_idx = -1
+        self._needs = {} # {case name: [prerequisite case names]}
+        self._conflicts = [] # [[case names]]
 
     def show(self):
         print("there are %d batches of tests" % len(self._batches))
@@ -71,6 +247,15 @@ class ScheduleCase(object):
         
         for line in self._raw_data.splitlines():
             line = line.strip()
+            if line.startswith('needs:'):
+                names = line[len('needs:'):].split()
+                if not names:
+                    raise Exception("no case in schedule line: %s" % line)
+                self._needs.setdefault(names[0], []).extend(names[1:])
+                continue
+            if line.startswith('conflicts:'):
+                self._conflicts.append(line[len('conflicts:'):].split())
+                continue
             # currently didnot need to support `ignore`
             if not line.startswith('test:'):
                 continue
@@ -84,6 +269,41 @@ class ScheduleCase(object):
 
             self._batches.append(tb)
 
+    def has_constraints(self):
+        """whether the schedule declares the needs or the conflicts
+        """
+        return bool(self._needs or self._conflicts)
+
+    def graph(self):
+        """build the schedule graph, the cases without `needs:` depend on
+        all the cases of the earlier lines
+
+        :rtype: :class:`ScheduleGraph`
+        """
+        graph = ScheduleGraph()
+        earlier = []
+        for batch in self._batches:
+            names = []
+            for case in batch.tests():
+                needs = self._needs.get(case.name(), earlier)
+                graph.add(case, needs)
+                names.append(case.name())
+            earlier = earlier + names
+
+        for names in self._conflicts:
+            for i, a in enumerate(names):
+                for b in names[i+1:]:
+                    graph.add_conflict(a, b)
+
+        for name in self._needs:
+            if not graph.has(name):
+                raise Exception("unknown case %s in the schedule" % name)
+        graph.validate()
+        return graph
+
+    def batches(self):
+        return self._batches
+
     def next_batch(self):
         self._current_batches_idx += 1
         if self._current_batches_idx >= len(self._batches):
@@ -1,73 +1,106 @@
-def parse_sqls(sqlstr):
+import re
+
+# the tokens which change the splitting, everything else is skipped by the
+# regular expression search in C speed
+_SPECIAL = re.compile(r"""'|"|--|/\*|\$(?:[^\W\d]\w*)?\$|;""")
+_STRING_END = re.compile(r"(?:[^']|'')*'")
+_ESCAPE_STRING_END = re.compile(r"(?:[^'\\]|\\[\s\S]|'')*'")
+_IDENTIFIER_END = re.compile(r'(?:[^"]|"")*"')
+_COMMENT_MARK = re.compile(r'/\*|\*/')
+
+def _is_identifier_char(c):
+    return c.isalnum() or c == '_' or c == '$'
+
+def _skip_block_comment(sqlstr, pos):
+    """
+    :rtype: int
+    :returns: the position after the block comment starts at pos, block
+              comments can be nested in postgresql
     """
+    depth = 0
+    for match in _COMMENT_MARK.finditer(sqlstr, pos):
+        if match.group() == '/*':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    return len(sqlstr)
+
+def _skip_quoted(pattern, sqlstr, pos):
+    match = pattern.match(sqlstr, pos)
+    if match is None:
+        return len(sqlstr)
+    return match.end()
+
+def _strip_span(sqlstr, start, end):
+    while start < end and sqlstr[start].isspace():
+        start += 1
+    while end > start and sqlstr[end-1].isspace():
+        end -= 1
+    return start, end
+
+def iter_sql_offsets(sqlstr):
+    """split the sql clause to statements, only the offsets are returned,
+    the statement text is not copied
+
+    the semicolons in the string constants (including the E'' escape
+    strings), the quoted identifiers, the -- and /* */ comments, and the
+    dollar quoted strings (like the function bodies) do not end a statement
+
     :type sqlstr: str
     :param sqlstr: a complex sql clause
 
-    :rtype: list of string
-    :returns: a list of sub sqls
+    :rtype: generator of tuple
+    :returns: the (start, end) of each statement, the statement includes
+              the ending semicolon, the blanks around it are excluded
     """
-    #sqlstr = sqlstr.strip()
-    #if sqlstr[0] == '{':
-    #    # remove the left and right {}
-    #    sqlstr = sqlstr[1:-1]
-        
-    sqlstr = sqlstr.strip()
-
-    sqls = []
-    startpos = 0
-    newstr = ''
-    inquora = False
-    indollar = False
     length = len(sqlstr)
-    i = -1
-    trigger_name = ""
-    while i < length-1:
-        i += 1
-        c = sqlstr[i]
-        if c == '\'' and inquora is False:
-            # handle wrap quora case
-            if i > 0 and sqlstr[i-1] == '\\':
-                pass
-            else:
-                inquora = True
-            continue
-
-        if c == '\'' and inquora is True:
-            if i > 0 and sqlstr[i-1] == '\\':
-                pass
-            else:
-                inquora = False
-            continue
+    start = 0
+    pos = 0
+    while pos < length:
+        match = _SPECIAL.search(sqlstr, pos)
+        if match is None:
+            break
+        token = match.group()
+        begin = match.start()
 
-        # for simple implemetation, ignore the wrap \$$ case handling
-        if c == '$':
-            tmp = []
-            while True:
-                i += 1
-                if sqlstr[i] == "$":
-                    break
-                if i > 10000:
-                    print("strange !! invalid trigger ")
-                    exit(1)
-                tmp.append(sqlstr[i])
-            trigger_name = "".join(tmp)
-            #if not indollar:
-            #    print("find a new trigger", trigger_name)
-            #else:
-            #    print("end trigger", trigger_name)
-            indollar = not indollar
-            continue
+        if token == ';':
+            yield _strip_span(sqlstr, start, match.end())
+            start = pos = match.end()
+        elif token == "'":
+            escape = (begin > 0 and sqlstr[begin-1] in 'eE'
+                      and (begin == 1
+                           or not _is_identifier_char(sqlstr[begin-2])))
+            pos = _skip_quoted(_ESCAPE_STRING_END if escape else _STRING_END,
+                               sqlstr, match.end())
+        elif token == '"':
+            pos = _skip_quoted(_IDENTIFIER_END, sqlstr, match.end())
+        elif token == '--':
+            pos = sqlstr.find('\n', match.end())
+            if pos == -1:
+                pos = length
+        elif token == '/*':
+            pos = _skip_block_comment(sqlstr, begin)
+        elif begin > 0 and _is_identifier_char(sqlstr[begin-1]):
+            # the $ is part of a identifier, like a$b$c
+            pos = begin + 1
+        else:
+            # dollar quoted string, the same tag ends it, other tags in the
+            # body are just text
+            pos = sqlstr.find(token, match.end())
+            pos = length if pos == -1 else pos + len(token)
 
-        if c == ';' and inquora is False and indollar is False:
-            newstr = sqlstr[startpos:i+1].strip()
-            # remove newlines
-            sqls.append(newstr)
-            startpos = i+1
+    begin, end = _strip_span(sqlstr, start, length)
+    if begin < end:
+        yield begin, end
 
-    if i > startpos:
-        sqls.append(sqlstr[startpos:].strip())
-
-    #for index, sql in enumerate(sqls):
-    #    print("%s -- %s" % (index, sql))
+def parse_sqls(sqlstr):
+    """
+    :type sqlstr: str
+    :param sqlstr: a complex sql clause
 
-    return sqls
+    :rtype: list of string
+    :returns: a list of sub sqls
+    """
+    return [sqlstr[start:end] for start, end in iter_sql_offsets(sqlstr)]
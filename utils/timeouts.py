@@ -0,0 +1,158 @@
+"""timeouts of the step sqls
+
+a sql which is not lock blocked but gets no result is canceled after the
+cancel timeout, and the runner gives up after the abort timeout. the
+timeouts come from (the later one overrides the earlier one):
+
+  * the config, step_cancel_timeout and step_abort_timeout
+  * the `timeout` file in the profile directory, like `cancel 10 abort 15`
+  * the directive of the spec, `#@ timeout cancel 10 abort 15`
+  * the directive of the step, `#@ timeout "s1a" cancel 120 abort 150`
+
+the adaptive mode (`adaptive <factor>` in any of them, or the config
+step_timeout_adaptive) derives the cancel timeout of a step from its
+duration history, the p99 duration times the factor, so a hang is caught
+in seconds. the step without enough history, or with a timeout set by a
+step directive, uses the fixed timeouts.
+"""
+
+import os
+import re
+import logging
+import config
+
+logger = logging.getLogger('Timeouts')
+
+# the seconds to cancel a sql which is not lock blocked but gets no result
+STEP_CANCEL_TIMEOUT = getattr(config, 'step_cancel_timeout', 60)
+# the seconds to give up the sql, after the cancel
+STEP_ABORT_TIMEOUT = getattr(config, 'step_abort_timeout', 75)
+# the factor of the p99 step duration to be the cancel timeout, 0 is off
+STEP_TIMEOUT_ADAPTIVE = getattr(config, 'step_timeout_adaptive', 0)
+# the min cancel timeout and the min history size of the adaptive mode
+STEP_TIMEOUT_MIN = getattr(config, 'step_timeout_min', 5)
+STEP_TIMEOUT_SAMPLES = getattr(config, 'step_timeout_samples', 10)
+# the max seconds between the lock status checks of a waiting sql, the
+# interval is doubled from the block time to it
+POLL_MAX_TIME = getattr(config, 'poll_max_time', 0.5)
+
+# the file of the timeout settings in the profile directory
+PROFILE_TIMEOUT_FILE = 'timeout'
+
+_TIMEOUT_DIRECTIVE = re.compile(
+    r'^\s*#@\s*timeout\s+(?:"(?P<tag>[^"]+)")?(?P<body>.*)$', re.M
+    )
+_SETTING = re.compile(r'(?P<name>cancel|abort|adaptive)\s+(?P<value>[\d.]+)')
+
+
+class StepTimeout(object):
+    """the cancel and the abort seconds of the sqls of a step
+    """
+    __slots__ = ('cancel', 'abort')
+
+    def __init__(self, cancel=STEP_CANCEL_TIMEOUT, abort=STEP_ABORT_TIMEOUT):
+        self.cancel = cancel
+        self.abort = max(abort, cancel)
+
+    def __repr__(self):
+        return "cancel %s abort %s" % (self.cancel, self.abort)
+
+DEFAULT_TIMEOUT = StepTimeout()
+
+
+def parse_settings(text):
+    """
+    :type text: str
+    :param text: the settings like 'cancel 10 abort 15 adaptive 3'
+
+    :rtype: dict
+    :returns: {setting name: float}
+    """
+    return {match.group('name'): float(match.group('value'))
+            for match in _SETTING.finditer(text)}
+
+def parse_timeout_directives(content):
+    """get the timeout directives from the spec content
+
+    :type content: str
+    :param content: the spec file content
+
+    :rtype: tuple
+    :returns: the settings of the spec, and the settings of the steps
+              {step tag: settings}
+    """
+    spec, steps = {}, {}
+    for match in _TIMEOUT_DIRECTIVE.finditer(content):
+        settings = parse_settings(match.group('body'))
+        if match.group('tag'):
+            steps.setdefault(match.group('tag'), {}).update(settings)
+        else:
+            spec.update(settings)
+    return spec, steps
+
+def load_profile_settings(profile_dir):
+    """
+    :rtype: dict
+    :returns: the settings of the timeout file in the profile directory,
+              empty if there is no such file
+    """
+    path = os.path.join(profile_dir, PROFILE_TIMEOUT_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as fd:
+        return parse_settings(fd.read())
+
+
+class TimeoutPolicy(object):
+    """decide the timeouts of the steps of a case
+
+    :type profile_dir: str
+    :param profile_dir: the profile directory of the case
+
+    :type spec_settings: dict
+    :param spec_settings: the settings of the spec directive
+
+    :type step_settings: dict
+    :param step_settings: {step tag: settings} of the step directives
+
+    :type history: :class:`utils.history.DurationHistory`
+    :param history: the step duration history for the adaptive mode
+    """
+    def __init__(self, profile_dir, spec_settings, step_settings,
+                 history=None):
+        settings = {'cancel': STEP_CANCEL_TIMEOUT,
+                    'abort': STEP_ABORT_TIMEOUT,
+                    'adaptive': STEP_TIMEOUT_ADAPTIVE}
+        settings.update(load_profile_settings(profile_dir))
+        settings.update(spec_settings)
+        self._settings = settings
+        self._step_settings = step_settings
+        self._history = history
+        self._base = StepTimeout(settings['cancel'], settings['abort'])
+
+    def adaptive(self):
+        return self._settings['adaptive'] > 0
+
+    def for_step(self, tag):
+        """
+        :rtype: :class:`StepTimeout`
+        :returns: the timeouts of the step
+        """
+        if tag in self._step_settings:
+            settings = dict(self._settings, **self._step_settings[tag])
+            return StepTimeout(settings['cancel'], settings['abort'])
+
+        if not self.adaptive() or self._history is None:
+            return self._base
+        if len(self._history.durations(tag)) < STEP_TIMEOUT_SAMPLES:
+            return self._base
+
+        # never more tolerant than the fixed timeouts, and the time from
+        # the cancel to the abort is kept
+        p99 = self._history.percentile(tag, 99)
+        cancel = min(max(p99 * self._settings['adaptive'], STEP_TIMEOUT_MIN),
+                     self._base.cancel)
+        timeout = StepTimeout(cancel,
+                              cancel + self._base.abort - self._base.cancel)
+        logger.debug("adaptive timeout of step %s: %s" % (tag, timeout))
+        return timeout
@@ -0,0 +1,123 @@
+"""trace events of the test running
+
+every phase (connect, setup, steps, lock waits, teardown, diff, report)
+can be recorded as a trace event, the events are appended to the trace
+file as json lines in the chrome trace event format, all the processes
+(the application, the runners) append to the same file, the timestamps
+are wall clock microseconds, so the events of different processes are
+comparable. to view it in chrome://tracing or perfetto, wrap the lines
+into a json array:
+
+    python3 -c "import sys; print('[' + ','.join(sys.stdin) + ']')" \\
+        < trace.jsonl > trace.json
+
+when the trace file is not configured, the functions return at once, and
+span() gives a shared no-op context manager.
+"""
+
+import os
+import json
+import time
+import threading
+import config
+
+# the file to append the trace events, empty means no trace
+TRACE_FILE = getattr(config, 'trace_file', '')
+
+_enabled = bool(TRACE_FILE)
+_lock = threading.Lock()
+_fd = None
+_fd_pid = None
+
+
+class _NoopSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span(object):
+    """record a complete event from entering to exiting
+    """
+    def __init__(self, name, cat, args):
+        self._name = name
+        self._cat = cat
+        self._args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self._args['error'] = exc_type.__name__
+        complete(self._name, self._cat, self._start, **self._args)
+        return False
+
+
+def enabled():
+    return _enabled
+
+def now():
+    """the timestamp used for the start of complete()
+    """
+    return time.time()
+
+def span(name, cat, **args):
+    """trace the time of a with block
+
+    :type name: str
+    :param name: the event name, like 'setup'
+
+    :type cat: str
+    :param cat: the event category, like 'runner'
+
+    :rtype: context manager
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+    return _Span(name, cat, args)
+
+def complete(name, cat, start, end=None, **args):
+    """trace a duration measured by the caller
+
+    :type start: float
+    :param start: the start timestamp got from now()
+
+    :type end: float
+    :param end: the end timestamp, None means now
+    """
+    if not _enabled:
+        return
+    if end is None:
+        end = time.time()
+    _emit({'name': name, 'cat': cat, 'ph': 'X',
+           'ts': int(start * 1000000), 'dur': int((end - start) * 1000000),
+           'args': args})
+
+def instant(name, cat, **args):
+    """trace a event without duration, like a cancel
+    """
+    if not _enabled:
+        return
+    _emit({'name': name, 'cat': cat, 'ph': 'i', 's': 't',
+           'ts': int(time.time() * 1000000), 'args': args})
+
+def _emit(record):
+    global _fd, _fd_pid
+    record['pid'] = os.getpid()
+    record['tid'] = threading.get_native_id()
+    line = (json.dumps(record, default=str) + "\n").encode('utf-8')
+    with _lock:
+        if _fd is None or _fd_pid != os.getpid():
+            # a forked process opens its own descriptor, the O_APPEND
+            # makes the lines of the processes not overwrite each other
+            _fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0o644)
+            _fd_pid = os.getpid()
+        os.write(_fd, line)